@@ -0,0 +1,7 @@
+-- Migration: Index bdns.concesion(id_concesion)
+-- Date: 2026-10-16
+
+-- load_concesiones_jsonl resuelve qué concesiones son nuevas con un anti-join
+-- (LEFT JOIN ... WHERE c.id_concesion IS NULL) y enriquece las existentes con
+-- un UPDATE ... FROM por id_concesion. Sin índice ambos recorren la tabla entera.
+CREATE INDEX IF NOT EXISTS idx_concesion_id_concesion ON bdns.concesion(id_concesion);
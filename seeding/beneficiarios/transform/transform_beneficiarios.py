@@ -12,7 +12,6 @@ Este script SOLO hace transformacion:
 La carga a BD se hace en load_beneficiarios.py
 """
 
-import csv
 import json
 import re
 import logging
@@ -20,6 +19,9 @@ import argparse
 from pathlib import Path
 from datetime import datetime
 from collections import defaultdict
+
+import pandas as pd
+
 from bdns_core.db.utils import normalizar
 from ETL.etl_utils import get_or_create_dir
 
@@ -84,35 +86,45 @@ def procesar_csv_concesiones(archivo_csv: Path, beneficiarios: dict):
     """
     Procesa un CSV de concesiones y extrae beneficiarios.
 
+    El CSV se lee en columnas con pandas (solo idPersona y beneficiario) y se
+    descartan vacios y pares repetidos antes de pasar a Python: el mismo
+    beneficiario aparece en muchas concesiones.
+
     Args:
         archivo_csv: Path al archivo CSV
         beneficiarios: Dict donde acumular beneficiarios por id_persona
     """
-    with open(archivo_csv, encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            id_persona = row.get("idPersona")
-            beneficiario_raw = row.get("beneficiario") or ""
-
-            if not id_persona or not beneficiario_raw.strip():
-                continue
-
-            nif, nombre = extraer_nif_y_nombre(beneficiario_raw)
-            nombre_limpio = limpiar_nombre(nombre)
-
-            if not nombre_limpio:
-                continue
-
-            nombre_norm = normalizar(nombre_limpio)
-            forma_juridica = deducir_forma_juridica(nif)
-
-            beneficiarios[id_persona].append({
-                "nif": nif,
-                "nombre_original": nombre,
-                "nombre": nombre_limpio,
-                "nombre_norm": nombre_norm,
-                "forma_juridica": forma_juridica,
-            })
+    columnas = ("idPersona", "beneficiario")
+    df = pd.read_csv(
+        archivo_csv,
+        usecols=lambda c: c in columnas,
+        dtype=str,
+        keep_default_na=False,
+        encoding="utf-8",
+    )
+    if not all(c in df.columns for c in columnas):
+        return
+
+    df = df[(df["idPersona"] != "") & (df["beneficiario"].str.strip() != "")]
+    df = df.drop_duplicates(subset=list(columnas))
+
+    for id_persona, beneficiario_raw in zip(df["idPersona"].to_numpy(), df["beneficiario"].to_numpy()):
+        nif, nombre = extraer_nif_y_nombre(beneficiario_raw)
+        nombre_limpio = limpiar_nombre(nombre)
+
+        if not nombre_limpio:
+            continue
+
+        nombre_norm = normalizar(nombre_limpio)
+        forma_juridica = deducir_forma_juridica(nif)
+
+        beneficiarios[id_persona].append({
+            "nif": nif,
+            "nombre_original": nombre,
+            "nombre": nombre_limpio,
+            "nombre_norm": nombre_norm,
+            "forma_juridica": forma_juridica,
+        })
 
 
 def consolidar_beneficiarios(beneficiarios: dict) -> tuple[list, list]:
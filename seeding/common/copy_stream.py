@@ -0,0 +1,42 @@
+"""
+Adaptador de iteradores a objeto fichero para alimentar COPY FROM STDIN.
+
+Lo comparten las cargas que generan las filas al vuelo, sin fichero
+intermedio (load_concesiones_from_json, transform_convocatorias_to_csv).
+"""
+import io
+from typing import AnyStr, Iterator
+
+
+class CopyStream(io.IOBase):
+    """
+    Adapta un iterador de fragmentos (texto o bytes) a objeto fichero para copy_expert.
+
+    Cada read() devuelve como mucho un fragmento (o su resto): copy_expert
+    admite lecturas cortas, y así no se concatenan ni recortan buffers que
+    crecen, sólo se avanza un desplazamiento sobre el fragmento actual.
+    Conviene que los fragmentos agrupen muchas filas: cada read() es un
+    mensaje CopyData al servidor.
+    """
+
+    def __init__(self, chunks: Iterator[AnyStr]):
+        self._chunks = chunks
+        self._chunk = None
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> AnyStr:
+        while self._chunk is None or self._pos >= len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return self._chunk[:0] if self._chunk is not None else b''
+            self._chunk, self._pos = chunk, 0
+
+        if size < 0:
+            data = self._chunk[self._pos:] + self._chunk[:0].join(self._chunks)
+        else:
+            data = self._chunk[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
@@ -9,22 +9,36 @@ Carga concesiones de diferentes fuentes:
 - Grandes Beneficiarios
 
 Usa deduplicación automática con ON CONFLICT DO NOTHING.
+
+Beneficiarios y convocatorias se resuelven en bloque antes de cargar
+las concesiones (una consulta por entidad, no una por registro). Las
+concesiones se envían con COPY a la tabla de staging de load_from_csv,
+sin CSV intermedio.
 """
 
-import json
+import mmap
+import multiprocessing
 import sys
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from datetime import datetime
-from uuid import uuid4
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from datetime import date, datetime
+from functools import lru_cache
 
 # Añadir rutas al path
 PROJECT_ROOT = Path(__file__).parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from sqlalchemy.dialects.postgresql import insert as pg_insert
-from bdns_core.db.session import get_session
-from bdns_core.db.models import Concesion, Beneficiario, Convocatoria
+# Añadir seeding/common/ al path para reutilizar load_from_csv y copy_stream
+common_path = Path(__file__).resolve().parent
+if str(common_path) not in sys.path:
+    sys.path.insert(0, str(common_path))
+
+import ijson
+import orjson
+from sqlalchemy import text
+from copy_stream import CopyStream
+from load_from_csv import bulk_load_session, copy_concesiones_from, sql_normalizar
 
 
 def extract_nif(beneficiario_str: str) -> Optional[str]:
@@ -35,70 +49,277 @@ def extract_nif(beneficiario_str: str) -> Optional[str]:
     return parts[0].strip() if parts else None
 
 
-def get_or_create_beneficiario(session, beneficiario_str: str) -> Optional[str]:
-    """Obtiene o crea un beneficiario. Retorna su UUID."""
-    try:
-        nif = extract_nif(beneficiario_str)
-        if not nif or len(nif) < 5:
-            return None
+class _LRUCache:
+    """Dict acotado con expulsión LRU (claves naturales → UUID ya resueltos)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+
+    def split(self, keys: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Separa keys en (aciertos {clave: uuid}, pendientes {clave: valor})."""
+        hits: Dict[str, str] = {}
+        misses: Dict[str, str] = {}
+        for key, value in keys.items():
+            cached = self._data.get(key)
+            if cached is None:
+                misses[key] = value
+            else:
+                self._data.move_to_end(key)
+                hits[key] = cached
+        return hits, misses
 
-        # Buscar existente con SQL directo para evitar problemas de modelo
-        from sqlalchemy import text
+    def update(self, items: Dict[str, str]):
+        for key, value in items.items():
+            self._data[key] = value
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+# Caché de proceso: en cargas de varios ficheros (main con varios --json) los
+# mismos NIFs y convocatorias se repiten y no necesitan volver a la BD.
+# Solo se alimenta tras un commit correcto.
+_BENEFICIARIO_CACHE = _LRUCache(maxsize=500_000)
+_CONVOCATORIA_CACHE = _LRUCache(maxsize=100_000)
+
+
+def _bulk_resolve_beneficiarios(session, nifs_with_names: Dict[str, str]) -> Tuple[Dict[str, str], int]:
+    """
+    Resuelve en bloque los UUIDs de beneficiarios.
+
+    Inserta los NIFs que no existen con un único INSERT ... ON CONFLICT DO
+    NOTHING y recupera los ya existentes con un único SELECT.
+
+    Returns:
+        ({nif: uuid}, beneficiarios_nuevos)
+    """
+    if not nifs_with_names:
+        return {}, 0
+
+    # Orden estable de claves: evita interbloqueos entre cargas en paralelo
+    nifs = sorted(nifs_with_names)
+    result = session.execute(
+        text(f"""
+            INSERT INTO bdns.beneficiario (id, nif, nombre, nombre_norm, created_by, created_at)
+            SELECT uuid_generate_v7(), t.nif, t.nombre, {sql_normalizar('t.nombre')}, 'etl_load', NOW()
+            FROM unnest(
+                CAST(:nifs AS varchar[]), CAST(:nombres AS varchar[])
+            ) AS t(nif, nombre)
+            ON CONFLICT DO NOTHING
+            RETURNING id, nif
+        """),
+        {
+            "nifs": nifs,
+            "nombres": [nifs_with_names[nif] for nif in nifs],
+        }
+    )
+    resolved = {nif: str(id_) for id_, nif in result}
+    nuevos = len(resolved)
+
+    pendientes = [nif for nif in nifs if nif not in resolved]
+    if pendientes:
         result = session.execute(
-            text("SELECT id FROM bdns.beneficiario WHERE nif = :nif"),
-            {"nif": nif}
-        ).first()
-
-        if result:
-            return str(result[0])
-
-        # Crear nuevo con SQL directo
-        nombre = beneficiario_str.split(maxsplit=1)[1] if ' ' in beneficiario_str else beneficiario_str
-        new_id = uuid4()
-        session.execute(
-            text("INSERT INTO bdns.beneficiario (id, nif, nombre, created_by, created_at) VALUES (:id, :nif, :nombre, :created_by, NOW())"),
-            {"id": new_id, "nif": nif, "nombre": nombre[:500] if nombre else None, "created_by": "etl_load"}
+            text("SELECT id, nif FROM bdns.beneficiario WHERE nif = ANY(:nifs)"),
+            {"nifs": pendientes}
         )
-        session.flush()
-        return str(new_id)
+        resolved.update((nif, str(id_)) for id_, nif in result)
 
-    except Exception as e:
-        session.rollback()
-        print(f"  ⚠️  Error con beneficiario {beneficiario_str[:30]}: {e}")
-        return None
+    return resolved, nuevos
 
 
-def get_or_create_convocatoria(session, id_convocatoria: Any, titulo: str = None) -> Optional[str]:
-    """Obtiene o crea una convocatoria. Retorna su UUID."""
-    try:
-        if not id_convocatoria:
-            return None
-
-        id_bdns = str(id_convocatoria)
+def _bulk_resolve_convocatorias(session, ids_with_titles: Dict[str, str]) -> Tuple[Dict[str, str], int]:
+    """
+    Resuelve en bloque los UUIDs de convocatorias por id_bdns.
 
-        # Buscar existente con SQL directo
-        from sqlalchemy import text
+    Returns:
+        ({id_bdns: uuid}, convocatorias_nuevas)
+    """
+    if not ids_with_titles:
+        return {}, 0
+
+    ids_bdns = sorted(ids_with_titles)
+    result = session.execute(
+        text("""
+            INSERT INTO bdns.convocatoria (id, id_bdns, titulo, created_by, created_at)
+            SELECT uuid_generate_v7(), t.id_bdns, t.titulo, 'etl_load', NOW()
+            FROM unnest(
+                CAST(:ids_bdns AS varchar[]), CAST(:titulos AS varchar[])
+            ) AS t(id_bdns, titulo)
+            ON CONFLICT DO NOTHING
+            RETURNING id, id_bdns
+        """),
+        {
+            "ids_bdns": ids_bdns,
+            "titulos": [ids_with_titles[id_bdns] for id_bdns in ids_bdns],
+        }
+    )
+    resolved = {id_bdns: str(id_) for id_, id_bdns in result}
+    nuevas = len(resolved)
+
+    pendientes = [id_bdns for id_bdns in ids_bdns if id_bdns not in resolved]
+    if pendientes:
         result = session.execute(
-            text("SELECT id FROM bdns.convocatoria WHERE id_bdns = :id_bdns"),
-            {"id_bdns": id_bdns}
-        ).first()
-
-        if result:
-            return str(result[0])
-
-        # Crear nueva con SQL directo
-        new_id = uuid4()
-        session.execute(
-            text("INSERT INTO bdns.convocatoria (id, id_bdns, titulo, created_by, created_at) VALUES (:id, :id_bdns, :titulo, :created_by, NOW())"),
-            {"id": new_id, "id_bdns": id_bdns, "titulo": (titulo or f"Conv {id_bdns}")[:500], "created_by": "etl_load"}
+            text("SELECT id, id_bdns FROM bdns.convocatoria WHERE id_bdns = ANY(:ids_bdns)"),
+            {"ids_bdns": pendientes}
         )
-        session.flush()
-        return str(new_id)
+        resolved.update((id_bdns, str(id_)) for id_, id_bdns in result)
 
-    except Exception as e:
-        session.rollback()
-        print(f"  ⚠️  Error con convocatoria {id_convocatoria}: {e}")
-        return None
+    return resolved, nuevas
+
+
+# Por debajo de este tamaño el JSON se decodifica entero con orjson
+# (más rápido); por encima se usa ijson en streaming (memoria acotada).
+STREAM_THRESHOLD_BYTES = 64 * 1024 * 1024
+
+# Frecuencia del progreso por stdout (registros); fuera del camino caliente
+PROGRESS_EVERY = 10_000
+
+
+def _iter_records(json_path: Path) -> Iterator[Dict]:
+    """Itera los registros del array JSON."""
+    with open(json_path, 'rb') as f:
+        size = json_path.stat().st_size
+        if size == 0:
+            return
+        if size > STREAM_THRESHOLD_BYTES:
+            yield from ijson.items(f, 'item', use_float=True)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            records = orjson.loads(view)
+        yield from records
+
+
+def _collect_entities(records: Iterable[Dict]) -> Tuple[Dict[str, str], Dict[str, str], int]:
+    """
+    Primera pasada: recopila beneficiarios y convocatorias únicos.
+
+    Returns:
+        ({nif: nombre}, {id_bdns: titulo}, total_registros)
+    """
+    beneficiarios: Dict[str, str] = {}
+    convocatorias: Dict[str, str] = {}
+    total = 0
+
+    for rec in records:
+        total += 1
+        beneficiario_str = rec.get('beneficiario') or ''
+        nif = extract_nif(beneficiario_str)
+        if nif and len(nif) >= 5 and nif not in beneficiarios:
+            nombre = beneficiario_str.split(maxsplit=1)[1] if ' ' in beneficiario_str.strip() else beneficiario_str
+            beneficiarios[nif] = nombre[:500] if nombre else None
+
+        id_conv = rec.get('idConvocatoria') or rec.get('numeroConvocatoria')
+        if id_conv:
+            id_bdns = str(id_conv)
+            if id_bdns not in convocatorias:
+                convocatorias[id_bdns] = (rec.get('convocatoria') or f"Conv {id_bdns}")[:500]
+
+    return beneficiarios, convocatorias, total
+
+
+@lru_cache(maxsize=4096)
+def _parse_iso_date(fecha_str: str) -> date:
+    """Parsea 'YYYY-MM-DD' por slicing (sin strptime). Cacheado: las fechas se repiten mucho."""
+    return date(int(fecha_str[:4]), int(fecha_str[5:7]), int(fecha_str[8:10]))
+
+
+def _copy_text(value) -> str:
+    """Formatea un texto como campo CSV de COPY (siempre entrecomillado)."""
+    if value is None:
+        return '\\N'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _copy_float(value) -> str:
+    """Formatea un importe como campo de COPY o NULL."""
+    return repr(float(value)) if value else '\\N'
+
+
+def _iter_concesion_lines(
+    records: Iterable[Dict],
+    total: int,
+    regimen_tipo: str,
+    benef_ids: Dict[str, str],
+    conv_ids: Dict[str, str],
+    stats: Dict[str, int],
+    batch_size: int
+) -> Iterator[str]:
+    """
+    Segunda pasada: genera las filas de temp_concesiones en formato COPY.
+
+    Emite bloques de batch_size líneas y actualiza stats sobre la marcha.
+    """
+    created_at = datetime.now().isoformat()
+    regimen = _copy_text(regimen_tipo)
+    created_by = _copy_text('etl_load')
+
+    # Buffer de tamaño fijo reutilizado entre bloques; i = filas ocupadas
+    batch = [None] * batch_size
+    i = 0
+
+    for idx, rec in enumerate(records, 1):
+        try:
+            # Progreso
+            if idx % PROGRESS_EVERY == 0:
+                print(f"   {idx:,} / {total:,} ...")
+
+            # Beneficiario
+            beneficiario_id = benef_ids.get(extract_nif(rec.get('beneficiario') or ''))
+            if not beneficiario_id:
+                stats['errores'] += 1
+                continue
+
+            # Convocatoria
+            id_conv = rec.get('idConvocatoria') or rec.get('numeroConvocatoria')
+            convocatoria_id = conv_ids.get(str(id_conv)) if id_conv else None
+            if not convocatoria_id:
+                stats['errores'] += 1
+                continue
+
+            # Preparar concesión
+            id_concesion = (rec.get('codConcesion') or
+                           rec.get('codigoConcesion') or
+                           str(rec.get('id', '')))
+
+            fecha_str = rec.get('fechaConcesion')
+            if not fecha_str:
+                stats['errores'] += 1
+                continue
+
+            fecha = _parse_iso_date(fecha_str)
+
+            importe_eq = rec.get('ayudaEquivalente') or rec.get('ayudaETotal')
+            importe_nom = rec.get('importe')
+
+            # Orden de columnas de temp_concesiones (el id lo genera la BD)
+            batch[i] = '|'.join((
+                _copy_text(id_concesion),
+                beneficiario_id,
+                convocatoria_id,
+                fecha.isoformat(),
+                regimen,
+                _copy_float(importe_nom),
+                _copy_float(importe_eq),
+                created_by,
+                created_at
+            ))
+            i += 1
+            stats['procesados'] += 1
+
+            if i == batch_size:
+                yield '\n'.join(batch) + '\n'
+                i = 0
+
+        except Exception as e:
+            print(f"   ⚠️  Error en registro {idx}: {e}")
+            stats['errores'] += 1
+            continue
+
+    # Batch final
+    if i:
+        yield '\n'.join(batch[:i]) + '\n'
 
 
 def load_json_to_concesiones(
@@ -112,7 +333,7 @@ def load_json_to_concesiones(
     Args:
         json_path: Ruta al JSON
         regimen_tipo: Tipo de régimen (minimis, ayuda_estado, etc.)
-        batch_size: Registros por batch
+        batch_size: Registros por bloque enviado al COPY
 
     Returns:
         Estadísticas de la carga
@@ -120,13 +341,6 @@ def load_json_to_concesiones(
     print(f"\n📥 Cargando {json_path.name}")
     print(f"   Régimen: {regimen_tipo}")
 
-    # Leer JSON
-    with open(json_path, 'r', encoding='utf-8') as f:
-        records = json.load(f)
-
-    total = len(records)
-    print(f"   Registros en JSON: {total:,}")
-
     stats = {
         'procesados': 0,
         'beneficiarios_nuevos': 0,
@@ -136,83 +350,41 @@ def load_json_to_concesiones(
         'errores': 0
     }
 
-    with get_session() as session:
-        batch = []
-
-        for idx, rec in enumerate(records, 1):
-            try:
-                # Progreso
-                if idx % 100 == 0:
-                    print(f"   {idx:,} / {total:,} ...")
-
-                # Beneficiario
-                beneficiario_str = rec.get('beneficiario', '')
-                beneficiario_id = get_or_create_beneficiario(session, beneficiario_str)
-                if not beneficiario_id:
-                    stats['errores'] += 1
-                    continue
-
-                # Convocatoria
-                id_conv = rec.get('idConvocatoria') or rec.get('numeroConvocatoria')
-                titulo_conv = rec.get('convocatoria')
-                convocatoria_id = get_or_create_convocatoria(session, id_conv, titulo_conv)
-                if not convocatoria_id:
-                    stats['errores'] += 1
-                    continue
-
-                # Preparar concesión
-                id_concesion = (rec.get('codConcesion') or
-                               rec.get('codigoConcesion') or
-                               str(rec.get('id', '')))
-
-                fecha_str = rec.get('fechaConcesion')
-                if not fecha_str:
-                    stats['errores'] += 1
-                    continue
-
-                fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
-
-                importe_eq = rec.get('ayudaEquivalente') or rec.get('ayudaETotal')
-                importe_nom = rec.get('importe')
-
-                concesion = {
-                    'id': uuid4(),
-                    'id_concesion': id_concesion,
-                    'fecha_concesion': fecha,
-                    'regimen_tipo': regimen_tipo,
-                    'beneficiario_id': beneficiario_id,
-                    'convocatoria_id': convocatoria_id,
-                    'importe_equivalente': float(importe_eq) if importe_eq else None,
-                    'importe_nominal': float(importe_nom) if importe_nom else None,
-                    'created_by': 'etl_load'
-                }
-
-                batch.append(concesion)
-                stats['procesados'] += 1
-
-                # Insertar batch
-                if len(batch) >= batch_size:
-                    inserted, duplicated = _insert_batch(session, batch)
-                    stats['concesiones_insertadas'] += inserted
-                    stats['duplicados'] += duplicated
-                    batch = []
-
-            except Exception as e:
-                print(f"   ⚠️  Error en registro {idx}: {e}")
-                stats['errores'] += 1
-                continue
-
-        # Batch final
-        if batch:
-            inserted, duplicated = _insert_batch(session, batch)
-            stats['concesiones_insertadas'] += inserted
-            stats['duplicados'] += duplicated
+    # Primera pasada (streaming): entidades únicas
+    beneficiarios, convocatorias, total = _collect_entities(_iter_records(json_path))
+    print(f"   Registros en JSON: {total:,}")
+    print(f"   Beneficiarios únicos: {len(beneficiarios):,}")
+    print(f"   Convocatorias únicas: {len(convocatorias):,}")
+
+    with bulk_load_session() as session:
+        # Resolución en bloque de claves foráneas
+        # (solo las que no están ya en la caché de proceso)
+        benef_ids, benef_pendientes = _BENEFICIARIO_CACHE.split(beneficiarios)
+        conv_ids, conv_pendientes = _CONVOCATORIA_CACHE.split(convocatorias)
+
+        benef_resueltos, stats['beneficiarios_nuevos'] = _bulk_resolve_beneficiarios(session, benef_pendientes)
+        conv_resueltas, stats['convocatorias_nuevas'] = _bulk_resolve_convocatorias(session, conv_pendientes)
+        benef_ids.update(benef_resueltos)
+        conv_ids.update(conv_resueltas)
+
+        # Segunda pasada (streaming): concesiones vía COPY
+        lines = _iter_concesion_lines(
+            _iter_records(json_path), total, regimen_tipo,
+            benef_ids, conv_ids, stats, batch_size
+        )
+        inserted, duplicated = copy_concesiones_from(session, CopyStream(lines))
+        stats['concesiones_insertadas'] += inserted
+        stats['duplicados'] += duplicated
 
-        session.commit()
+    # Commit hecho: los ids resueltos ya son válidos para siguientes cargas
+    _BENEFICIARIO_CACHE.update(benef_resueltos)
+    _CONVOCATORIA_CACHE.update(conv_resueltas)
 
     # Resumen
     print(f"\n✅ Carga completada:")
     print(f"   Procesados: {stats['procesados']:,}")
+    print(f"   Beneficiarios nuevos: {stats['beneficiarios_nuevos']:,}")
+    print(f"   Convocatorias nuevas: {stats['convocatorias_nuevas']:,}")
     print(f"   Insertadas: {stats['concesiones_insertadas']:,}")
     print(f"   Duplicadas: {stats['duplicados']:,}")
     print(f"   Errores: {stats['errores']:,}")
@@ -220,36 +392,50 @@ def load_json_to_concesiones(
     return stats
 
 
-def _insert_batch(session, batch: List[Dict]) -> tuple[int, int]:
-    """Inserta batch con ON CONFLICT DO NOTHING."""
-    stmt = pg_insert(Concesion).values(batch)
-    stmt = stmt.on_conflict_do_nothing(constraint='uq_concesion_id_fecha')
-
-    result = session.execute(stmt)
-    inserted = result.rowcount or 0
-    duplicated = len(batch) - inserted
-
-    return inserted, duplicated
-
-
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--json', required=True, help='Archivo JSON')
-    parser.add_argument('--regimen', required=True,
-                       choices=['minimis', 'ayuda_estado', 'partidos_politicos', 'grandes_beneficiarios'])
+    # Varios ficheros en una sola invocación reutilizan el engine y el pool de
+    # conexiones de bdns_core (creado una vez por proceso), en lugar de pagar
+    # arranque + conexión por cada fichero.
+    parser.add_argument('--json', required=True, nargs='+', help='Archivo(s) JSON')
+    parser.add_argument('--regimen', required=True, nargs='+',
+                       choices=['minimis', 'ayuda_estado', 'partidos_politicos', 'grandes_beneficiarios'],
+                       help='Un régimen para todos los ficheros, o uno por fichero')
     parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--parallel', type=int, nargs='?', const=4, default=1, metavar='N',
+                        help='Cargar los ficheros en N procesos (por defecto 4 con --parallel)')
 
     args = parser.parse_args()
 
-    json_path = Path(args.json)
-    if not json_path.exists():
-        print(f"❌ No existe: {json_path}")
-        sys.exit(1)
-
-    stats = load_json_to_concesiones(json_path, args.regimen, args.batch_size)
-    sys.exit(0 if stats['errores'] == 0 else 1)
+    if len(args.regimen) == 1:
+        regimenes = args.regimen * len(args.json)
+    elif len(args.regimen) == len(args.json):
+        regimenes = args.regimen
+    else:
+        parser.error("--regimen debe tener un valor o uno por cada --json")
+
+    json_paths = [Path(p) for p in args.json]
+    for json_path in json_paths:
+        if not json_path.exists():
+            print(f"❌ No existe: {json_path}")
+            sys.exit(1)
+
+    jobs = [(json_path, regimen, args.batch_size) for json_path, regimen in zip(json_paths, regimenes)]
+    workers = min(args.parallel, len(jobs))
+
+    if workers > 1:
+        # El padre no abre conexiones antes del fork: cada proceso abre las
+        # suyas desde su copia del pool
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = pool.starmap(load_json_to_concesiones, jobs)
+    else:
+        results = [load_json_to_concesiones(*job) for job in jobs]
+
+    errores = sum(stats['errores'] for stats in results)
+
+    sys.exit(0 if errores == 0 else 1)
 
 
 if __name__ == '__main__':
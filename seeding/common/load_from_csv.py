@@ -5,17 +5,21 @@ Carga CSVs a PostgreSQL usando COPY para máximo rendimiento.
 Usa COPY FROM para inserción masiva ~100x más rápida que INSERT.
 
 Maneja:
-- Deduplicación automática con ON CONFLICT DO NOTHING
-- Creación de tabla temporal para staging
+- Deduplicación con anti-join NOT EXISTS (+ ON CONFLICT DO NOTHING como red)
+- Creación de tabla temporal para staging (las TEMP ya no generan WAL)
 - Bulk upsert desde staging a tabla final
+- Ajustes de sesión para carga masiva (synchronous_commit, work_mem...)
 
 Uso:
-    python load_from_csv.py /path/to/csv_dir/
+    python load_from_csv.py /path/to/csv_dir/ [/otro/csv_dir/ ...] [--rebuild-indexes] [--format csv|binary]
 """
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
+from uuid import uuid4
 
 PROJECT_ROOT = Path(__file__).parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -29,6 +33,63 @@ def log(msg: str):
     print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
 
 
+# Tamaño de lectura para COPY: ficheros abiertos en binario (sin decodificar
+# a str en Python) y copy_expert leyendo bloques de 1 MiB en vez de 8 KiB.
+COPY_BUFFER_SIZE = 1 << 20
+
+# Ajustes de sesión para carga masiva. Se aplican con SET (no SET LOCAL)
+# porque cada copy_* hace su propio commit, y se restauran al terminar para
+# no contaminar la conexión devuelta al pool.
+BULK_LOAD_SETTINGS = {
+    'synchronous_commit': 'off',
+    'maintenance_work_mem': '1GB',
+    'work_mem': '256MB',
+}
+
+# Tablas de staging de concesiones (copy_concesiones_to_staging): esquema
+# propio, fuera de bdns, y prefijo fijo para poder limpiar las huérfanas
+STAGING_SCHEMA = 'bdns_staging'
+STAGING_TABLE_PREFIX = 'staging_concesiones_'
+
+
+@contextmanager
+def bulk_load_session():
+    """
+    Sesión propia (conexión independiente del pool) con BULK_LOAD_SETTINGS.
+
+    Los ajustes se restauran al salir, aunque la carga falle.
+    """
+    with get_session() as session:
+        for name, value in BULK_LOAD_SETTINGS.items():
+            session.execute(text(f"SET {name} = '{value}'"))
+        try:
+            yield session
+        finally:
+            session.rollback()
+            for name in BULK_LOAD_SETTINGS:
+                session.execute(text(f"RESET {name}"))
+            session.commit()
+
+
+def _copy_in_own_session(copy_fn, csv_path: Path, *args) -> Tuple:
+    """Ejecuta un copy_* en su propia sesión de carga masiva."""
+    with bulk_load_session() as session:
+        return copy_fn(session, csv_path, *args)
+
+
+def sql_normalizar(expr: str) -> str:
+    """
+    Expresión SQL de normalización para búsqueda: minúsculas, sin acentos,
+    solo [a-z0-9] y espacios simples. Requiere la extensión unaccent
+    (init_db.sql).
+    """
+    return (
+        "NULLIF(btrim(regexp_replace(regexp_replace("
+        f"lower(unaccent({expr})), '[^a-z0-9\\s]', ' ', 'g'), "
+        "'\\s+', ' ', 'g')), '')"
+    )
+
+
 def copy_beneficiarios(session, csv_path: Path) -> Tuple[int, int]:
     """
     Carga beneficiarios desde CSV usando COPY.
@@ -41,10 +102,8 @@ def copy_beneficiarios(session, csv_path: Path) -> Tuple[int, int]:
     # 1. Crear tabla temporal
     session.execute(text("""
         CREATE TEMP TABLE IF NOT EXISTS temp_beneficiarios (
-            id UUID,
             nif VARCHAR,
             nombre VARCHAR,
-            nombre_norm VARCHAR,
             created_by VARCHAR,
             created_at TIMESTAMP
         ) ON COMMIT DROP;
@@ -56,13 +115,13 @@ def copy_beneficiarios(session, csv_path: Path) -> Tuple[int, int]:
     raw_conn = connection.connection  # psycopg2 connection
     cursor = raw_conn.cursor()
 
-    with open(csv_path, 'r', encoding='utf-8') as f:
+    with open(csv_path, 'rb', buffering=COPY_BUFFER_SIZE) as f:
         # Saltar header
         next(f)
         # COPY desde archivo
         cursor.copy_expert(
             """
-            COPY temp_beneficiarios (id, nif, nombre, nombre_norm, created_by, created_at)
+            COPY temp_beneficiarios (nif, nombre, created_by, created_at)
             FROM STDIN WITH (
                 FORMAT CSV,
                 DELIMITER '|',
@@ -71,17 +130,23 @@ def copy_beneficiarios(session, csv_path: Path) -> Tuple[int, int]:
                 ESCAPE '\\'
             )
             """,
-            f
+            f,
+            size=COPY_BUFFER_SIZE
         )
 
     rows_copied = cursor.rowcount
     log(f"  ✓ COPY: {rows_copied} filas copiadas a temp")
 
-    # 3. Upsert a tabla final con ON CONFLICT
-    result = session.execute(text("""
+    # 3. Upsert a tabla final: anti-join (hash) descarta los existentes en
+    # bloque; ON CONFLICT queda como red para cargas concurrentes.
+    # id y nombre_norm se calculan aquí (no viajan en el CSV)
+    result = session.execute(text(f"""
         INSERT INTO bdns.beneficiario (id, nif, nombre, nombre_norm, created_by, created_at)
-        SELECT id, nif, nombre, nombre_norm, created_by, created_at::timestamp
-        FROM temp_beneficiarios
+        SELECT uuid_generate_v7(), t.nif, t.nombre, {sql_normalizar('t.nombre')}, t.created_by, t.created_at::timestamp
+        FROM temp_beneficiarios t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM bdns.beneficiario b WHERE b.nif = t.nif
+        )
         ON CONFLICT (nif) DO NOTHING;
     """))
 
@@ -106,7 +171,6 @@ def copy_convocatorias(session, csv_path: Path) -> Tuple[int, int]:
     # 1. Crear tabla temporal
     session.execute(text("""
         CREATE TEMP TABLE IF NOT EXISTS temp_convocatorias (
-            id UUID,
             id_bdns VARCHAR,
             codigo_bdns VARCHAR,
             titulo VARCHAR,
@@ -120,11 +184,11 @@ def copy_convocatorias(session, csv_path: Path) -> Tuple[int, int]:
     raw_conn = connection.connection
     cursor = raw_conn.cursor()
 
-    with open(csv_path, 'r', encoding='utf-8') as f:
+    with open(csv_path, 'rb', buffering=COPY_BUFFER_SIZE) as f:
         next(f)  # Saltar header
         cursor.copy_expert(
             """
-            COPY temp_convocatorias (id, id_bdns, codigo_bdns, titulo, created_by, created_at)
+            COPY temp_convocatorias (id_bdns, codigo_bdns, titulo, created_by, created_at)
             FROM STDIN WITH (
                 FORMAT CSV,
                 DELIMITER '|',
@@ -133,18 +197,22 @@ def copy_convocatorias(session, csv_path: Path) -> Tuple[int, int]:
                 ESCAPE '\\'
             )
             """,
-            f
+            f,
+            size=COPY_BUFFER_SIZE
         )
 
     rows_copied = cursor.rowcount
     log(f"  ✓ COPY: {rows_copied} filas copiadas a temp")
 
     # 3. Upsert a tabla final
-    # codigoBDNS es el identificador natural único
+    # codigoBDNS es el identificador natural único; el id se genera aquí
     result = session.execute(text("""
         INSERT INTO bdns.convocatoria (id, id_bdns, codigo_bdns, titulo, created_by, created_at)
-        SELECT id, id_bdns, codigo_bdns, titulo, created_by, created_at::timestamp
-        FROM temp_convocatorias
+        SELECT uuid_generate_v7(), t.id_bdns, t.codigo_bdns, t.titulo, t.created_by, t.created_at::timestamp
+        FROM temp_convocatorias t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM bdns.convocatoria c WHERE c.codigo_bdns = t.codigo_bdns
+        )
         ON CONFLICT (codigo_bdns) DO NOTHING;
     """))
 
@@ -157,98 +225,341 @@ def copy_convocatorias(session, csv_path: Path) -> Tuple[int, int]:
     return insertados, duplicados
 
 
-def copy_concesiones(session, csv_path: Path) -> Tuple[int, int]:
+# Columnas de staging de concesiones. Dos formatos, mismo orden:
+# - ficheros (concesiones.csv/.bin del transform): FKs por clave natural
+#   (nif, codigo_bdns), resueltas a UUID con un JOIN en el upsert
+# - streams (load_concesiones_from_json): FKs ya resueltas a UUID
+_CONCESIONES_STAGING_DDL = """
+    id_concesion VARCHAR,
+    {fk_ddl},
+    fecha_concesion DATE,
+    regimen_tipo VARCHAR,
+    importe_nominal FLOAT,
+    importe_equivalente FLOAT,
+    created_by VARCHAR,
+    created_at TIMESTAMP
+"""
+_FK_NATURAL_DDL = "beneficiario_nif VARCHAR, convocatoria_id_bdns VARCHAR"
+_FK_UUID_DDL = "beneficiario_id UUID, convocatoria_id UUID"
+
+
+def _concesiones_staging_ddl(natural_keys: bool) -> str:
+    return _CONCESIONES_STAGING_DDL.format(
+        fk_ddl=_FK_NATURAL_DDL if natural_keys else _FK_UUID_DDL
+    )
+
+
+# Ficheros de concesiones por formato (--format del transform y de la carga)
+CONCESIONES_FORMATS = {'csv': 'concesiones.csv', 'binary': 'concesiones.bin'}
+
+
+@contextmanager
+def _open_concesiones_source(conc_path: Path, binary: bool):
     """
-    Carga concesiones desde CSV usando COPY.
+    Abre concesiones.csv, o concesiones.bin (COPY BINARY) si binary.
 
-    Returns:
-        (insertados, duplicados)
+    Yields:
+        fichero listo para COPY
     """
-    log(f"Cargando concesiones desde {csv_path.name}...")
+    if binary:
+        log(f"Cargando concesiones desde {conc_path.name} (binario)...")
+        with open(conc_path, 'rb', buffering=COPY_BUFFER_SIZE) as f:
+            yield f
+        return
+
+    log(f"Cargando concesiones desde {conc_path.name}...")
+    with open(conc_path, 'rb', buffering=COPY_BUFFER_SIZE) as f:
+        next(f)  # Saltar header
+        yield f
 
-    # 1. Crear tabla temporal
-    session.execute(text("""
-        CREATE TEMP TABLE IF NOT EXISTS temp_concesiones (
-            id UUID,
-            id_concesion VARCHAR,
-            beneficiario_id UUID,
-            convocatoria_id UUID,
-            fecha_concesion DATE,
-            regimen_tipo VARCHAR,
-            importe_nominal FLOAT,
-            importe_equivalente FLOAT,
-            created_by VARCHAR,
-            created_at TIMESTAMP
-        ) ON COMMIT DROP;
-    """))
 
-    # 2. COPY a tabla temporal
+def _copy_concesiones_into(session, table: str, source, binary: bool,
+                           natural_keys: bool) -> int:
+    """COPY de concesiones a una tabla de staging. Retorna filas copiadas."""
     connection = session.connection()
     raw_conn = connection.connection
     cursor = raw_conn.cursor()
 
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        next(f)  # Saltar header
-        cursor.copy_expert(
-            """
-            COPY temp_concesiones (
-                id, id_concesion, beneficiario_id, convocatoria_id,
-                fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
-                created_by, created_at
-            )
-            FROM STDIN WITH (
-                FORMAT CSV,
-                DELIMITER '|',
-                NULL '\\N',
-                QUOTE '"',
-                ESCAPE '\\'
-            )
-            """,
-            f
+    if binary:
+        copy_options = "FORMAT BINARY"
+    else:
+        copy_options = """
+            FORMAT CSV,
+            DELIMITER '|',
+            NULL '\\N',
+            QUOTE '"',
+            ESCAPE '\\'
+        """
+
+    fk_cols = "beneficiario_nif, convocatoria_id_bdns" if natural_keys else "beneficiario_id, convocatoria_id"
+    cursor.copy_expert(
+        f"""
+        COPY {table} (
+            id_concesion, {fk_cols},
+            fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
+            created_by, created_at
         )
+        FROM STDIN WITH ({copy_options})
+        """,
+        source,
+        size=COPY_BUFFER_SIZE
+    )
 
     rows_copied = cursor.rowcount
-    log(f"  ✓ COPY: {rows_copied} filas copiadas a temp")
+    log(f"  ✓ COPY: {rows_copied} filas copiadas a {table}")
+    return rows_copied
+
+
+def _upsert_concesiones(session, table: str, rows_copied: int,
+                        natural_keys: bool) -> Tuple[int, int]:
+    """
+    Upsert de una tabla de staging a bdns.concesion (sin commit).
+
+    Con natural_keys las FKs se resuelven por nif / codigo_bdns contra
+    beneficiarios y convocatorias ya cargados (la columna
+    convocatoria_id_bdns del transform lleva el codigoBDNS, que es la clave
+    por la que se deduplican las convocatorias). Las filas sin
+    correspondencia no se insertan y se cuentan aparte, no como duplicados.
+
+    Returns:
+        (insertados, duplicados)
+    """
+    if natural_keys:
+        fk_select = "b.id AS beneficiario_id, cv.id AS convocatoria_id"
+        fk_join = """
+            LEFT JOIN bdns.beneficiario b ON b.nif = t.beneficiario_nif
+            LEFT JOIN bdns.convocatoria cv ON cv.codigo_bdns = t.convocatoria_id_bdns"""
+    else:
+        fk_select = "t.beneficiario_id, t.convocatoria_id"
+        fk_join = ""
 
-    # 3. Upsert a tabla final particionada
     # UNIQUE constraint: (id_concesion, fecha_concesion, regimen_tipo)
-    result = session.execute(text("""
-        INSERT INTO bdns.concesion (
-            id, id_concesion, beneficiario_id, convocatoria_id,
-            fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
-            created_by, created_at
+    # Ordenado por clave de partición: cada partición recibe sus filas de
+    # forma contigua y las hojas de los índices por fecha crecen en orden
+    result = session.execute(text(f"""
+        WITH src AS (
+            SELECT t.id_concesion, {fk_select},
+                   t.fecha_concesion, t.regimen_tipo, t.importe_nominal, t.importe_equivalente,
+                   t.created_by, t.created_at
+            FROM {table} t{fk_join}
+        ),
+        ins AS (
+            INSERT INTO bdns.concesion (
+                id, id_concesion, beneficiario_id, convocatoria_id,
+                fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
+                created_by, created_at
+            )
+            SELECT
+                uuid_generate_v7(), s.id_concesion, s.beneficiario_id, s.convocatoria_id,
+                s.fecha_concesion, s.regimen_tipo, s.importe_nominal, s.importe_equivalente,
+                s.created_by, s.created_at::timestamp
+            FROM src s
+            WHERE s.beneficiario_id IS NOT NULL
+              AND s.convocatoria_id IS NOT NULL
+              AND NOT EXISTS (
+                SELECT 1 FROM bdns.concesion c
+                WHERE c.id_concesion = s.id_concesion
+                  AND c.fecha_concesion = s.fecha_concesion
+                  AND c.regimen_tipo = s.regimen_tipo
+              )
+            ORDER BY s.regimen_tipo, s.fecha_concesion
+            ON CONFLICT (id_concesion, fecha_concesion, regimen_tipo) DO NOTHING
+            RETURNING 1
         )
         SELECT
-            id, id_concesion, beneficiario_id, convocatoria_id,
-            fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
-            created_by, created_at::timestamp
-        FROM temp_concesiones
-        ON CONFLICT (id_concesion, fecha_concesion, regimen_tipo) DO NOTHING;
+            (SELECT count(*) FROM ins),
+            (SELECT count(*) FROM src
+             WHERE beneficiario_id IS NULL OR convocatoria_id IS NULL)
     """))
 
-    insertados = result.rowcount
-    duplicados = rows_copied - insertados
+    insertados, sin_referencia = result.one()
+    duplicados = rows_copied - insertados - sin_referencia
+    log(f"  ✓ Insertados: {insertados}, Duplicados: {duplicados}")
+    if sin_referencia:
+        log(f"  ⚠️  Sin beneficiario/convocatoria: {sin_referencia} (no insertadas)")
+
+    return insertados, duplicados
+
+
+def copy_concesiones(session, csv_path: Path, binary: bool = False) -> Tuple[int, int]:
+    """
+    Carga concesiones desde CSV (o concesiones.bin si binary) usando COPY.
+
+    Returns:
+        (insertados, duplicados)
+    """
+    with _open_concesiones_source(csv_path, binary) as f:
+        return copy_concesiones_from(session, f, binary=binary, natural_keys=True)
+
+
+def copy_concesiones_from(session, source, binary: bool = False,
+                          natural_keys: bool = False) -> Tuple[int, int]:
+    """
+    Carga concesiones usando COPY desde cualquier objeto con read().
+
+    Permite alimentar el COPY desde un fichero o desde un stream generado
+    al vuelo (p.ej. load_concesiones_from_json), sin CSV intermedio.
+    El formato de las filas es el de concesiones.csv, sin header, o el de
+    concesiones.bin si binary=True; por defecto con las FKs ya resueltas a
+    UUID (beneficiario_id, convocatoria_id) y, con natural_keys=True, por
+    clave natural (beneficiario_nif, convocatoria_id_bdns) como en los
+    ficheros del transform. El id no viaja en las filas: se genera en la BD
+    con uuid_generate_v7() (ordenado en el tiempo).
+
+    Returns:
+        (insertados, duplicados)
+    """
+    # 1. Crear tabla temporal
+    session.execute(text(f"""
+        CREATE TEMP TABLE IF NOT EXISTS temp_concesiones (
+            {_concesiones_staging_ddl(natural_keys)}
+        ) ON COMMIT DROP;
+    """))
+
+    # 2. COPY a tabla temporal
+    rows_copied = _copy_concesiones_into(session, 'temp_concesiones', source, binary, natural_keys)
+
+    # 3. Upsert a tabla final particionada
+    insertados, duplicados = _upsert_concesiones(session, 'temp_concesiones', rows_copied, natural_keys)
 
     session.commit()
-    log(f"  ✓ Insertados: {insertados}, Duplicados: {duplicados}")
+    return insertados, duplicados
+
+
+def copy_concesiones_to_staging(session, csv_path: Path, binary: bool = False) -> Tuple[str, int]:
+    """
+    COPY de concesiones a una tabla UNLOGGED propia en STAGING_SCHEMA, sin upsert.
+
+    A diferencia de temp_concesiones, la tabla es visible desde otras
+    conexiones, de modo que merge_concesiones_staging() puede ejecutarse en
+    otro hilo mientras este sigue copiando el siguiente directorio.
+
+    Returns:
+        (tabla, filas_copiadas)
+    """
+    table = f"{STAGING_SCHEMA}.{STAGING_TABLE_PREFIX}{uuid4().hex}"
+    session.execute(text(f"CREATE UNLOGGED TABLE {table} ({_concesiones_staging_ddl(True)})"))
+
+    try:
+        with _open_concesiones_source(csv_path, binary) as f:
+            rows_copied = _copy_concesiones_into(session, table, f, binary, natural_keys=True)
+        session.commit()
+    except Exception:
+        session.rollback()  # revierte también el CREATE TABLE
+        raise
+
+    return table, rows_copied
+
+
+def drop_stale_staging_tables(session) -> int:
+    """
+    Crea STAGING_SCHEMA si no existe y elimina las tablas de staging que
+    haya dejado una carga interrumpida (caída entre el COPY y la fusión, o
+    con fusiones aún en cola). Incluye las antiguas bdns.staging_concesiones_*.
+
+    No admite dos load_csvs simultáneos: cada uno borraría el staging del otro.
+
+    Returns:
+        tablas eliminadas
+    """
+    session.execute(text(f"CREATE SCHEMA IF NOT EXISTS {STAGING_SCHEMA}"))
+    tables = session.execute(text("""
+        SELECT schemaname, tablename
+        FROM pg_tables
+        WHERE schemaname IN (:staging_schema, 'bdns')
+          AND tablename LIKE :pattern
+    """), {
+        "staging_schema": STAGING_SCHEMA,
+        "pattern": STAGING_TABLE_PREFIX.replace('_', '\\_') + '%',
+    }).all()
+
+    for schema, table in tables:
+        log(f"  DROP TABLE {schema}.{table} (staging huérfano)")
+        session.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table}"'))
+
+    session.commit()
+    return len(tables)
+
+
+def merge_concesiones_staging(session, table: str, rows_copied: int) -> Tuple[int, int]:
+    """
+    Upsert de una tabla de copy_concesiones_to_staging() y la elimina.
+
+    Returns:
+        (insertados, duplicados)
+    """
+    log(f"Fusionando {table}...")
+    try:
+        insertados, duplicados = _upsert_concesiones(session, table, rows_copied, natural_keys=True)
+        session.commit()
+    finally:
+        session.rollback()
+        session.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        session.commit()
 
     return insertados, duplicados
 
 
-def load_csvs(csv_dir: Path):
-    """Carga todos los CSVs de un directorio."""
+def _merge_in_own_session(table: str, rows_copied: int) -> Tuple[int, int]:
+    """Ejecuta merge_concesiones_staging en su propia sesión de carga masiva."""
+    with bulk_load_session() as session:
+        return merge_concesiones_staging(session, table, rows_copied)
+
+
+def drop_secondary_indexes(session, schema: str = 'bdns', table: str = 'concesion') -> List[Tuple[str, str]]:
+    """
+    Elimina los índices no únicos de una tabla antes de una carga masiva.
+
+    Se conservan PK y UNIQUE (necesarios para ON CONFLICT). Las definiciones
+    se registran en el log para poder recrearlos a mano si algo falla.
+
+    bdns.concesion está particionada: pg_indexes da la definición del índice
+    padre como "CREATE INDEX ... ON ONLY ...", que recrearía sólo un índice
+    inválido en el padre (el DROP elimina también los de las particiones).
+    Se guarda sin ONLY para que el CREATE INDEX los reconstruya y adjunte.
+
+    Returns:
+        [(indexname, indexdef)] para recreate_indexes()
+    """
+    indexes = session.execute(text("""
+        SELECT i.indexname, i.indexdef
+        FROM pg_indexes i
+        JOIN pg_namespace n ON n.nspname = i.schemaname
+        JOIN pg_class c ON c.relname = i.indexname AND c.relnamespace = n.oid
+        JOIN pg_index x ON x.indexrelid = c.oid
+        WHERE i.schemaname = :schema
+          AND i.tablename = :table
+          AND NOT x.indisunique
+          AND NOT x.indisprimary
+          AND x.indisvalid
+    """), {"schema": schema, "table": table}).all()
+    indexes = [(name, definition.replace(' ON ONLY ', ' ON ', 1)) for name, definition in indexes]
+
+    for indexname, indexdef in indexes:
+        log(f"  DROP INDEX {schema}.{indexname}  ({indexdef})")
+        session.execute(text(f'DROP INDEX IF EXISTS {schema}."{indexname}"'))
+
+    session.commit()
+    return indexes
+
+
+def recreate_indexes(session, indexes: List[Tuple[str, str]]):
+    """Recrea los índices eliminados por drop_secondary_indexes()."""
+    # CREATE INDEX CONCURRENTLY no es posible sobre tablas particionadas
+    for indexname, indexdef in indexes:
+        log(f"  CREATE INDEX {indexname}...")
+        session.execute(text(indexdef))
+        session.commit()
+
+
+def _csv_paths(csv_dir: Path, concesiones_format: str = 'csv') -> Tuple[Path, Path, Path]:
+    """Rutas de beneficiarios/convocatorias/concesiones de un directorio; sale si falta alguna."""
     benef_csv = csv_dir / 'beneficiarios.csv'
     conv_csv = csv_dir / 'convocatorias.csv'
-    conc_csv = csv_dir / 'concesiones.csv'
+    conc_csv = csv_dir / CONCESIONES_FORMATS[concesiones_format]
 
     # Validar que existen
-    missing = []
-    if not benef_csv.exists():
-        missing.append(str(benef_csv))
-    if not conv_csv.exists():
-        missing.append(str(conv_csv))
-    if not conc_csv.exists():
-        missing.append(str(conc_csv))
+    missing = [str(p) for p in (benef_csv, conv_csv, conc_csv) if not p.exists()]
 
     if missing:
         log(f"ERROR: CSVs faltantes:")
@@ -256,23 +567,76 @@ def load_csvs(csv_dir: Path):
             log(f"  - {m}")
         sys.exit(1)
 
+    return benef_csv, conv_csv, conc_csv
+
+
+def load_csvs(csv_dirs: List[Path], rebuild_indexes: bool = False,
+              concesiones_format: str = 'csv'):
+    """
+    Carga todos los CSVs de uno o varios directorios.
+
+    Las concesiones de cada directorio se copian a una tabla de staging y
+    se fusionan en bdns.concesion desde un hilo aparte, en orden: la fusión
+    del directorio N se solapa con el COPY del directorio N+1.
+
+    Args:
+        csv_dirs: Directorios con beneficiarios.csv, convocatorias.csv y concesiones.csv
+        rebuild_indexes: Eliminar los índices secundarios de bdns.concesion antes
+            del upsert y recrearlos después (recomendado en cargas iniciales)
+        concesiones_format: 'csv' (concesiones.csv) o 'binary' (concesiones.bin);
+            debe coincidir con el --format usado en transform_json_to_csv
+    """
+    paths = [_csv_paths(csv_dir, concesiones_format) for csv_dir in csv_dirs]
+    binary = concesiones_format == 'binary'
+
     log(f"{'='*60}")
     log(f"LOAD CSV → PostgreSQL (COPY)")
     log(f"{'='*60}")
-    log(f"Directorio: {csv_dir}")
+    for csv_dir in csv_dirs:
+        log(f"Directorio: {csv_dir}")
     log("")
 
     start_time = time.time()
-
-    with get_session() as session:
-        # 1. Beneficiarios (primero, FK dependency)
-        b_ins, b_dup = copy_beneficiarios(session, benef_csv)
-
-        # 2. Convocatorias
-        c_ins, c_dup = copy_convocatorias(session, conv_csv)
-
-        # 3. Concesiones
-        conc_ins, conc_dup = copy_concesiones(session, conc_csv)
+    b_ins = b_dup = c_ins = c_dup = conc_ins = conc_dup = 0
+
+    with bulk_load_session() as session:
+        drop_stale_staging_tables(session)
+
+    dropped_indexes = []
+    if rebuild_indexes:
+        log("Eliminando índices secundarios de bdns.concesion...")
+        with bulk_load_session() as session:
+            dropped_indexes = drop_secondary_indexes(session)
+
+    try:
+        # Un único hilo de fusión: los merges se ejecutan en orden de llegada
+        with ThreadPoolExecutor(max_workers=1) as merge_pool:
+            merges = []
+
+            for benef_csv, conv_csv, conc_csv in paths:
+                # 1-2. Beneficiarios y convocatorias en paralelo: no dependen
+                # entre sí, cada una en su propia conexión
+                with ThreadPoolExecutor(max_workers=2) as pool:
+                    benef_future = pool.submit(_copy_in_own_session, copy_beneficiarios, benef_csv)
+                    conv_future = pool.submit(_copy_in_own_session, copy_convocatorias, conv_csv)
+                    ins, dup = benef_future.result()
+                    b_ins, b_dup = b_ins + ins, b_dup + dup
+                    ins, dup = conv_future.result()
+                    c_ins, c_dup = c_ins + ins, c_dup + dup
+
+                # 3. Concesiones (FK a ambas, ya confirmadas): COPY aquí,
+                # fusión en segundo plano
+                table, rows_copied = _copy_in_own_session(copy_concesiones_to_staging, conc_csv, binary)
+                merges.append(merge_pool.submit(_merge_in_own_session, table, rows_copied))
+
+            for merge in merges:
+                ins, dup = merge.result()
+                conc_ins, conc_dup = conc_ins + ins, conc_dup + dup
+    finally:
+        if dropped_indexes:
+            log("Recreando índices secundarios de bdns.concesion...")
+            with bulk_load_session() as session:
+                recreate_indexes(session, dropped_indexes)
 
     elapsed = time.time() - start_time
 
@@ -289,25 +653,33 @@ def load_csvs(csv_dir: Path):
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Uso: python load_from_csv.py <csv_directory>")
-        print()
-        print("El directorio debe contener:")
-        print("  - beneficiarios.csv")
-        print("  - convocatorias.csv")
-        print("  - concesiones.csv")
-        print()
-        print("Ejemplo:")
-        print("  python load_from_csv.py ./output/")
-        sys.exit(1)
-
-    csv_dir = Path(sys.argv[1])
-
-    if not csv_dir.is_dir():
-        print(f"Error: No es un directorio: {csv_dir}")
-        sys.exit(1)
-
-    load_csvs(csv_dir)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Carga CSVs a PostgreSQL usando COPY.",
+        epilog=(
+            "Cada directorio debe contener beneficiarios.csv, convocatorias.csv "
+            "y concesiones.csv (o concesiones.bin con --format binary). Ejemplo: python load_from_csv.py ./output/"
+        ),
+    )
+    parser.add_argument('csv_dirs', type=Path, nargs='+', metavar='csv_dir',
+                        help='Directorio(s) con los CSVs')
+    parser.add_argument('--rebuild-indexes', action='store_true',
+                        help='Eliminar y recrear los índices secundarios de bdns.concesion '
+                             'alrededor de la carga (cargas iniciales)')
+    parser.add_argument('--format', dest='concesiones_format', choices=sorted(CONCESIONES_FORMATS),
+                        default='csv',
+                        help='Formato de las concesiones: concesiones.csv o concesiones.bin '
+                             '(COPY BINARY). Debe coincidir con el --format del transform')
+    args = parser.parse_args()
+
+    for csv_dir in args.csv_dirs:
+        if not csv_dir.is_dir():
+            print(f"Error: No es un directorio: {csv_dir}")
+            sys.exit(1)
+
+    load_csvs(args.csv_dirs, rebuild_indexes=args.rebuild_indexes,
+              concesiones_format=args.concesiones_format)
 
 
 if __name__ == "__main__":
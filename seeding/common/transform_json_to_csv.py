@@ -5,7 +5,12 @@ Transforma JSONs de concesiones a CSVs para carga rápida con COPY.
 Procesa:
 1. Beneficiarios → beneficiarios.csv
 2. Convocatorias → convocatorias.csv
-3. Concesiones → concesiones.csv
+3. Concesiones → concesiones.csv, o concesiones.bin (formato binario de
+   COPY) con --format binary
+
+Ninguna tabla lleva UUID: los genera la BD al cargar (uuid_generate_v7()).
+Las concesiones los referencian por clave natural (nif, id_bdns), que
+load_from_csv resuelve con un JOIN.
 
 Los CSVs generados están listos para COPY FROM con formato:
 - Delimiter: |
@@ -14,43 +19,25 @@ Los CSVs generados están listos para COPY FROM con formato:
 - Escape: \\
 
 Uso:
-    python transform_json_to_csv.py /path/to/data.json partidos_politicos /output/dir/
+    python transform_json_to_csv.py /path/to/data.json partidos_politicos /output/dir/ [--format csv|binary]
 """
-import json
-import csv
+import struct
 import sys
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
-from typing import Dict, List, Set, Tuple
-from uuid import uuid4
-
-
-def normalizar(texto: str) -> str:
-    """Normaliza texto para búsqueda."""
-    if not texto:
-        return ""
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Set, Tuple
 
-    # Minúsculas
-    texto = texto.lower()
+import ijson
+import orjson
 
-    # Eliminar acentos
-    replacements = {
-        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u', 'ü': 'u',
-        'à': 'a', 'è': 'e', 'ì': 'i', 'ò': 'o', 'ù': 'u',
-        'ä': 'a', 'ë': 'e', 'ï': 'i', 'ö': 'o', 'ü': 'u',
-        'ñ': 'n', 'ç': 'c'
-    }
-    for old, new in replacements.items():
-        texto = texto.replace(old, new)
+# Por encima de este tamaño el JSON se lee en streaming con ijson; por debajo
+# se decodifica de una vez con orjson (mucho más rápido que json/ijson)
+STREAM_THRESHOLD_BYTES = 64 * 1024 * 1024
 
-    # Eliminar caracteres especiales excepto letras, números, espacios
-    texto = re.sub(r'[^a-z0-9\s]', ' ', texto)
-
-    # Normalizar espacios
-    texto = ' '.join(texto.split())
-
-    return texto
+# Sufijos de tipo de entidad en el NIF (":OT", ":LO", ...)
+_NIF_SUFFIX_RE = re.compile(r':[A-Z]{2}$')
 
 
 def extract_nif(beneficiario_str: str) -> str:
@@ -63,7 +50,7 @@ def extract_nif(beneficiario_str: str) -> str:
     if len(parts) >= 1:
         nif = parts[0].strip().upper()
         # Limpiar sufijos como :OT, :LO, etc
-        nif = re.sub(r':[A-Z]{2}$', '', nif)
+        nif = _NIF_SUFFIX_RE.sub('', nif)
         return nif
 
     return ""
@@ -87,16 +74,23 @@ def parse_date(date_str: str) -> str:
     if not date_str:
         return "\\N"
 
-    try:
-        # Formato API: "31/05/2024" o "2024-05-31"
-        if '/' in date_str:
-            dt = datetime.strptime(date_str, '%d/%m/%Y')
-        else:
-            dt = datetime.strptime(date_str, '%Y-%m-%d')
+    # Formato API: "31/05/2024" o "2024-05-31" (troceo directo, sin strptime;
+    # las ISO se devuelven tal cual)
+    if len(date_str) != 10:
+        return "\\N"
+    if date_str[2] == '/' and date_str[5] == '/':
+        iso = f"{date_str[6:10]}-{date_str[3:5]}-{date_str[0:2]}"
+    elif date_str[4] == '-' and date_str[7] == '-':
+        iso = date_str
+    else:
+        return "\\N"
 
-        return dt.strftime('%Y-%m-%d')
-    except:
+    # Dígitos y rango (31/02 no pasa): una fecha inválida abortaría el COPY entero
+    try:
+        date.fromisoformat(iso)
+    except ValueError:
         return "\\N"
+    return iso
 
 
 def safe_float(val) -> str:
@@ -109,6 +103,11 @@ def safe_float(val) -> str:
         return "\\N"
 
 
+# Caracteres que safe_str debe sanear para el CSV de COPY
+_CSV_ESCAPE = str.maketrans({'\n': ' ', '\r': ' ', '\t': ' ', '|': ' '})
+_CSV_SPECIAL_RE = re.compile(r'[\\\n\r\t|]')
+
+
 def safe_str(val) -> str:
     """Escapa string para CSV o NULL."""
     if val is None or val == '':
@@ -119,41 +118,173 @@ def safe_str(val) -> str:
     if not s:
         return "\\N"
 
-    # Escapar caracteres especiales
-    s = s.replace('\\', '\\\\')  # Backslash
-    s = s.replace('\n', ' ')     # Newlines
-    s = s.replace('\r', ' ')     # Carriage returns
-    s = s.replace('\t', ' ')     # Tabs
-    s = s.replace('|', ' ')      # Delimiter
+    # Caso habitual: nada que escapar
+    if not _CSV_SPECIAL_RE.search(s):
+        return s
+
+    # Escapar caracteres especiales: backslash duplicado; saltos de línea,
+    # tabuladores y delimitador a espacio (una sola pasada con translate)
+    if '\\' in s:
+        s = s.replace('\\', '\\\\')
+    return s.translate(_CSV_ESCAPE)
 
+
+def csv_field(s: str) -> str:
+    """
+    Prepara un texto ya saneado con safe_str para CSV de COPY.
+
+    Sólo se entrecomilla si contiene comillas o backslash (con ESCAPE '\\'
+    únicamente se interpretan dentro de comillas); \\N queda sin comillas
+    para que COPY lo lea como NULL.
+    """
+    if '"' in s or ('\\' in s and s != "\\N"):
+        return '"' + s.replace('"', '\\"') + '"'
     return s
 
 
+# Escritura a disco: las líneas se acumulan en un bytearray y se vuelcan por bloques
+WRITE_BUFFER_SIZE = 1 << 20
+FLUSH_EVERY = 10_000
+
+
+class _BufferedWriter:
+    """Acumula bytes en memoria y los escribe en bloques cada FLUSH_EVERY filas."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray()
+        self.rows = 0
+
+    def write(self, data: bytes):
+        self.buf += data
+        self.rows += 1
+        if self.rows % FLUSH_EVERY == 0:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write(self.buf)
+            self.buf.clear()
+
+
+# Formato binario de COPY (https://www.postgresql.org/docs/current/sql-copy.html)
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PG_EPOCH_DATE = date(2000, 1, 1)
+PG_EPOCH_DATETIME = datetime(2000, 1, 1)
+_NULL_FIELD = struct.pack('!i', -1)
+
+
+def _bin_text(val) -> bytes:
+    if val is None or val == "\\N":
+        return _NULL_FIELD
+    data = str(val).encode('utf-8')
+    return struct.pack('!i', len(data)) + data
+
+
+def _bin_date(val: str) -> bytes:
+    days = (date.fromisoformat(val) - PG_EPOCH_DATE).days
+    return struct.pack('!ii', 4, days)
+
+
+def _bin_float(val: str) -> bytes:
+    if val == "\\N":
+        return _NULL_FIELD
+    return struct.pack('!id', 8, float(val))
+
+
+def _bin_timestamp(val: str) -> bytes:
+    delta = datetime.fromisoformat(val) - PG_EPOCH_DATETIME
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return struct.pack('!iq', 8, micros)
+
+
+# Columnas de concesiones.csv/.bin; process_concesion devuelve tuplas en este orden
+CONCESION_COLUMNS = (
+    'id_concesion', 'beneficiario_nif', 'convocatoria_id_bdns', 'fecha_concesion',
+    'regimen_tipo', 'importe_nominal', 'importe_equivalente', 'created_by', 'created_at',
+)
+
+
+def pack_concesion_binary(c: Tuple) -> bytes:
+    """Empaqueta una concesión (tupla en orden CONCESION_COLUMNS) como tupla de COPY BINARY."""
+    id_concesion, nif, id_bdns, fecha, regimen, nominal, equivalente, created_by, created_at = c
+    return b''.join((
+        struct.pack('!h', 9),
+        _bin_text(id_concesion),
+        _bin_text(nif),
+        _bin_text(id_bdns),
+        _bin_date(fecha),
+        _bin_text(regimen),
+        _bin_float(nominal),
+        _bin_float(equivalente),
+        _bin_text(created_by),
+        _bin_timestamp(created_at),
+    ))
+
+
+def pack_concesion_csv(c: Tuple) -> bytes:
+    """Formatea una concesión (tupla en orden CONCESION_COLUMNS) como línea de concesiones.csv."""
+    # Los tres primeros campos son texto libre; el resto ya viene en formato COPY
+    return '|'.join((
+        csv_field(safe_str(c[0])),
+        csv_field(safe_str(c[1])),
+        csv_field(safe_str(c[2])),
+        *c[3:],
+    )).encode('utf-8') + b'\n'
+
+
+# Formatos de salida de concesiones: nombre de fichero por formato
+CONCESIONES_FORMATS = {'csv': 'concesiones.csv', 'binary': 'concesiones.bin'}
+
+
 class JSONToCSVTransformer:
     """Transforma JSON de concesiones a CSVs optimizados para COPY."""
 
-    def __init__(self, json_path: Path, regimen_tipo: str, output_dir: Path):
+    def __init__(self, json_path: Path, regimen_tipo: str, output_dir: Path,
+                 concesiones_format: str = 'csv'):
+        if concesiones_format not in CONCESIONES_FORMATS:
+            raise ValueError(f"Formato de concesiones no válido: {concesiones_format}")
         self.json_path = json_path
         self.regimen_tipo = regimen_tipo
         self.output_dir = output_dir
+        self.concesiones_format = concesiones_format
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Tablas temporales para deduplicación
-        self.beneficiarios: Dict[str, Dict] = {}  # nif → data
-        self.convocatorias: Dict[str, Dict] = {}  # codigo_bdns → data
-        self.concesiones: List[Dict] = []
-
-    def load_json(self) -> List[Dict]:
-        """Carga JSON de concesiones."""
-        print(f"Cargando JSON: {self.json_path}")
-        with open(self.json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        print(f"  ✓ {len(data)} registros cargados")
-        return data
+        # Tablas para deduplicación en columnas paralelas (sin un dict por
+        # fila); las concesiones no se acumulan: se escriben según se generan.
+        # Las claves naturales se internan: la misma cadena sirve de clave del
+        # índice, de columna y de FK en cada concesión
+        self.benef_nifs: List[str] = []
+        self.benef_nombres: List[str] = []
+        self.benef_nif_to_idx: Dict[str, int] = {}
+
+        self.conv_codigos: List[str] = []  # id_bdns y codigo_bdns (mismo valor)
+        self.conv_titulos: List[str] = []
+        self.conv_codigo_to_idx: Dict[str, int] = {}
+
+        self.total_concesiones = 0
+
+        # Marca de tiempo común a toda la ejecución (se fija en transform())
+        self._now_iso = datetime.now().isoformat()
+
+    def iter_records(self) -> Iterator[Dict]:
+        """
+        Itera el array JSON de concesiones.
+
+        Los ficheros pequeños se decodifican de una vez con orjson; los
+        grandes se recorren en streaming con ijson (memoria constante).
+        """
+        print(f"Leyendo JSON: {self.json_path}")
+        with open(self.json_path, 'rb') as f:
+            if self.json_path.stat().st_size > STREAM_THRESHOLD_BYTES:
+                yield from ijson.items(f, 'item', use_float=True)
+                return
+            records = orjson.loads(f.read())
+        yield from records
 
     def process_beneficiario(self, beneficiario_str: str) -> str:
-        """Procesa beneficiario y retorna UUID."""
+        """Procesa beneficiario y retorna su NIF (clave natural)."""
         if not beneficiario_str:
             return None
 
@@ -162,27 +293,21 @@ class JSONToCSVTransformer:
             return None
 
         # Ya existe?
-        if nif in self.beneficiarios:
-            return self.beneficiarios[nif]['id']
+        if nif in self.benef_nif_to_idx:
+            return self.benef_nifs[self.benef_nif_to_idx[nif]]
 
-        # Crear nuevo
+        # Crear nuevo (id y nombre_norm se calculan en la BD durante la carga)
+        nif = sys.intern(nif)
         nombre = extract_nombre(beneficiario_str)
-        nombre_norm = normalizar(nombre)
 
-        benef_id = str(uuid4())
-        self.beneficiarios[nif] = {
-            'id': benef_id,
-            'nif': nif,
-            'nombre': nombre[:500],  # Límite de columna
-            'nombre_norm': nombre_norm[:500],
-            'created_by': 'etl_transform',
-            'created_at': datetime.now().isoformat()
-        }
+        self.benef_nif_to_idx[nif] = len(self.benef_nifs)
+        self.benef_nifs.append(nif)
+        self.benef_nombres.append(nombre[:500])  # Límite de columna
 
-        return benef_id
+        return nif
 
     def process_convocatoria(self, record: Dict) -> str:
-        """Procesa convocatoria y retorna UUID."""
+        """Procesa convocatoria y retorna su id_bdns (clave natural)."""
         # codigoBDNS es el identificador natural
         codigo_bdns = record.get('codigoBDNS', record.get('codigo_bdns'))
         if not codigo_bdns:
@@ -192,36 +317,35 @@ class JSONToCSVTransformer:
         if not codigo_bdns:
             return None
 
+        # El JSON puede traerlo como número
+        codigo_bdns = str(codigo_bdns)
+
         # Ya existe?
-        if codigo_bdns in self.convocatorias:
-            return self.convocatorias[codigo_bdns]['id']
+        idx = self.conv_codigo_to_idx.get(codigo_bdns)
+        if idx is not None:
+            return self.conv_codigos[idx]
 
-        # Crear nueva
-        conv_id = str(uuid4())
+        # Crear nueva (el id lo genera la BD durante la carga)
+        codigo_bdns = sys.intern(codigo_bdns)
 
         # Título de convocatoria
         titulo = None
         if isinstance(record.get('convocatoria'), dict):
             titulo = record.get('convocatoria', {}).get('titulo')
 
-        self.convocatorias[codigo_bdns] = {
-            'id': conv_id,
-            'id_bdns': codigo_bdns,  # ID natural de BDNS
-            'codigo_bdns': codigo_bdns,  # Mismo valor por compatibilidad
-            'titulo': titulo[:500] if titulo else None,
-            'created_by': 'etl_transform',
-            'created_at': datetime.now().isoformat()
-        }
+        self.conv_codigo_to_idx[codigo_bdns] = len(self.conv_codigos)
+        self.conv_codigos.append(codigo_bdns)  # ID natural de BDNS
+        self.conv_titulos.append(titulo[:500] if titulo else None)
 
-        return conv_id
+        return codigo_bdns
 
-    def process_concesion(self, record: Dict) -> Dict:
-        """Procesa concesión y retorna registro para CSV."""
-        # IDs foráneos
-        beneficiario_id = self.process_beneficiario(record.get('beneficiario'))
-        convocatoria_id = self.process_convocatoria(record)
+    def process_concesion(self, record: Dict) -> Tuple:
+        """Procesa concesión y retorna su fila (tupla en orden CONCESION_COLUMNS)."""
+        # Claves foráneas (naturales; se resuelven a UUID en la carga)
+        beneficiario_nif = self.process_beneficiario(record.get('beneficiario'))
+        convocatoria_id_bdns = self.process_convocatoria(record)
 
-        if not beneficiario_id or not convocatoria_id:
+        if not beneficiario_nif or not convocatoria_id_bdns:
             return None
 
         # ID de concesión (natural de BDNS)
@@ -238,140 +362,148 @@ class JSONToCSVTransformer:
         importe_nominal = safe_float(record.get('importeConcedidoNominal', record.get('importe_nominal')))
         importe_equivalente = safe_float(record.get('importeConcedido', record.get('importe_equivalente')))
 
-        return {
-            'id': str(uuid4()),  # UUID generado
-            'id_concesion': id_concesion,
-            'beneficiario_id': beneficiario_id,
-            'convocatoria_id': convocatoria_id,
-            'fecha_concesion': fecha_concesion,
-            'regimen_tipo': self.regimen_tipo,
-            'importe_nominal': importe_nominal,
-            'importe_equivalente': importe_equivalente,
-            'created_by': 'etl_transform',
-            'created_at': datetime.now().isoformat()
-        }
+        return (
+            str(id_concesion).strip(),
+            beneficiario_nif,
+            convocatoria_id_bdns,
+            fecha_concesion,
+            self.regimen_tipo,
+            importe_nominal,
+            importe_equivalente,
+            'etl_transform',
+            self._now_iso,
+        )
 
     def transform(self):
-        """Ejecuta transformación completa."""
-        # Cargar JSON
-        records = self.load_json()
-
-        # Procesar cada registro
-        print(f"\nProcesando {len(records)} registros...")
-        for i, record in enumerate(records, 1):
-            concesion = self.process_concesion(record)
-            if concesion:
-                self.concesiones.append(concesion)
-
-            if i % 1000 == 0:
-                print(f"  Procesados: {i}/{len(records)} ({i*100//len(records)}%)")
-
-        print(f"\n✓ Transformación completada:")
-        print(f"  Beneficiarios: {len(self.beneficiarios)}")
-        print(f"  Convocatorias: {len(self.convocatorias)}")
-        print(f"  Concesiones:   {len(self.concesiones)}")
-
-    def write_csvs(self):
-        """Escribe CSVs optimizados para COPY."""
-        # CSV de beneficiarios
+        """
+        Ejecuta la transformación en streaming.
+
+        Cada registro se procesa y su concesión se escribe de inmediato en
+        concesiones.csv o concesiones.bin, según concesiones_format;
+        beneficiarios y convocatorias se deduplican en memoria y se escriben
+        al final con write_csvs().
+
+        Se escribe sólo el formato pedido y a un .tmp que se renombra al
+        terminar: la carga nunca ve un fichero a medias.
+        """
+        self._now_iso = datetime.now().isoformat()
+
+        binary = self.concesiones_format == 'binary'
+        conc_path = self.output_dir / CONCESIONES_FORMATS[self.concesiones_format]
+        tmp_path = conc_path.with_name(conc_path.name + '.tmp')
+        pack = pack_concesion_binary if binary else pack_concesion_csv
+        print(f"\nEscribiendo {conc_path}...")
+
+        with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            if binary:
+                # Formato binario de COPY (el servidor no parsea texto)
+                f.write(PGCOPY_HEADER)
+            else:
+                f.write(('|'.join(CONCESION_COLUMNS) + '\n').encode('utf-8'))
+            out = _BufferedWriter(f)
+
+            i = 0
+            for i, record in enumerate(self.iter_records(), 1):
+                c = self.process_concesion(record)
+                if c:
+                    out.write(pack(c))
+                    self.total_concesiones += 1
+
+                if i % 10000 == 0:
+                    print(f"  Procesados: {i:,}")
+
+            out.flush()
+            if binary:
+                f.write(PGCOPY_TRAILER)
+        tmp_path.replace(conc_path)
+
+        print(f"\n✓ Transformación completada ({i:,} registros):")
+        print(f"  Beneficiarios: {len(self.benef_nifs)}")
+        print(f"  Convocatorias: {len(self.conv_codigos)}")
+        print(f"  Concesiones:   {self.total_concesiones}")
+
+    def _write_beneficiarios(self) -> Path:
+        """Escribe beneficiarios.csv."""
         benef_csv = self.output_dir / 'beneficiarios.csv'
-        print(f"\nEscribiendo {benef_csv}...")
-        with open(benef_csv, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f, delimiter='|', quoting=csv.QUOTE_MINIMAL, escapechar='\\')
-            # Header
-            writer.writerow(['id', 'nif', 'nombre', 'nombre_norm', 'created_by', 'created_at'])
-            # Data
-            for b in self.beneficiarios.values():
-                writer.writerow([
-                    b['id'],
-                    safe_str(b['nif']),
-                    safe_str(b['nombre']),
-                    safe_str(b['nombre_norm']),
-                    b['created_by'],
-                    b['created_at']
-                ])
-        print(f"  ✓ {len(self.beneficiarios)} beneficiarios escritos")
-
-        # CSV de convocatorias
+        with open(benef_csv, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(b'nif|nombre|created_by|created_at\n')
+            out = _BufferedWriter(f)
+            tail = f"|etl_transform|{self._now_iso}\n"
+            for nif, nombre in zip(self.benef_nifs, self.benef_nombres):
+                out.write((
+                    f"{csv_field(safe_str(nif))}|{csv_field(safe_str(nombre))}{tail}"
+                ).encode('utf-8'))
+            out.flush()
+        return benef_csv
+
+    def _write_convocatorias(self) -> Path:
+        """Escribe convocatorias.csv."""
         conv_csv = self.output_dir / 'convocatorias.csv'
-        print(f"\nEscribiendo {conv_csv}...")
-        with open(conv_csv, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f, delimiter='|', quoting=csv.QUOTE_MINIMAL, escapechar='\\')
-            # Header
-            writer.writerow(['id', 'id_bdns', 'codigo_bdns', 'titulo', 'created_by', 'created_at'])
-            # Data
-            for c in self.convocatorias.values():
-                writer.writerow([
-                    c['id'],
-                    safe_str(c['id_bdns']),
-                    safe_str(c['codigo_bdns']),
-                    safe_str(c['titulo']),
-                    c['created_by'],
-                    c['created_at']
-                ])
-        print(f"  ✓ {len(self.convocatorias)} convocatorias escritas")
-
-        # CSV de concesiones
-        conc_csv = self.output_dir / 'concesiones.csv'
-        print(f"\nEscribiendo {conc_csv}...")
-        with open(conc_csv, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f, delimiter='|', quoting=csv.QUOTE_MINIMAL, escapechar='\\')
-            # Header
-            writer.writerow([
-                'id', 'id_concesion', 'beneficiario_id', 'convocatoria_id',
-                'fecha_concesion', 'regimen_tipo', 'importe_nominal', 'importe_equivalente',
-                'created_by', 'created_at'
-            ])
-            # Data
-            for c in self.concesiones:
-                writer.writerow([
-                    c['id'],
-                    safe_str(c['id_concesion']),
-                    c['beneficiario_id'],
-                    c['convocatoria_id'],
-                    c['fecha_concesion'],
-                    c['regimen_tipo'],
-                    c['importe_nominal'],
-                    c['importe_equivalente'],
-                    c['created_by'],
-                    c['created_at']
-                ])
-        print(f"  ✓ {len(self.concesiones)} concesiones escritas")
-
+        with open(conv_csv, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(b'id_bdns|codigo_bdns|titulo|created_by|created_at\n')
+            out = _BufferedWriter(f)
+            tail = f"|etl_transform|{self._now_iso}\n"
+            for codigo, titulo in zip(self.conv_codigos, self.conv_titulos):
+                codigo = csv_field(safe_str(codigo))
+                out.write((
+                    f"{codigo}|{codigo}|{csv_field(safe_str(titulo))}{tail}"
+                ).encode('utf-8'))
+            out.flush()
+        return conv_csv
 
-def main():
-    if len(sys.argv) < 4:
-        print("Uso: python transform_json_to_csv.py <json_path> <regimen_tipo> <output_dir>")
-        print()
-        print("Ejemplo:")
-        print("  python transform_json_to_csv.py data.json partidos_politicos ./output/")
-        print()
-        print("regimen_tipo valores:")
-        print("  - minimis")
-        print("  - ayuda_estado")
-        print("  - partidos_politicos")
-        print("  - grandes_benef")
-        print("  - ordinaria")
-        sys.exit(1)
+    def write_csvs(self):
+        """
+        Escribe los CSVs de beneficiarios y convocatorias deduplicados.
+
+        Son ficheros y estructuras independientes, así que se escriben en
+        paralelo (las escrituras a disco liberan el GIL).
+        """
+        print(f"\nEscribiendo beneficiarios.csv y convocatorias.csv en {self.output_dir}...")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            f_benef = pool.submit(self._write_beneficiarios)
+            f_conv = pool.submit(self._write_convocatorias)
+            f_benef.result()
+            f_conv.result()
+        print(f"  ✓ {len(self.benef_nifs)} beneficiarios escritos")
+        print(f"  ✓ {len(self.conv_codigos)} convocatorias escritas")
 
-    json_path = Path(sys.argv[1])
-    regimen_tipo = sys.argv[2]
-    output_dir = Path(sys.argv[3])
 
-    if not json_path.exists():
-        print(f"Error: JSON no encontrado: {json_path}")
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Transforma un JSON de concesiones a CSVs para COPY.",
+        epilog=(
+            "regimen_tipo: minimis, ayuda_estado, partidos_politicos, grandes_benef, ordinaria. "
+            "Ejemplo: python transform_json_to_csv.py data.json partidos_politicos ./output/"
+        ),
+    )
+    parser.add_argument('json_path', type=Path, help='JSON de concesiones')
+    parser.add_argument('regimen_tipo', help='Régimen de las concesiones')
+    parser.add_argument('output_dir', type=Path, help='Directorio de salida')
+    parser.add_argument('--format', dest='concesiones_format', choices=sorted(CONCESIONES_FORMATS),
+                        default='csv',
+                        help='Formato de las concesiones: concesiones.csv o concesiones.bin '
+                             '(COPY BINARY). Debe coincidir con el --format de load_from_csv')
+    args = parser.parse_args()
+
+    if not args.json_path.exists():
+        print(f"Error: JSON no encontrado: {args.json_path}")
         sys.exit(1)
 
     print(f"{'='*60}")
     print(f"TRANSFORM JSON → CSV")
     print(f"{'='*60}")
-    print(f"JSON:         {json_path}")
-    print(f"Régimen:      {regimen_tipo}")
-    print(f"Output:       {output_dir}")
+    print(f"JSON:         {args.json_path}")
+    print(f"Régimen:      {args.regimen_tipo}")
+    print(f"Output:       {args.output_dir}")
+    print(f"Concesiones:  {args.concesiones_format}")
     print()
 
     # Transformar
-    transformer = JSONToCSVTransformer(json_path, regimen_tipo, output_dir)
+    transformer = JSONToCSVTransformer(
+        args.json_path, args.regimen_tipo, args.output_dir, args.concesiones_format
+    )
     transformer.transform()
     transformer.write_csvs()
 
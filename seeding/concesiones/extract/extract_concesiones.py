@@ -4,13 +4,16 @@ Extract: Concesiones ordinarias desde /concesiones/busqueda
 Genera JSONL con campos crudos + metadata de origen.
 """
 
-import json
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
@@ -23,19 +26,55 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 PAGE_SIZE = 10000
+MAX_IN_FLIGHT = 4  # Páginas pedidas en paralelo por delante de la que se escribe
+WRITE_BUFFER_SIZE = 1 << 20  # Bytes acumulados antes de volcar a disco
 URL = "https://www.infosubvenciones.es/bdnstrans/api/concesiones/busqueda"
 RUTA_RAW = Path(__file__).resolve().parent.parent / "data" / "jsonl"
 RUTA_RAW.mkdir(parents=True, exist_ok=True)
 
+# Sesión HTTP compartida: reutiliza las conexiones TCP/TLS entre páginas
+# (una por petición en vuelo), pide respuesta comprimida y reintenta con
+# backoff ante 429/5xx
+_session = requests.Session()
+_session.headers.update({"Accept-Encoding": "gzip"})
+_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_IN_FLIGHT,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
 
 def limpiar_campo(txt):
     return txt.replace('\ufeff', '').strip() if txt else ""
 
 
+def fetch_page(page: int, desde: str, hasta: str) -> list:
+    """Descarga una página de /concesiones/busqueda y retorna su content."""
+    params = {
+        "page": page,
+        "pageSize": PAGE_SIZE,
+        "fechaDesde": desde,
+        "fechaHasta": hasta,
+    }
+    
+    try:
+        r = _session.get(URL, params=params, timeout=180)
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        logger.error(f"Error en página {page}: {e}")
+        raise
+    
+    return data.get("content", [])
+
+
 def extract_concesiones_ordinarias(year: int) -> Path:
     """
     Extrae concesiones ordinarias y genera JSONL.
     Cada línea es un objeto JSON con campos de la API + _meta.
+
+    Mantiene hasta MAX_IN_FLIGHT páginas descargándose en paralelo, pero
+    las escribe en orden; la última página es la que llega incompleta.
     """
     desde = f"01/01/{year}"
     hasta = f"31/12/{year}"
@@ -48,36 +87,30 @@ def extract_concesiones_ordinarias(year: int) -> Path:
     page = 0
     total = 0
     seen_ids = set()  # Deduplicación intra-proceso
+    buf = bytearray()
     
-    with open(output_path, "w", encoding="utf-8") as fout:
+    with open(output_path, "wb") as fout, ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as pool:
+        pending = {p: pool.submit(fetch_page, p, desde, hasta) for p in range(MAX_IN_FLIGHT)}
+        
         while True:
-            params = {
-                "page": page,
-                "pageSize": PAGE_SIZE,
-                "fechaDesde": desde,
-                "fechaHasta": hasta,
-            }
-            
-            try:
-                r = requests.get(URL, params=params, timeout=180)
-                r.raise_for_status()
-                data = r.json()
-            except requests.RequestException as e:
-                logger.error(f"Error en página {page}: {e}")
-                raise
-            
-            content = data.get("content", [])
+            content = pending.pop(page).result()
             batch_count = 0
             
             for row in content:
-                id_concesion = str(row.get("id"))
+                raw_id = row.get("id")
+                # Los IDs de BDNS son numéricos: como int ocupan menos que como str
+                try:
+                    id_key = int(raw_id)
+                except (TypeError, ValueError):
+                    id_key = raw_id
                 
                 # Deduplicación: saltar si ya vimos este ID
-                if id_concesion in seen_ids:
-                    logger.warning(f"Concesión {id_concesion} duplicada en extracción ordinaria")
+                if id_key in seen_ids:
+                    logger.warning(f"Concesión {raw_id} duplicada en extracción ordinaria")
                     continue
                 
-                seen_ids.add(id_concesion)
+                seen_ids.add(id_key)
+                id_concesion = str(raw_id)
                 
                 # Construir registro con metadata
                 record = {
@@ -119,17 +152,28 @@ def extract_concesiones_ordinarias(year: int) -> Path:
                     "tiene_proyecto": row.get("tieneProyecto"),
                 }
                 
-                fout.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
-                fout.write("\n")
+                buf += orjson.dumps(record)
+                buf += b"\n"
+                if len(buf) > WRITE_BUFFER_SIZE:
+                    fout.write(buf)
+                    buf.clear()
                 batch_count += 1
             
             total += batch_count
             logger.info(f"Página {page}: {batch_count} registros (total únicos: {total})")
             
-            if batch_count < PAGE_SIZE:
+            if len(content) < PAGE_SIZE:
+                # Las páginas ya pedidas tras la última se descartan
+                for future in pending.values():
+                    future.cancel()
                 break
             
+            next_page = page + MAX_IN_FLIGHT
+            pending[next_page] = pool.submit(fetch_page, next_page, desde, hasta)
             page += 1
+        
+        if buf:
+            fout.write(buf)
     
     logger.info(f"Extracción completada: {total} concesiones ordinarias")
     return output_path
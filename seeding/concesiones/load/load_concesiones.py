@@ -4,9 +4,9 @@ Carga de concesiones a la base de datos.
 
 Este script carga concesiones desde CSVs generados por extract_concesiones.py.
 Optimizado para volumen alto (~1M registros/ano) usando:
-- Procesamiento por lotes (batches)
-- Bulk inserts con executemany
-- Manejo de concurrencia
+- COPY FROM STDIN del CSV completo a una tabla temporal (sin parseo en Python)
+- Validacion y conversion de tipos en SQL
+- INSERT ... SELECT ... ON CONFLICT DO NOTHING en una sola transaccion
 
 Uso:
     python -m ETL.concesiones.load.load_concesiones --year 2024
@@ -14,26 +14,22 @@ Uso:
 
 import csv
 import argparse
-import asyncio
 import logging
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any, Tuple
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 import sys
 
 # Agregar el directorio raiz al path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent))
 
 from bdns_core.db.session import get_session
-from bdns_core.db.models import Concesion, Instrumento, Beneficiario
-from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 
 # Configuracion
-BATCH_SIZE = 5000  # Registros por batch
-MAX_WORKERS = 4    # Threads para procesamiento paralelo
 ETL_USER = "etl_system"
+COPY_BUFFER_SIZE = 1 << 20
 
 # Logging
 logging.basicConfig(
@@ -43,58 +39,108 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def safe_float(val: str) -> float | None:
-    """Convierte string a float de forma segura."""
-    if not val or val.strip() == '':
-        return None
-    try:
-        return float(val.replace(',', '.'))
-    except (ValueError, AttributeError):
-        return None
+def _quote_ident(name: str) -> str:
+    """Entrecomilla un identificador SQL."""
+    return '"' + name.replace('"', '""') + '"'
 
 
-def safe_int(val: str) -> int | None:
-    """Convierte string a int de forma segura."""
-    if not val or val.strip() == '':
-        return None
-    try:
-        return int(val)
-    except (ValueError, AttributeError):
-        return None
+def _sql_str(col: str) -> str:
+    """Texto recortado; vacio → NULL."""
+    return f"NULLIF(btrim({col}), '')"
 
 
-def safe_str(val: str) -> str | None:
-    """Limpia string de forma segura."""
-    if not val:
-        return None
-    cleaned = val.strip()
-    return cleaned if cleaned else None
+def _sql_uuid(col: str) -> str:
+    """UUID si el texto lo es; si no, NULL."""
+    return (
+        f"CASE WHEN btrim({col}) ~* '^[0-9a-f]{{8}}-?([0-9a-f]{{4}}-?){{3}}[0-9a-f]{{12}}$' "
+        f"THEN btrim({col})::uuid END"
+    )
 
 
-def safe_date(val: str) -> datetime.date | None:
-    """Convierte string a date de forma segura."""
-    if not val or val.strip() == '':
-        return None
-    try:
-        # Formato esperado: YYYY-MM-DD o DD/MM/YYYY
-        if '/' in val:
-            return datetime.strptime(val.strip(), '%d/%m/%Y').date()
-        return datetime.strptime(val.strip(), '%Y-%m-%d').date()
-    except (ValueError, AttributeError):
-        return None
+def _sql_make_date(y: str, m: str, d: str) -> str:
+    """make_date(y, m, d) solo si la fecha existe (mes y dia segun calendario); si no, NULL."""
+    dias_mes = (
+        f"CASE WHEN {m} = 2 THEN 28 + ({y} % 4 = 0 AND ({y} % 100 <> 0 OR {y} % 400 = 0))::int "
+        f"WHEN {m} IN (4, 6, 9, 11) THEN 30 ELSE 31 END"
+    )
+    return (
+        f"CASE WHEN {y} >= 1 AND {m} BETWEEN 1 AND 12 AND {d} BETWEEN 1 AND {dias_mes} "
+        f"THEN make_date({y}, {m}, {d}) END"
+    )
+
+
+def _sql_date(col: str) -> str:
+    """
+    Fecha en formato YYYY-MM-DD o DD/MM/YYYY; si no, NULL.
+
+    Nunca lanza error: una fecha imposible (2024-02-31) abortaria toda la
+    carga, que va en una sola transaccion. El CASE anidado garantiza que los
+    casts a int solo se evaluan si el texto ya casa con la expresion regular.
+    """
+    s = f"btrim({col})"
+    iso = _sql_make_date(
+        f"substr({s}, 1, 4)::int", f"substr({s}, 6, 2)::int", f"substr({s}, 9, 2)::int"
+    )
+    dmy = _sql_make_date(
+        f"split_part({s}, '/', 3)::int", f"split_part({s}, '/', 2)::int", f"split_part({s}, '/', 1)::int"
+    )
+    return (
+        f"CASE WHEN {s} ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}$' THEN {iso} "
+        f"WHEN {s} ~ '^[0-9]{{1,2}}/[0-9]{{1,2}}/[0-9]{{4}}$' THEN {dmy} END"
+    )
+
+
+def _sql_float(col: str) -> str:
+    """
+    Numero (admite coma decimal); si no, NULL.
+
+    Nunca lanza error: el exponente se limita a tres cifras y el valor se
+    comprueba como numeric antes de pasarlo a float, asi 1e999 da NULL.
+    """
+    n = f"replace(btrim({col}), ',', '.')::numeric"
+    return (
+        f"CASE WHEN btrim({col}) ~ '^[-+]?([0-9]+([.,][0-9]*)?|[.,][0-9]+)([eE][-+]?[0-9]{{1,3}})?$' "
+        f"THEN CASE WHEN {n} = 0 OR abs({n}) BETWEEN 1e-307 AND 1e308 THEN {n}::float END END"
+    )
+
 
+def read_header(csv_path: Path) -> List[str]:
+    """Lee los nombres de columna del CSV."""
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return [c.strip() for c in next(csv.reader(f))]
 
-def load_csv_rows(csv_path: Path) -> List[Dict[str, str]]:
-    """Carga filas del CSV."""
-    with open(csv_path, "r", encoding="utf-8") as f:
-        return list(csv.DictReader(f))
 
+def copy_csv_to_staging(session, csv_path: Path, columns: List[str]) -> int:
+    """
+    Crea la tabla temporal con las columnas del CSV (todas texto) y la llena con COPY.
 
-def prepare_concesion_dict(row: Dict[str, str], now: datetime) -> Dict[str, Any]:
+    Returns:
+        int: filas copiadas
+    """
+    session.execute(text(
+        "CREATE TEMP TABLE temp_concesiones_csv ("
+        + ", ".join(f"{_quote_ident(c)} TEXT" for c in columns)
+        + ") ON COMMIT DROP"
+    ))
+
+    cursor = session.connection().connection.cursor()
+    with open(csv_path, "rb", buffering=COPY_BUFFER_SIZE) as f:
+        cursor.copy_expert(
+            f"""
+            COPY temp_concesiones_csv ({", ".join(_quote_ident(c) for c in columns)})
+            FROM STDIN WITH (FORMAT CSV, HEADER true)
+            """,
+            f,
+            size=COPY_BUFFER_SIZE
+        )
+    return cursor.rowcount
+
+
+def insert_from_staging(session, columns: List[str]) -> Tuple[int, int]:
     """
-    Prepara un diccionario de concesion para insercion.
+    Inserta en bdns.concesion las filas validas de la tabla temporal.
 
-    El JSON/CSV debe tener estos campos (del transform_concesiones.py):
+    El CSV debe tener estos campos (del transform_concesiones.py):
     - id: identificador unico de la concesion (id_concesion de la API BDNS)
     - codigo_bdns: UUID de la convocatoria (ya resuelto en transform)
     - id_beneficiario: UUID del beneficiario (ya resuelto en transform)
@@ -103,85 +149,82 @@ def prepare_concesion_dict(row: Dict[str, str], now: datetime) -> Dict[str, Any]
     - importe_equivalente: importe equivalente (ESG)
     - regimen_ayuda_id: UUID del regimen de ayuda (puede ser None)
     - regimen_tipo: tipo de regimen ('minimis', 'ayuda_estado', 'ordinaria', 'notificada') - REQUERIDO
-    - id_instrumento: UUID del instrumento (opcional)
 
-    NOTA: El campo 'id' (UUID) NO se especifica, se autogenera con uuid7() en la BD.
+    NOTA: El campo 'id' (UUID) de bdns.concesion se autogenera con uuid_generate_v7().
+
+    Returns:
+        Tuple[int, int]: (insertados, validos)
     """
-    return {
-        # id NO se incluye (se autogenera con uuid_generate_v7())
-        'id_concesion': safe_str(row.get('id')),  # String de la API BDNS
-        'convocatoria_id': row.get('codigo_bdns'),  # UUID (ya resuelto en transform)
-        'beneficiario_id': row.get('id_beneficiario'),  # UUID (ya resuelto en transform)
-        'fecha_concesion': safe_date(row.get('fecha_concesion')),
-        'regimen_tipo': safe_str(row.get('regimen_tipo')) or 'desconocido',  # ← REQUERIDO para particionado
-        'importe_nominal': safe_float(row.get('importe_nominal')),
-        'importe_equivalente': safe_float(row.get('importe_equivalente')),
-        'regimen_ayuda_id': row.get('regimen_ayuda_id'),  # UUID o None
-        # Campos de auditoria
-        'created_at': now,
-        'created_by': ETL_USER,
-    }
-
-
-def process_batch(batch: List[Dict[str, Any]], batch_num: int) -> Tuple[int, int, List[str]]:
+    present = set(columns)
+
+    def col(name: str) -> str:
+        return f"t.{_quote_ident(name)}" if name in present else "NULL::text"
+
+    result = session.execute(text(f"""
+        WITH v AS (
+            SELECT
+                {_sql_str(col('id'))} AS id_concesion,
+                {_sql_uuid(col('codigo_bdns'))} AS convocatoria_id,
+                {_sql_uuid(col('id_beneficiario'))} AS beneficiario_id,
+                {_sql_date(col('fecha_concesion'))} AS fecha_concesion,
+                COALESCE({_sql_str(col('regimen_tipo'))}, 'desconocido') AS regimen_tipo,
+                {_sql_float(col('importe_nominal'))} AS importe_nominal,
+                {_sql_float(col('importe_equivalente'))} AS importe_equivalente,
+                {_sql_uuid(col('regimen_ayuda_id'))} AS regimen_ayuda_id
+            FROM temp_concesiones_csv t
+        ),
+        validas AS (
+            SELECT * FROM v
+            WHERE id_concesion IS NOT NULL
+              AND convocatoria_id IS NOT NULL
+              AND beneficiario_id IS NOT NULL
+              AND fecha_concesion IS NOT NULL
+        ),
+        ins AS (
+            -- UNIQUE constraint: uq_concesion_id_fecha (id_concesion, fecha_concesion, regimen_tipo)
+            INSERT INTO bdns.concesion (
+                id, id_concesion, convocatoria_id, beneficiario_id,
+                fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
+                regimen_ayuda_id, created_at, created_by
+            )
+            SELECT
+                uuid_generate_v7(), id_concesion, convocatoria_id, beneficiario_id,
+                fecha_concesion, regimen_tipo, importe_nominal, importe_equivalente,
+                regimen_ayuda_id, NOW(), :created_by
+            FROM validas
+            ORDER BY regimen_tipo, fecha_concesion
+            ON CONFLICT ON CONSTRAINT uq_concesion_id_fecha DO NOTHING
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM ins), (SELECT count(*) FROM validas)
+    """), {"created_by": ETL_USER})
+
+    inserted, valid = result.one()
+    return inserted, valid
+
+
+def load_concesiones_csv(csv_path: Path) -> Tuple[int, int, int]:
     """
-    Procesa un batch de concesiones.
+    Carga el CSV completo en una sola transaccion.
 
     Returns:
-        Tuple[int, int, List[str]]: (insertados, fallidos, errores)
+        Tuple[int, int, int]: (total, insertados, incompletos)
     """
-    inserted = 0
-    failed = 0
-    errors = []
-
-    now = datetime.utcnow()
-    prepared = []
-
-    for row in batch:
-        try:
-            data = prepare_concesion_dict(row, now)
-            # Validar campos requeridos
-            if data['id_concesion'] and data['convocatoria_id'] and data['beneficiario_id'] and data['fecha_concesion'] and data['regimen_tipo']:
-                prepared.append(data)
-            else:
-                failed += 1
-                errors.append(f"Registro incompleto: id_concesion={data.get('id_concesion')}, regimen_tipo={data.get('regimen_tipo')}")
-        except Exception as e:
-            failed += 1
-            errors.append(f"Error preparando registro: {e}")
-
-    if not prepared:
-        return inserted, failed, errors
+    columns = read_header(csv_path)
 
-    try:
-        with get_session() as session:
-            # Usar INSERT ... ON CONFLICT DO NOTHING para evitar duplicados
-            # UNIQUE constraint: uq_concesion_id_fecha (id_concesion, fecha_concesion, regimen_tipo)
-            stmt = pg_insert(Concesion).values(prepared)
-            stmt = stmt.on_conflict_do_nothing(
-                constraint='uq_concesion_id_fecha'  # Usar el nombre del unique constraint
-            )
-            result = session.execute(stmt)
-            session.commit()
-            inserted = result.rowcount if hasattr(result, 'rowcount') else len(prepared)
-            logger.info(f"Batch {batch_num}: {inserted} insertados")
-    except IntegrityError as e:
-        failed += len(prepared)
-        errors.append(f"IntegrityError en batch {batch_num}: {e}")
-        logger.error(f"IntegrityError en batch {batch_num}: {e}")
-    except SQLAlchemyError as e:
-        failed += len(prepared)
-        errors.append(f"SQLAlchemyError en batch {batch_num}: {e}")
-        logger.error(f"SQLAlchemyError en batch {batch_num}: {e}")
+    with get_session() as session:
+        total = copy_csv_to_staging(session, csv_path, columns)
+        logger.info(f"COPY: {total:,} filas copiadas a temporal")
 
-    return inserted, failed, errors
+        inserted, valid = insert_from_staging(session, columns)
+        session.commit()
+
+    return total, inserted, total - valid
 
 
 def main():
     parser = argparse.ArgumentParser(description='Cargar concesiones a la BD')
     parser.add_argument('--year', type=int, required=True, help='Ano de las concesiones')
-    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Tamano del batch')
-    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='Numero de workers')
     parser.add_argument('--csv-path', type=str, help='Ruta al CSV (opcional)')
     args = parser.parse_args()
 
@@ -206,35 +249,13 @@ def main():
             sys.exit(1)
 
     logger.info(f"Cargando concesiones desde: {csv_path}")
-    logger.info(f"Batch size: {args.batch_size}, Workers: {args.workers}")
 
-    # Cargar filas
     start_time = datetime.now()
-    rows = load_csv_rows(csv_path)
-    total = len(rows)
-    logger.info(f"Total registros a procesar: {total:,}")
-
-    # Dividir en batches
-    batches = [rows[i:i + args.batch_size] for i in range(0, len(rows), args.batch_size)]
-    logger.info(f"Total batches: {len(batches)}")
-
-    # Procesar batches
-    total_inserted = 0
-    total_failed = 0
-    all_errors = []
-
-    # Procesamiento secuencial (mas seguro para BD)
-    for i, batch in enumerate(batches, 1):
-        inserted, failed, errors = process_batch(batch, i)
-        total_inserted += inserted
-        total_failed += failed
-        all_errors.extend(errors)
-
-        # Progreso cada 10 batches
-        if i % 10 == 0:
-            elapsed = (datetime.now() - start_time).total_seconds()
-            rate = (i * args.batch_size) / elapsed if elapsed > 0 else 0
-            logger.info(f"Progreso: {i}/{len(batches)} batches, {rate:.0f} reg/s")
+    try:
+        total, total_inserted, total_failed = load_concesiones_csv(csv_path)
+    except SQLAlchemyError as e:
+        logger.error(f"Error cargando {csv_path}: {e}")
+        return 1
 
     # Resumen
     elapsed = (datetime.now() - start_time).total_seconds()
@@ -243,14 +264,15 @@ def main():
     logger.info("=" * 60)
     logger.info(f"Total procesados: {total:,}")
     logger.info(f"Insertados:       {total_inserted:,}")
-    logger.info(f"Fallidos:         {total_failed:,}")
+    logger.info(f"Duplicados:       {total - total_failed - total_inserted:,}")
+    logger.info(f"Incompletos:      {total_failed:,}")
     logger.info(f"Tiempo:           {elapsed:.1f}s")
     logger.info(f"Velocidad:        {total / elapsed:.0f} reg/s")
 
-    if all_errors:
-        logger.warning(f"Errores ({len(all_errors)}):")
-        for err in all_errors[:10]:  # Solo primeros 10
-            logger.warning(f"  - {err}")
+    if total_failed:
+        logger.warning(
+            f"{total_failed:,} registros sin id, convocatoria, beneficiario o fecha validos"
+        )
 
     return 0 if total_failed == 0 else 1
 
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 """
 LOAD: Carga concesiones desde JSONL usando COPY nativo + INSERT/UPDATE con prioridad.
+
+El JSONL se envía desde este proceso con COPY FROM STDIN (no hace falta que
+el servidor PostgreSQL pueda leer el fichero) y todo el proceso corre en una
+única transacción.
 """
 
-import subprocess
-import re
 import logging
 import argparse
 from pathlib import Path
@@ -13,7 +15,8 @@ import sys
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from bdns_core.db.session import get_database_url
+from sqlalchemy import text
+from bdns_core.db.session import get_session
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,187 +24,254 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+COPY_BUFFER_SIZE = 1 << 20
 
-def generate_load_sql(jsonl_path: Path) -> str:
-    """Genera script SQL completo para cargar concesiones con lógica de prioridad."""
-    return f"""
-\\set ON_ERROR_STOP on
-
--- ============================================
--- 1. TABLA TEMPORAL CON JSONB
--- ============================================
-DROP TABLE IF EXISTS temp_concesiones_json;
+# ============================================
+# 1. TABLA TEMPORAL CON JSONB
+# ============================================
+CREATE_TEMP_JSON_SQL = """
 CREATE TEMP TABLE temp_concesiones_json (
     data JSONB NOT NULL
-);
+) ON COMMIT DROP
+"""
 
--- COPY del JSONL línea por línea
+# COPY del JSONL línea por línea. En CSV con comillas y delimitador que no
+# aparecen en JSON cada línea llega intacta (FORMAT text interpretaría los
+# escapes \ del propio JSON)
+COPY_JSON_SQL = r"""
 COPY temp_concesiones_json (data)
-FROM '{jsonl_path.absolute()}'
-WITH (FORMAT text);
-
--- ============================================
--- 2. CREAR TABLA TEMPORAL DESNORMALIZADA
--- ============================================
-DROP TABLE IF EXISTS temp_concesiones;
-CREATE TEMP TABLE temp_concesiones AS
-SELECT 
-    data->>'id_concesion' as id_concesion,
-    data->>'codigo_bdns' as codigo_bdns,
-    NULLIF(data->>'convocatoria_id', '')::UUID as convocatoria_id,
-    NULLIF(data->>'organo_id', '')::UUID as organo_id,
-    NULLIF(data->>'beneficiario_id', '')::UUID as beneficiario_id,
-    NULLIF(data->>'instrumento_id', '')::UUID as instrumento_id,
-    NULLIF(data->>'regimen_ayuda_id', '')::UUID as regimen_ayuda_id,
-    data->>'regimen_tipo' as regimen_tipo,
-    NULLIF(data->>'fecha_concesion', '')::DATE as fecha_concesion,
-    NULLIF(data->>'importe_nominal', '')::FLOAT as importe_nominal,
-    NULLIF(data->>'importe_equivalente', '')::FLOAT as importe_equivalente,
-    data->>'url_bases_reguladoras' as url_bases_reguladoras,
-    COALESCE((data->>'tiene_proyecto')::BOOLEAN, false) as tiene_proyecto,
+FROM STDIN WITH (FORMAT csv, QUOTE E'\x01', DELIMITER E'\x02')
+"""
+
+# ============================================
+# 2. CREAR TABLA TEMPORAL DESNORMALIZADA
+# ============================================
+# Una fila por id_concesion: la variante de mayor prioridad (sin prioridad
+# en _meta, la última: NULLS LAST).
+# jsonb_to_record recorre cada documento una sola vez y extrae todos los
+# campos como texto (mismo resultado que data->>'campo'); los casts se
+# hacen después.
+CREATE_TEMP_CONCESIONES_SQL = """
+CREATE TEMP TABLE temp_concesiones ON COMMIT DROP AS
+SELECT DISTINCT ON (r.id_concesion)
+    r.id_concesion,
+    r.codigo_bdns,
+    NULLIF(r.convocatoria_id, '')::UUID as convocatoria_id,
+    NULLIF(r.organo_id, '')::UUID as organo_id,
+    NULLIF(r.beneficiario_id, '')::UUID as beneficiario_id,
+    NULLIF(r.instrumento_id, '')::UUID as instrumento_id,
+    NULLIF(r.regimen_ayuda_id, '')::UUID as regimen_ayuda_id,
+    r.regimen_tipo,
+    NULLIF(r.fecha_concesion, '')::DATE as fecha_concesion,
+    NULLIF(r.importe_nominal, '')::FLOAT as importe_nominal,
+    NULLIF(r.importe_equivalente, '')::FLOAT as importe_equivalente,
+    r.url_bases_reguladoras,
+    COALESCE(r.tiene_proyecto::BOOLEAN, false) as tiene_proyecto,
     -- Campos enriquecidos
-    data->>'reglamento_descripcion' as reglamento_descripcion,
-    data->>'objetivo_descripcion' as objetivo_descripcion,
-    data->>'tipo_beneficiario' as tipo_beneficiario,
-    data->>'sector_actividad' as sector_actividad,
-    data->>'region' as region,
-    data->>'ayuda_estado_codigo' as ayuda_estado_codigo,
-    data->>'ayuda_estado_url' as ayuda_estado_url,
-    data->>'entidad' as entidad,
-    data->>'intermediario' as intermediario,
+    r.reglamento_descripcion,
+    r.objetivo_descripcion,
+    r.tipo_beneficiario,
+    r.sector_actividad,
+    r.region,
+    r.ayuda_estado_codigo,
+    r.ayuda_estado_url,
+    r.entidad,
+    r.intermediario,
     -- Prioridad para lógica de enriquecimiento
-    (data->'_meta'->>'prioridad')::INTEGER as prioridad
-FROM temp_concesiones_json;
-
-CREATE INDEX idx_temp_concesiones_id ON temp_concesiones(id_concesion);
-CREATE INDEX idx_temp_concesiones_prioridad ON temp_concesiones(id_concesion, prioridad DESC);
-
--- ============================================
--- 3. INSERT DE NUEVAS CONCESIONES (no existen)
--- ============================================
-INSERT INTO bdns.concesion (
-    id, id_concesion, convocatoria_id, beneficiario_id, organo_id,
-    instrumento_id, regimen_ayuda_id, regimen_tipo,
-    fecha_concesion, importe_nominal, importe_equivalente,
-    url_bases_reguladoras, tiene_proyecto,
-    reglamento_descripcion, objetivo_descripcion, tipo_beneficiario,
-    sector_actividad, region, ayuda_estado_codigo, ayuda_estado_url,
-    entidad, intermediario,
-    created_at, created_by
+    (r._meta->>'prioridad')::INTEGER as prioridad
+FROM temp_concesiones_json j
+CROSS JOIN LATERAL jsonb_to_record(j.data) AS r(
+    id_concesion TEXT,
+    codigo_bdns TEXT,
+    convocatoria_id TEXT,
+    organo_id TEXT,
+    beneficiario_id TEXT,
+    instrumento_id TEXT,
+    regimen_ayuda_id TEXT,
+    regimen_tipo TEXT,
+    fecha_concesion TEXT,
+    importe_nominal TEXT,
+    importe_equivalente TEXT,
+    url_bases_reguladoras TEXT,
+    tiene_proyecto TEXT,
+    reglamento_descripcion TEXT,
+    objetivo_descripcion TEXT,
+    tipo_beneficiario TEXT,
+    sector_actividad TEXT,
+    region TEXT,
+    ayuda_estado_codigo TEXT,
+    ayuda_estado_url TEXT,
+    entidad TEXT,
+    intermediario TEXT,
+    _meta JSONB
+)
+ORDER BY r.id_concesion, prioridad DESC NULLS LAST
+"""
+
+# Se crea tras poblar la tabla; su columna inicial cubre también las búsquedas
+# por id_concesion
+CREATE_TEMP_INDEXES_SQL = [
+    "CREATE INDEX idx_temp_concesiones_prioridad ON temp_concesiones(id_concesion, prioridad DESC NULLS LAST)",
+]
+
+# Prioridad de cada regimen_tipo (la misma que cada extract fija en
+# _meta.prioridad); un regimen no listado vale 0
+PRIORIDAD_REGIMEN = {
+    "minimis": 4,
+    "ayudas_estado": 3,
+    "partidos_politicos": 2,
+    "ordinaria": 1,
+}
+
+
+def _sql_prioridad(col: str) -> str:
+    """CASE que traduce regimen_tipo a su prioridad."""
+    ramas = " ".join(f"WHEN '{tipo}' THEN {nivel}" for tipo, nivel in PRIORIDAD_REGIMEN.items())
+    return f"CASE {col} {ramas} ELSE 0 END"
+
+
+# ============================================
+# 3. INSERT DE NUEVAS + UPDATE DE EXISTENTES
+# ============================================
+# Un único statement: cada CTE devuelve una fila por registro afectado y los
+# contadores se leen con un solo fetch. Ambos CTEs ven la misma instantánea,
+# así que el UPDATE solo enriquece concesiones que ya existían (las nuevas
+# entran directamente con su variante de mayor prioridad).
+#
+# INSERT: anti-join contra idx_concesion_id_concesion
+# (migrations/003_add_concesion_id_concesion_index.sql)
+#
+# UPDATE: solo si la nueva tiene mayor prioridad que la existente
+LOAD_SQL = f"""
+WITH ins AS (
+    INSERT INTO bdns.concesion (
+        id, id_concesion, convocatoria_id, beneficiario_id, organo_id,
+        instrumento_id, regimen_ayuda_id, regimen_tipo,
+        fecha_concesion, importe_nominal, importe_equivalente,
+        url_bases_reguladoras, tiene_proyecto,
+        reglamento_descripcion, objetivo_descripcion, tipo_beneficiario,
+        sector_actividad, region, ayuda_estado_codigo, ayuda_estado_url,
+        entidad, intermediario,
+        created_at, created_by
+    )
+    SELECT 
+        uuid_generate_v7(),
+        t.id_concesion,
+        t.convocatoria_id,
+        t.beneficiario_id,
+        t.organo_id,
+        t.instrumento_id,
+        t.regimen_ayuda_id,
+        t.regimen_tipo,
+        t.fecha_concesion,
+        t.importe_nominal,
+        t.importe_equivalente,
+        t.url_bases_reguladoras,
+        t.tiene_proyecto,
+        t.reglamento_descripcion,
+        t.objetivo_descripcion,
+        t.tipo_beneficiario,
+        t.sector_actividad,
+        t.region,
+        t.ayuda_estado_codigo,
+        t.ayuda_estado_url,
+        t.entidad,
+        t.intermediario,
+        NOW(),
+        'etl_loader'
+    FROM temp_concesiones t
+    LEFT JOIN bdns.concesion c ON c.id_concesion = t.id_concesion
+    WHERE c.id_concesion IS NULL
+    RETURNING 1
+),
+upd AS (
+    UPDATE bdns.concesion c
+    SET 
+        regimen_ayuda_id = t.regimen_ayuda_id,
+        regimen_tipo = t.regimen_tipo,
+        -- Enriquecer campos que no teníamos
+        reglamento_descripcion = COALESCE(t.reglamento_descripcion, c.reglamento_descripcion),
+        objetivo_descripcion = COALESCE(t.objetivo_descripcion, c.objetivo_descripcion),
+        tipo_beneficiario = COALESCE(t.tipo_beneficiario, c.tipo_beneficiario),
+        sector_actividad = COALESCE(t.sector_actividad, c.sector_actividad),
+        region = COALESCE(t.region, c.region),
+        ayuda_estado_codigo = COALESCE(t.ayuda_estado_codigo, c.ayuda_estado_codigo),
+        ayuda_estado_url = COALESCE(t.ayuda_estado_url, c.ayuda_estado_url),
+        entidad = COALESCE(t.entidad, c.entidad),
+        intermediario = COALESCE(t.intermediario, c.intermediario),
+        -- Actualizar si los nuevos son más específicos
+        organo_id = COALESCE(t.organo_id, c.organo_id),
+        instrumento_id = COALESCE(t.instrumento_id, c.instrumento_id),
+        updated_at = NOW()
+    FROM temp_concesiones t
+    WHERE c.id_concesion = t.id_concesion
+      AND t.prioridad > {_sql_prioridad("c.regimen_tipo")}
+      -- Saltar filas en las que el SET no cambiaría nada (evita reescribir
+      -- la tupla y generar WAL sin aportar datos)
+      AND (
+        t.regimen_ayuda_id, t.regimen_tipo,
+        COALESCE(t.reglamento_descripcion, c.reglamento_descripcion),
+        COALESCE(t.objetivo_descripcion, c.objetivo_descripcion),
+        COALESCE(t.tipo_beneficiario, c.tipo_beneficiario),
+        COALESCE(t.sector_actividad, c.sector_actividad),
+        COALESCE(t.region, c.region),
+        COALESCE(t.ayuda_estado_codigo, c.ayuda_estado_codigo),
+        COALESCE(t.ayuda_estado_url, c.ayuda_estado_url),
+        COALESCE(t.entidad, c.entidad),
+        COALESCE(t.intermediario, c.intermediario),
+        COALESCE(t.organo_id, c.organo_id),
+        COALESCE(t.instrumento_id, c.instrumento_id)
+      ) IS DISTINCT FROM (
+        c.regimen_ayuda_id, c.regimen_tipo,
+        c.reglamento_descripcion,
+        c.objetivo_descripcion,
+        c.tipo_beneficiario,
+        c.sector_actividad,
+        c.region,
+        c.ayuda_estado_codigo,
+        c.ayuda_estado_url,
+        c.entidad,
+        c.intermediario,
+        c.organo_id,
+        c.instrumento_id
+      )
+    RETURNING 1
 )
-SELECT 
-    uuid_generate_v7(),
-    t.id_concesion,
-    t.convocatoria_id,
-    t.beneficiario_id,
-    t.organo_id,
-    t.instrumento_id,
-    t.regimen_ayuda_id,
-    t.regimen_tipo,
-    t.fecha_concesion,
-    t.importe_nominal,
-    t.importe_equivalente,
-    t.url_bases_reguladoras,
-    t.tiene_proyecto,
-    t.reglamento_descripcion,
-    t.objetivo_descripcion,
-    t.tipo_beneficiario,
-    t.sector_actividad,
-    t.region,
-    t.ayuda_estado_codigo,
-    t.ayuda_estado_url,
-    t.entidad,
-    t.intermediario,
-    NOW(),
-    'etl_loader'
-FROM temp_concesiones t
-WHERE NOT EXISTS (
-    SELECT 1 FROM bdns.concesion c WHERE c.id_concesion = t.id_concesion
-);
-
--- Contar insertadas
-SELECT COUNT(*) as insertadas FROM bdns.concesion WHERE created_by = 'etl_loader' AND created_at > NOW() - INTERVAL '1 minute';
-
--- ============================================
--- 4. UPDATE DE EXISTENTES (enriquecimiento con mayor prioridad)
--- ============================================
--- Solo actualizar si la nueva tiene mayor prioridad que la existente
-UPDATE bdns.concesion c
-SET 
-    regimen_ayuda_id = t.regimen_ayuda_id,
-    regimen_tipo = t.regimen_tipo,
-    -- Enriquecer campos que no teníamos
-    reglamento_descripcion = COALESCE(t.reglamento_descripcion, c.reglamento_descripcion),
-    objetivo_descripcion = COALESCE(t.objetivo_descripcion, c.objetivo_descripcion),
-    tipo_beneficiario = COALESCE(t.tipo_beneficiario, c.tipo_beneficiario),
-    sector_actividad = COALESCE(t.sector_actividad, c.sector_actividad),
-    region = COALESCE(t.region, c.region),
-    ayuda_estado_codigo = COALESCE(t.ayuda_estado_codigo, c.ayuda_estado_codigo),
-    ayuda_estado_url = COALESCE(t.ayuda_estado_url, c.ayuda_estado_url),
-    entidad = COALESCE(t.entidad, c.entidad),
-    intermediario = COALESCE(t.intermediario, c.intermediario),
-    -- Actualizar si los nuevos son más específicos
-    organo_id = COALESCE(t.organo_id, c.organo_id),
-    instrumento_id = COALESCE(t.instrumento_id, c.instrumento_id),
-    updated_at = NOW()
-FROM temp_concesiones t
-WHERE c.id_concesion = t.id_concesion
-  AND t.prioridad > CASE c.regimen_tipo
-    WHEN 'minimis' THEN 4
-    WHEN 'ayudas_estado' THEN 3
-    WHEN 'partidos_politicos' THEN 2
-    WHEN 'ordinaria' THEN 1
-    ELSE 0
-  END;
-
--- Contar actualizadas
-SELECT COUNT(*) as actualizadas FROM bdns.concesion WHERE updated_at > NOW() - INTERVAL '1 minute' AND created_by = 'etl_loader';
-
--- ============================================
--- 5. ESTADÍSTICAS FINALES
--- ============================================
-SELECT 
-    (SELECT COUNT(*) FROM temp_concesiones) as total_en_jsonl,
-    (SELECT COUNT(*) FROM bdns.concesion WHERE created_by = 'etl_loader' AND created_at > NOW() - INTERVAL '10 seconds') as total_insertadas,
-    (SELECT COUNT(DISTINCT id_concesion) FROM temp_concesiones) as concesiones_unicas;
+SELECT
+    (SELECT COUNT(*) FROM ins) AS insertadas,
+    (SELECT COUNT(*) FROM upd) AS actualizadas,
+    (SELECT COUNT(*) FROM temp_concesiones) AS concesiones_unicas
 """
 
 
 def load_concesiones_jsonl(jsonl_path: Path) -> dict:
-    """Carga concesiones via psql COPY con INSERT/UPDATE."""
+    """Carga concesiones via COPY FROM STDIN con INSERT/UPDATE."""
     if not jsonl_path.exists():
         logger.error(f"JSONL no encontrado: {jsonl_path}")
         raise FileNotFoundError(jsonl_path)
     
-    db_url = get_database_url()
-    sql = generate_load_sql(jsonl_path)
-    
     logger.info(f"Cargando concesiones desde {jsonl_path.name}")
     
-    result = subprocess.run(
-        ["psql", db_url, "-v", "ON_ERROR_STOP=1", "-c", sql],
-        capture_output=True,
-        text=True
-    )
-    
-    if result.returncode != 0:
-        logger.error(f"psql falló: {result.stderr}")
-        raise RuntimeError(result.stderr)
-    
-    # Parsear estadísticas
-    output = result.stdout + result.stderr
-    
     stats = {}
-    patterns = {
-        "insertadas": r'insertadas\s*\n\s*(\d+)',
-        "actualizadas": r'actualizadas\s*\n\s*(\d+)',
-        "total_en_jsonl": r'total_en_jsonl\s*\n\s*(\d+)',
-        "concesiones_unicas": r'concesiones_unicas\s*\n\s*(\d+)'
-    }
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, output)
-        stats[key] = int(match.group(1)) if match else 0
+    with get_session() as session:
+        session.execute(text(CREATE_TEMP_JSON_SQL))
+        
+        cursor = session.connection().connection.cursor()
+        with open(jsonl_path, "rb", buffering=COPY_BUFFER_SIZE) as f:
+            cursor.copy_expert(COPY_JSON_SQL, f, size=COPY_BUFFER_SIZE)
+        stats["total_en_jsonl"] = cursor.rowcount
+        
+        # Tabla desnormalizada + índices en un solo envío (sin parámetros, el
+        # servidor ejecuta las sentencias en orden): un roundtrip en vez de uno
+        # por sentencia
+        session.execute(text(";\n".join([CREATE_TEMP_CONCESIONES_SQL, *CREATE_TEMP_INDEXES_SQL])))
+        
+        stats.update(zip(
+            ("insertadas", "actualizadas", "concesiones_unicas"),
+            session.execute(text(LOAD_SQL)).one()
+        ))
+        
+        session.commit()
     
     logger.info(f"Carga completada:")
     logger.info(f"  - En JSONL: {stats.get('total_en_jsonl', 0)}")
@@ -216,4 +286,4 @@ if __name__ == "__main__":
     parser.add_argument("--jsonl", required=True, help="Archivo JSONL de concesiones transformadas")
     args = parser.parse_args()
     
-    load_concesiones_jsonl(Path(args.jsonl))
\ No newline at end of file
+    load_concesiones_jsonl(Path(args.jsonl))
@@ -9,16 +9,25 @@ Salida:   seeding/concesiones/data/jsonl/transformed/concesiones_{year}.jsonl
           seeding/concesiones/data/jsonl/transformed/beneficiarios_pendientes_{year}.jsonl
 """
 
-import json
+import os
+import shutil
 import logging
 import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+
+import orjson
+from sqlalchemy import String, cast, literal, select, union_all
 
 from bdns_core.db.session import get_session
 from bdns_core.db.models import Beneficiario, Convocatoria, Instrumento, RegimenAyuda, Organo
 from bdns_core.db.utils import normalizar
 
+# Los mismos nombres de órgano/instrumento se repiten en lookups y registros
+normalizar = lru_cache(maxsize=65536)(normalizar)
+
 MODULO = "transform_concesiones"
 
 # Rutas
@@ -26,6 +35,12 @@ DATA_DIR = Path(__file__).resolve().parent.parent / "data" / "jsonl"
 TRANSFORMED_DIR = DATA_DIR / "transformed"
 TRANSFORMED_DIR.mkdir(parents=True, exist_ok=True)
 
+COPY_BUFFER_SIZE = 1 << 20  # Bytes por bloque al concatenar shards
+
+# Valores de texto que cuentan como verdadero en tiene_proyecto (las
+# grafías habituales se aceptan sin pasar por lower())
+_VERDADEROS = frozenset({"true", "1", "s", "si", "True", "TRUE", "S", "SI", "Si"})
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
@@ -37,63 +52,89 @@ def log(msg):
     logger.info(f"[{MODULO}] {msg}")
 
 
+class ResolucionCache(dict):
+    """
+    Valor crudo -> UUID (o None), resuelto bajo demanda contra un lookup
+    normalizado.
+
+    Cada valor distinto se normaliza una sola vez; los siguientes accesos
+    son una única consulta al dict.
+    """
+
+    def __init__(self, tabla: dict):
+        super().__init__()
+        self.tabla = tabla
+
+    def __missing__(self, valor: str) -> str | None:
+        resuelto = self[valor] = self.tabla.get(normalizar(valor))
+        return resuelto
+
+
+def _lookup_select(fuente: str, clave, id_col):
+    """SELECT (fuente, clave, id) de un lookup, con clave e id como texto."""
+    return select(
+        literal(fuente).label("fuente"),
+        cast(clave, String).label("clave"),
+        cast(id_col, String).label("id"),
+    ).where(clave.isnot(None))
+
+
 def cargar_lookups(session) -> dict:
-    """Carga lookups de BD para resolver FKs."""
-    # Convocatorias: codigo_bdns (str) -> UUID
-    convocatorias = {}
-    for row in session.query(Convocatoria.codigo_bdns, Convocatoria.id).all():
-        if row[0]:
-            convocatorias[str(row[0])] = str(row[1])
-
-    # Beneficiarios: nif -> UUID
-    beneficiarios = {}
-    for row in session.query(Beneficiario.nif, Beneficiario.id).all():
-        if row[0]:
-            beneficiarios[row[0]] = str(row[1])
-
-    # Instrumentos: descripcion_norm -> UUID
-    instrumentos = {}
-    for row in session.query(Instrumento.descripcion, Instrumento.id).all():
-        if row[0]:
-            instrumentos[normalizar(row[0])] = str(row[1])
-
-    # Regimenes: descripcion_norm -> UUID
-    regimenes = {}
-    for row in session.query(RegimenAyuda.descripcion_norm, RegimenAyuda.id).all():
-        if row[0]:
-            regimenes[row[0]] = str(row[1])
-
-    # Organos: descripcion_norm -> UUID
-    organos = {}
-    for row in session.query(Organo.descripcion, Organo.id).all():
-        if row[0]:
-            organos[normalizar(row[0])] = str(row[1])
+    """
+    Carga lookups de BD para resolver FKs.
+
+    Las cinco tablas se leen en una sola consulta UNION ALL (un único
+    roundtrip) y se reparten por la columna fuente.
+    """
+    query = union_all(
+        # Convocatorias: codigo_bdns (str) -> UUID
+        _lookup_select("convocatorias", Convocatoria.codigo_bdns, Convocatoria.id),
+        # Beneficiarios: nif -> UUID
+        _lookup_select("beneficiarios", Beneficiario.nif, Beneficiario.id),
+        # Instrumentos: descripcion_norm -> UUID
+        _lookup_select("instrumentos", Instrumento.descripcion_norm, Instrumento.id),
+        # Regimenes: descripcion_norm -> UUID
+        _lookup_select("regimenes", RegimenAyuda.descripcion_norm, RegimenAyuda.id),
+        # Organos: descripcion -> UUID (se normaliza abajo)
+        _lookup_select("organos", Organo.descripcion, Organo.id),
+    )
+
+    tablas = {
+        "convocatorias": {},
+        "beneficiarios": {},
+        "instrumentos": {},
+        "regimenes": {},
+        "organos": {},
+    }
+    for fuente, clave, id_ in session.execute(query):
+        if clave:
+            if fuente == "organos":
+                clave = normalizar(clave)
+            tablas[fuente][clave] = id_
 
     return {
-        "convocatorias": convocatorias,
-        "beneficiarios": beneficiarios,
-        "instrumentos": instrumentos,
-        "regimenes": regimenes,
-        "organos": organos,
+        **tablas,
+        # Resolución por valor crudo de los lookups normalizados
+        "instrumentos_por_valor": ResolucionCache(tablas["instrumentos"]),
+        "regimenes_por_valor": ResolucionCache(tablas["regimenes"]),
+        "organos_por_valor": ResolucionCache(tablas["organos"]),
     }
 
 
-def resolver_organo_id(record: dict, organos: dict) -> str | None:
+def resolver_organo_id(record: dict, organos: ResolucionCache) -> str | None:
     """Intenta resolver el organo_id desde los campos del registro."""
     # Intentar por niveles (ordinarias y partidos_politicos)
-    for campo in ["organo_nivel3", "organo_nivel2", "organo_nivel1"]:
+    for campo in ("organo_nivel3", "organo_nivel2", "organo_nivel1"):
         valor = record.get(campo)
         if valor:
-            norm = normalizar(valor)
-            if norm in organos:
-                return organos[norm]
+            organo_id = organos[valor]
+            if organo_id:
+                return organo_id
 
     # Intentar por organo_convocante (minimis y ayudas_estado)
     organo_conv = record.get("organo_convocante")
     if organo_conv:
-        norm = normalizar(organo_conv)
-        if norm in organos:
-            return organos[norm]
+        return organos[organo_conv]
 
     return None
 
@@ -128,19 +169,19 @@ def transformar_registro(record: dict, lookups: dict) -> tuple[dict | None, dict
         }
 
     # Resolver organo_id
-    organo_id = resolver_organo_id(record, lookups["organos"])
+    organo_id = resolver_organo_id(record, lookups["organos_por_valor"])
 
     # Resolver instrumento_id
     instrumento = record.get("instrumento_descripcion")
     instrumento_id = None
     if instrumento:
-        instrumento_id = lookups["instrumentos"].get(normalizar(instrumento))
+        instrumento_id = lookups["instrumentos_por_valor"][instrumento]
 
     # Resolver regimen_ayuda_id
     regimen_desc = record.get("regimen_descripcion")
     regimen_ayuda_id = None
     if regimen_desc:
-        regimen_ayuda_id = lookups["regimenes"].get(normalizar(regimen_desc))
+        regimen_ayuda_id = lookups["regimenes_por_valor"][regimen_desc]
 
     # Parsear fecha
     fecha = record.get("fecha_concesion")
@@ -167,7 +208,7 @@ def transformar_registro(record: dict, lookups: dict) -> tuple[dict | None, dict
     # Parsear booleano
     tiene_proyecto = record.get("tiene_proyecto")
     if isinstance(tiene_proyecto, str):
-        tiene_proyecto = tiene_proyecto.lower() in ("true", "1", "s", "si")
+        tiene_proyecto = tiene_proyecto in _VERDADEROS or tiene_proyecto.lower() in _VERDADEROS
     elif not isinstance(tiene_proyecto, bool):
         tiene_proyecto = False
 
@@ -201,6 +242,53 @@ def transformar_registro(record: dict, lookups: dict) -> tuple[dict | None, dict
     return resultado, beneficiario_pendiente
 
 
+# Lookups de solo lectura instalados en cada proceso worker (ver _init_worker)
+_lookups = None
+
+
+def _init_worker(lookups: dict):
+    """Inicializador del pool: recibe los lookups una vez por proceso."""
+    global _lookups
+    _lookups = lookups
+
+
+def procesar_jsonl(jsonl_file: Path, shard_path: Path) -> tuple[int, int, int, dict]:
+    """
+    Transforma un JSONL crudo y escribe el resultado en su propio shard.
+
+    Returns:
+        (leidos, transformados, saltados, beneficiarios_pendientes)
+    """
+    count_in = 0
+    count_out = 0
+    skipped = 0
+    pendientes = {}  # nif -> {nif, nombre}
+
+    with open(jsonl_file, "rb") as f_in, open(shard_path, "wb") as f_out:
+        for line in f_in:
+            line = line.strip()
+            if not line:
+                continue
+            count_in += 1
+
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                skipped += 1
+                continue
+
+            resultado, beneficiario_pend = transformar_registro(record, _lookups)
+
+            if resultado:
+                f_out.write(orjson.dumps(resultado) + b"\n")
+                count_out += 1
+
+            if beneficiario_pend and beneficiario_pend["nif"]:
+                pendientes[beneficiario_pend["nif"]] = beneficiario_pend
+
+    return count_in, count_out, skipped, pendientes
+
+
 def main():
     parser = argparse.ArgumentParser(description=f"{MODULO}: Transforma JSONL crudos a formato de carga.")
     parser.add_argument("--year", type=int, required=True, help="Ejercicio a procesar")
@@ -234,48 +322,41 @@ def main():
     total_skipped = 0
     beneficiarios_pendientes = {}  # nif -> {nif, nombre}
 
+    # Cada JSONL se transforma en un proceso aparte (el trabajo es CPU:
+    # parseo JSON y normalización) sobre su propio shard; los shards se
+    # concatenan después en el orden original de los ficheros.
     out_path = TRANSFORMED_DIR / f"concesiones_{year}.jsonl"
-    with open(out_path, "w", encoding="utf-8") as f_out:
-        for jsonl_file in jsonl_files:
-            count_in = 0
-            count_out = 0
-            log(f"Procesando {jsonl_file.name}...")
-
-            with open(jsonl_file, "r", encoding="utf-8") as f_in:
-                for line in f_in:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    count_in += 1
-
-                    try:
-                        record = json.loads(line)
-                    except json.JSONDecodeError:
-                        total_skipped += 1
-                        continue
-
-                    resultado, beneficiario_pend = transformar_registro(record, lookups)
-
-                    if resultado:
-                        f_out.write(json.dumps(resultado, ensure_ascii=False) + "\n")
-                        count_out += 1
-
-                    if beneficiario_pend and beneficiario_pend["nif"]:
-                        beneficiarios_pendientes[beneficiario_pend["nif"]] = beneficiario_pend
-
+    shards = [TRANSFORMED_DIR / f"{out_path.name}.{i}.part" for i in range(len(jsonl_files))]
+    workers = min(len(jsonl_files), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(lookups,)) as pool:
+        futures = [
+            pool.submit(procesar_jsonl, jsonl_file, shard)
+            for jsonl_file, shard in zip(jsonl_files, shards)
+        ]
+        for jsonl_file, future in zip(jsonl_files, futures):
+            count_in, count_out, skipped, pendientes = future.result()
             total_in += count_in
             total_out += count_out
+            total_skipped += skipped
+            beneficiarios_pendientes.update(pendientes)
             log(f"  {jsonl_file.name}: {count_in} leidos -> {count_out} transformados")
 
+    with open(out_path, "wb") as f_out:
+        for shard in shards:
+            with open(shard, "rb") as f_shard:
+                shutil.copyfileobj(f_shard, f_out, COPY_BUFFER_SIZE)
+            shard.unlink()
+
     log(f"Total: {total_in} leidos, {total_out} transformados, {total_skipped} saltados")
     log(f"Salida: {out_path}")
 
     # Guardar beneficiarios pendientes
     if beneficiarios_pendientes:
         ben_path = TRANSFORMED_DIR / f"beneficiarios_pendientes_{year}.jsonl"
-        with open(ben_path, "w", encoding="utf-8") as f:
+        with open(ben_path, "wb") as f:
             for ben in beneficiarios_pendientes.values():
-                f.write(json.dumps(ben, ensure_ascii=False) + "\n")
+                f.write(orjson.dumps(ben) + b"\n")
         log(f"Beneficiarios pendientes: {len(beneficiarios_pendientes)} -> {ben_path}")
 
     return 0
@@ -1,51 +1,136 @@
 # seeding/convocatorias/extract/extract_convocatorias.py
 
 
-import json
 import time
+import random
+import threading
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 RUTA_RAW = Path(__file__).resolve().parent.parent.parent / "data" / "json" / "convocatorias" / "raw"
 RUTA_RAW.mkdir(parents=True, exist_ok=True)
 
+# ETag de la última respuesta 200 por código: se envía como If-None-Match y
+# un 304 (sin cambios en el servidor) no se vuelve a descargar. El cuerpo se
+# guarda junto al ETag (RUTA_CACHE/<codigo>.json) para reemitirlo en la
+# salida; ambos se anotan solo después de escribir el registro
+RUTA_ETAGS = RUTA_RAW / ".etags.json"
+RUTA_CACHE = RUTA_RAW / ".cache"
+_etags: dict[str, str] = {}
+
 # Rate limiting: máximo ~5 req/s compartido entre workers
-_REQUEST_DELAY = 0.2  # segundos entre peticiones por worker
+_REQUESTS_PER_SECOND = 5
 _MAX_RETRIES = 5
 _BACKOFF_BASE = 2  # segundos base para backoff exponencial
 
+# Sesión HTTP compartida por los workers: reutiliza las conexiones TCP/TLS
+# (keep-alive) en lugar de abrir una por convocatoria y pide respuesta
+# comprimida. El pool se dimensiona en main() según el número de workers.
+_session = requests.Session()
+_session.headers.update({"Accept-Encoding": "gzip"})
+
+
+class _TokenBucket:
+    """Limitador global de peticiones compartido por todos los workers.
+
+    Un worker solo espera cuando el cubo está vacío, en lugar de dormir
+    tras cada respuesta.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_bucket = _TokenBucket(rate=_REQUESTS_PER_SECOND, capacity=_REQUESTS_PER_SECOND)
+
+
+def _espera_429(r: requests.Response, attempt: int) -> float:
+    """Segundos a esperar tras un 429: Retry-After si viene, si no backoff exponencial, más jitter."""
+    retry_after = r.headers.get("Retry-After") if r is not None else None
+    try:
+        wait = float(retry_after)
+    except (TypeError, ValueError):
+        wait = _BACKOFF_BASE * (2 ** attempt)
+    return wait + random.uniform(0, 0.5)
+
+
+def _cargar_etags():
+    if RUTA_ETAGS.exists():
+        _etags.update(orjson.loads(RUTA_ETAGS.read_bytes()))
+
+def _guardar_etags():
+    RUTA_ETAGS.write_bytes(orjson.dumps(_etags))
+
+def _ruta_cache(codigo: str) -> Path:
+    return RUTA_CACHE / f"{codigo}.json"
+
+def _get_convocatoria(url: str, codigo: str):
+    _bucket.acquire()
+    # Sin cuerpo en caché no se puede aprovechar un 304: petición completa
+    usar_etag = codigo in _etags and _ruta_cache(codigo).exists()
+    headers = {"If-None-Match": _etags[codigo]} if usar_etag else {}
+    return _session.get(url, timeout=60, headers=headers)
+
+def _resultado(r: requests.Response, codigo: str):
+    if r.status_code == 304:
+        return orjson.loads(_ruta_cache(codigo).read_bytes()), None
+    data = r.json()
+    return [data] if isinstance(data, dict) else data, r.headers.get("ETag")
 
 def fetch_convocatoria(codigo: str):
     """Descarga el detalle de una convocatoria por su código BDNS.
 
     La API devuelve el objeto convocatoria directamente (no envuelto en lista).
-    Retorna una lista con un solo elemento para mantener compatibilidad con
-    el patrón resultados.extend(result) del caller.
+    Retorna (lista de convocatorias, ETag nuevo o None). Si el servidor
+    responde 304 (sin cambios desde el ETag guardado) la lista sale del
+    cuerpo en caché. El ETag no se anota aquí: lo hace el caller tras
+    escribir el registro (ver _anotar_etag).
     """
     url = f"https://www.infosubvenciones.es/bdnstrans/api/convocatorias?numConv={codigo}"
     for attempt in range(_MAX_RETRIES):
         try:
-            r = requests.get(url, timeout=60)
+            r = _get_convocatoria(url, codigo)
             if r.status_code == 429:
-                wait = _BACKOFF_BASE * (2 ** attempt)
-                time.sleep(wait)
+                time.sleep(_espera_429(r, attempt))
                 continue
             r.raise_for_status()
-            time.sleep(_REQUEST_DELAY)
-            data = r.json()
-            return [data] if isinstance(data, dict) else data
+            return _resultado(r, codigo)
         except requests.exceptions.HTTPError as e:
             if e.response is not None and e.response.status_code == 429:
-                wait = _BACKOFF_BASE * (2 ** attempt)
-                time.sleep(wait)
+                time.sleep(_espera_429(e.response, attempt))
                 continue
             raise
     # Último intento sin capturar
-    r = requests.get(url, timeout=60)
+    r = _get_convocatoria(url, codigo)
     r.raise_for_status()
-    data = r.json()
-    return [data] if isinstance(data, dict) else data
+    return _resultado(r, codigo)
+
+def _anotar_etag(codigo: str, items: list, etag):
+    """Guarda el cuerpo en caché y el ETag, una vez escrito el registro."""
+    if not etag:
+        return
+    RUTA_CACHE.mkdir(parents=True, exist_ok=True)
+    _ruta_cache(codigo).write_bytes(orjson.dumps(items))
+    _etags[codigo] = etag
 
 def main(year: int, mes: int, tipo: str, workers: int):
     # aquí normalmente sacarías los códigos desde la BD
@@ -55,16 +140,36 @@ def main(year: int, mes: int, tipo: str, workers: int):
     if not codigos:
         return
 
-    resultados = []
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        futures = [pool.submit(fetch_convocatoria, c) for c in codigos]
-        for f in as_completed(futures):
-            resultados.extend(f.result())
+    _session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+    _cargar_etags()
+
+    # NDJSON escrito según llega cada respuesta: no se acumula la lista
+    # completa en memoria. Se escribe en un .tmp que solo sustituye a la
+    # salida anterior si la extracción termina; un fallo a mitad la conserva
+    out = RUTA_RAW / f"raw_convocatorias_{tipo}_{year}_{mes:02d}.jsonl"
+    tmp = out.with_suffix(".jsonl.tmp")
+    escritas = 0
+    try:
+        with open(tmp, "wb") as f_out, ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_convocatoria, c): c for c in codigos}
+            for f in as_completed(futures):
+                items, etag = f.result()
+                for item in items:
+                    f_out.write(orjson.dumps(item) + b"\n")
+                    escritas += 1
+                f_out.flush()
+                _anotar_etag(futures[f], items, etag)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        _guardar_etags()
 
-    if resultados:
-        out = RUTA_RAW / f"raw_convocatorias_{tipo}_{year}_{mes:02d}.json"
-        with open(out, "w", encoding="utf-8") as f:
-            json.dump(resultados, f, ensure_ascii=False, indent=2)
+    if escritas:
+        tmp.replace(out)
+    else:
+        tmp.unlink()
+        out.unlink(missing_ok=True)
 
 if __name__ == "__main__":
     import argparse
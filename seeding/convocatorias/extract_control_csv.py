@@ -1,103 +1,150 @@
 # extract_control_csv.py
 # Genera o actualiza el CSV de control de convocatorias por ejercicio y tipo. Unifica en uno anual y borra los mensuales.
 
+import math
 import time
+import random
+import threading
 import requests
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
 TIPOS = ["C", "A", "L", "O"]
 
+# Columnas del CSV de control, en orden
+CAMPOS_CONTROL = [
+    "codigo_bdns", "fecha_recepcion", "tipo_administracion",
+    "status", "last_error", "last_attempt", "retries"
+]
+
 _MAX_RETRIES = 5
 _BACKOFF_BASE = 2  # segundos base para backoff exponencial
+_PAGE_SIZE = 10000
+_MAX_PAGINAS_EN_PARALELO = 4
+
+# Peticiones en vuelo contra la API, compartido entre tipos y páginas
+_en_vuelo = threading.Semaphore(_MAX_PAGINAS_EN_PARALELO)
+
+# Sesión HTTP reutilizada entre páginas y tipos: mantiene viva la conexión
+# TCP/TLS con infosubvenciones.es en lugar de abrir una por petición
+_session = requests.Session()
+_session.headers.update({"Accept-Encoding": "gzip"})
 
 def log(msg, level="INFO", modulo="extract_control_csv"):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{ts}] [{modulo}] [{level}] {msg}")
 
-def fetch_codigos_bdns(year, tipo, csv_path):
-    url = "https://www.infosubvenciones.es/bdnstrans/api/convocatorias/busqueda"
-    page = 0
-    page_size = 10000
-    total_esperado = None
+def leer_control(csv_path, filas):
+    """Añade a `filas` (codigo_bdns -> lista en orden CAMPOS_CONTROL) las filas del CSV de control."""
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return
+        pos = [header.index(c) if c in header else None for c in CAMPOS_CONTROL]
+        cod_pos = pos[0]
+        if cod_pos is None:
+            return
+        for row in reader:
+            cod = row[cod_pos] if cod_pos < len(row) else ""
+            if cod:
+                filas[cod] = [row[i] if i is not None and i < len(row) else "" for i in pos]
+
+def leer_codigos(csv_path):
+    """
+    Conjunto de codigo_bdns del CSV de control leyendo solo el primer campo de
+    cada línea, sin parsear el resto. Devuelve None si la cabecera no es
+    CAMPOS_CONTROL (hay que leerlo con leer_control).
+    """
+    with open(csv_path, "rb") as f:
+        header = f.readline().rstrip(b"\r\n").decode("utf-8").split(",")
+        if header != CAMPOS_CONTROL:
+            return None
+        return {line[:line.find(b",")].decode("utf-8") for line in f if line.strip()}
+
+def escribir_control(csv_path, filas):
+    """Escribe el CSV de control con cabecera CAMPOS_CONTROL."""
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(CAMPOS_CONTROL)
+        writer.writerows(filas)
 
-    existentes_csv = {}
-    if csv_path.exists():
-        with open(csv_path, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                cod = row.get('codigo_bdns')
-                if cod:
-                    existentes_csv[cod] = row
-
-    nuevos = []
-    while True:
-        params = {
-            "fechaDesde": f"01/01/{year}",
-            "fechaHasta": f"31/12/{year}",
-            "page": page,
-            "pageSize": page_size,
-            "order": "numeroConvocatoria",
-            "direccion": "asc",
-            "tipoAdministracion": tipo,
-        }
-        # Retry con backoff exponencial para 429
-        data = None
-        for attempt in range(_MAX_RETRIES):
-            response = requests.get(url, params=params, timeout=180)
-            if response.status_code == 429:
+def _get_pagina(year, tipo, page):
+    """Pide una página de la búsqueda; ante 429 respeta Retry-After (o backoff exponencial)."""
+    url = "https://www.infosubvenciones.es/bdnstrans/api/convocatorias/busqueda"
+    params = {
+        "fechaDesde": f"01/01/{year}",
+        "fechaHasta": f"31/12/{year}",
+        "page": page,
+        "pageSize": _PAGE_SIZE,
+        "order": "numeroConvocatoria",
+        "direccion": "asc",
+        "tipoAdministracion": tipo,
+    }
+    for attempt in range(_MAX_RETRIES):
+        with _en_vuelo:
+            response = _session.get(url, params=params, timeout=180)
+        if response.status_code == 429:
+            try:
+                wait = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
                 wait = _BACKOFF_BASE * (2 ** attempt)
-                log(f"[{tipo}] 429 Too Many Requests en página {page}, reintentando en {wait}s (intento {attempt+1}/{_MAX_RETRIES})", "WARNING")
-                time.sleep(wait)
-                continue
-            response.raise_for_status()
-            data = response.json()
-            break
-        if data is None:
-            # Último intento sin capturar
-            response = requests.get(url, params=params, timeout=180)
-            response.raise_for_status()
-            data = response.json()
-        contenido = data.get("content", [])
-        log(f"[{tipo}] Página {page}: {len(contenido)} registros")
+            wait += random.uniform(0, 0.5)
+            log(f"[{tipo}] 429 Too Many Requests en página {page}, reintentando en {wait:.1f}s (intento {attempt+1}/{_MAX_RETRIES})", "WARNING")
+            time.sleep(wait)
+            continue
+        response.raise_for_status()
+        return response.json()
+    # Último intento sin capturar
+    with _en_vuelo:
+        response = _session.get(url, params=params, timeout=180)
+    response.raise_for_status()
+    return response.json()
 
+def fetch_codigos_bdns(year, tipo, csv_path):
+    # Con la cabecera estándar basta con los códigos: las filas nuevas se
+    # añaden al final. Si no, se lee entero y se reescribe normalizado
+    existentes_csv = {}
+    codigos_csv = leer_codigos(csv_path) if csv_path.exists() else None
+    reescribir = codigos_csv is None
+    if reescribir:
+        if csv_path.exists():
+            leer_control(csv_path, existentes_csv)
+        codigos_csv = existentes_csv.keys()
+
+    # La primera página da totalElements; el resto se piden a la vez
+    # (como mucho _MAX_PAGINAS_EN_PARALELO) en lugar de una tras otra
+    data = _get_pagina(year, tipo, 0)
+    total_esperado = data.get("totalElements", 0)
+    paginas = [data.get("content", [])]
+    log(f"[{tipo}] Página 0: {len(paginas[0])} registros de {total_esperado}")
+
+    npages = math.ceil(total_esperado / _PAGE_SIZE)
+    if npages > 1 and len(codigos_csv) < total_esperado:
+        with ThreadPoolExecutor(max_workers=_MAX_PAGINAS_EN_PARALELO) as pool:
+            paginas.extend(pool.map(
+                lambda page: _get_pagina(year, tipo, page).get("content", []),
+                range(1, npages),
+            ))
+        log(f"[{tipo}] Páginas 1-{npages - 1}: {sum(len(p) for p in paginas[1:])} registros")
+
+    nuevos = {}
+    for contenido in paginas:
         for item in contenido:
             codigo_bdns = str(item.get("numeroConvocatoria") or item.get("id"))
             fecha_recepcion = item.get("fechaRecepcion", "")[:10]
-            if codigo_bdns and codigo_bdns not in existentes_csv:
-                nuevos.append({
-                    "codigo_bdns": codigo_bdns,
-                    "fecha_recepcion": fecha_recepcion,
-                    "tipo_administracion": tipo,
-                    "status": "pending",
-                    "last_error": "",
-                    "last_attempt": "",
-                    "retries": "0"
-                })
-
-        if total_esperado is None:
-            total_esperado = data.get("totalElements", 0)
-
-        if not contenido or (len(existentes_csv) + len(nuevos)) >= total_esperado:
-            break
-        page += 1
-        time.sleep(2)  # Rate limiting: 2s entre páginas
-
-    todas = list(existentes_csv.values()) + nuevos
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "codigo_bdns", "fecha_recepcion", "tipo_administracion",
-                "status", "last_error", "last_attempt", "retries"
-            ]
-        )
-        writer.writeheader()
-        for row in todas:
-            writer.writerow(row)
-
-    log(f"[{tipo}] Total {len(todas)} en {csv_path}")
+            if codigo_bdns and codigo_bdns not in codigos_csv and codigo_bdns not in nuevos:
+                nuevos[codigo_bdns] = [codigo_bdns, fecha_recepcion, tipo, "pending", "", "", "0"]
+
+    if reescribir:
+        escribir_control(csv_path, list(existentes_csv.values()) + list(nuevos.values()))
+    elif nuevos:
+        with open(csv_path, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(nuevos.values())
+
+    log(f"[{tipo}] Total {len(codigos_csv) + len(nuevos)} en {csv_path}")
 
 def merge_and_cleanup(year, control_dir):
     """Fusiona los archivos mensuales y borra los temporales."""
@@ -107,28 +154,13 @@ def merge_and_cleanup(year, control_dir):
     for tipo in TIPOS:
         path = control_dir / f"convocatoria_{year}_{tipo}.csv"
         if path.exists():
-            with open(path, encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    cod = row.get("codigo_bdns")
-                    if cod:
-                        filas[cod] = row
+            leer_control(path, filas)
             # Borra el archivo mensual
             path.unlink()
             log(f"Borrado temporal: {path}", "INFO")
     # Escribe el archivo anual único
     if filas:
-        with open(anual_path, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(
-                f,
-                fieldnames=[
-                    "codigo_bdns", "fecha_recepcion", "tipo_administracion",
-                    "status", "last_error", "last_attempt", "retries"
-                ]
-            )
-            writer.writeheader()
-            for row in filas.values():
-                writer.writerow(row)
+        escribir_control(anual_path, filas.values())
         log(f"CSV anual completado en {anual_path} ({len(filas)} convocatorias)", "INFO")
     else:
         log("No se encontró ningún archivo temporal para fusionar.", "WARNING")
@@ -140,9 +172,13 @@ def main():
     args = parser.parse_args()
     control_dir = Path(__file__).resolve().parent.parent / "control"
     control_dir.mkdir(parents=True, exist_ok=True)
-    for tipo in TIPOS:
-        csv_path = control_dir / f"convocatoria_{args.year}_{tipo}.csv"
-        fetch_codigos_bdns(args.year, tipo, csv_path)
+    # Los tipos son independientes: se extraen a la vez (las peticiones en
+    # vuelo siguen limitadas por _en_vuelo)
+    with ThreadPoolExecutor(max_workers=len(TIPOS)) as pool:
+        list(pool.map(
+            lambda tipo: fetch_codigos_bdns(args.year, tipo, control_dir / f"convocatoria_{args.year}_{tipo}.csv"),
+            TIPOS,
+        ))
     merge_and_cleanup(args.year, control_dir)
 
 if __name__ == "__main__":
@@ -1,25 +1,49 @@
 # load_convocatorias.py
 
 from pathlib import Path
+from bdns_core.db.session import get_session
 from ETL.convocatorias.load.load_convocatorias_from_json import load_convocatorias_from_json
 from ETL.etl_utils import get_or_create_dir
 
 RUTA_CONTROL = get_or_create_dir("control")
 RUTA_TRANSFORMED = get_or_create_dir("json", "convocatorias", "transformed")
 
+TIPOS = ["C", "A", "L", "O"]
+
+def json_path_for(year: int, mes: int, tipo: str) -> Path:
+    return RUTA_TRANSFORMED / f"convocatorias_{tipo}_{year}_{mes:02d}.json"
+
+def csv_path_for(year: int) -> Path:
+    return RUTA_CONTROL / f"convocatoria_{year}.csv"
+
 def main(year: int, mes: int, tipo: str):
-    json_path = RUTA_TRANSFORMED / f"convocatorias_{tipo}_{year}_{mes:02d}.json"
+    json_path = json_path_for(year, mes, tipo)
     if not json_path.exists():
         return
 
-    csv_path = RUTA_CONTROL / f"convocatoria_{year}.csv"
-    load_convocatorias_from_json(json_path, csv_path)
+    load_convocatorias_from_json(json_path, csv_path_for(year))
+
+def load_many(tasks):
+    """
+    Carga varios JSON mensuales (tareas (year, mes, tipo)) en un solo proceso,
+    con una sesión y la caché de ids de catálogo compartidas entre ficheros.
+    """
+    existentes = {}
+    with get_session() as session:
+        for year, mes, tipo in tasks:
+            json_path = json_path_for(year, mes, tipo)
+            if json_path.exists():
+                load_convocatorias_from_json(
+                    json_path, csv_path_for(year), session=session, existentes=existentes
+                )
 
 if __name__ == "__main__":
     import argparse
     p = argparse.ArgumentParser()
     p.add_argument("--year", type=int, required=True)
-    p.add_argument("--mes", type=int, required=True)
-    p.add_argument("--tipo", type=str, required=True)
+    p.add_argument("--mes", type=int, help="Mes (por defecto, todos)")
+    p.add_argument("--tipo", type=str, help="Tipo de administración (por defecto, todos)")
     args = p.parse_args()
-    main(args.year, args.mes, args.tipo)
+    meses = [args.mes] if args.mes else range(1, 13)
+    tipos = [args.tipo] if args.tipo else TIPOS
+    load_many([(args.year, mes, tipo) for mes in meses for tipo in tipos])
@@ -18,6 +18,8 @@ sys.path.insert(0, str(PROJECT_ROOT))
 from sqlalchemy import text
 from bdns_core.db.session import get_session
 
+# Bytes por lectura al alimentar COPY (por defecto psycopg2 lee de 8 KiB en 8 KiB)
+COPY_BUFFER_SIZE = 1 << 20
 
 TEMP_TABLE_DDL = """
     CREATE TEMP TABLE IF NOT EXISTS temp_convocatorias (
@@ -42,9 +44,10 @@ COPY_COLUMNS = (
     "presupuesto_total, reglamento_id, created_by, created_at"
 )
 
+# El transform deja id a NULL: se genera aquí con uuid_generate_v7()
 UPSERT_SQL = f"""
     INSERT INTO bdns.convocatoria ({COPY_COLUMNS})
-    SELECT {COPY_COLUMNS}
+    SELECT COALESCE(id, uuid_generate_v7()), {COPY_COLUMNS.split(", ", 1)[1]}
     FROM temp_convocatorias
     ON CONFLICT (id_bdns) DO NOTHING;
 """
@@ -54,21 +57,14 @@ def log(msg: str):
     print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
 
 
-def copy_convocatorias(csv_path: Path) -> Tuple[int, int]:
+def copy_convocatorias_from(f) -> Tuple[int, int]:
     """
-    Carga convocatorias desde CSV pipe-separated usando COPY.
-
-    Args:
-        csv_path: Ruta al CSV generado por transform_convocatorias_to_csv.py
+    Carga convocatorias con COPY desde un objeto fichero (o stream) con filas
+    pipe-separated sin cabecera, en el formato de transform_convocatorias_to_csv.
 
     Returns:
         (insertados, duplicados)
     """
-    if not csv_path.exists():
-        raise FileNotFoundError(f"CSV no encontrado: {csv_path}")
-
-    log(f"Cargando convocatorias desde {csv_path.name}...")
-
     with get_session() as session:
         # 1. Crear tabla temporal
         session.execute(text(TEMP_TABLE_DDL))
@@ -78,21 +74,20 @@ def copy_convocatorias(csv_path: Path) -> Tuple[int, int]:
         raw_conn = connection.connection
         cursor = raw_conn.cursor()
 
-        with open(csv_path, "r", encoding="utf-8") as f:
-            next(f)  # Saltar header
-            cursor.copy_expert(
-                f"""
-                COPY temp_convocatorias ({COPY_COLUMNS})
-                FROM STDIN WITH (
-                    FORMAT CSV,
-                    DELIMITER '|',
-                    NULL '\\N',
-                    QUOTE '"',
-                    ESCAPE '\\'
-                )
-                """,
-                f,
+        cursor.copy_expert(
+            f"""
+            COPY temp_convocatorias ({COPY_COLUMNS})
+            FROM STDIN WITH (
+                FORMAT CSV,
+                DELIMITER '|',
+                NULL '\\N',
+                QUOTE '"',
+                ESCAPE '\\'
             )
+            """,
+            f,
+            size=COPY_BUFFER_SIZE
+        )
 
         rows_copied = cursor.rowcount
         log(f"  COPY: {rows_copied} filas copiadas a temp")
@@ -109,6 +104,26 @@ def copy_convocatorias(csv_path: Path) -> Tuple[int, int]:
     return insertados, duplicados
 
 
+def copy_convocatorias(csv_path: Path) -> Tuple[int, int]:
+    """
+    Carga convocatorias desde CSV pipe-separated usando COPY.
+
+    Args:
+        csv_path: Ruta al CSV generado por transform_convocatorias_to_csv.py
+
+    Returns:
+        (insertados, duplicados)
+    """
+    if not csv_path.exists():
+        raise FileNotFoundError(f"CSV no encontrado: {csv_path}")
+
+    log(f"Cargando convocatorias desde {csv_path.name}...")
+
+    with open(csv_path, "rb", buffering=COPY_BUFFER_SIZE) as f:
+        next(f)  # Saltar header
+        return copy_convocatorias_from(f)
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -1,11 +1,16 @@
 # load_convocatorias_from_json.py
 # Carga las convocatorias de un JSON mensual, marcando las cargadas como 'loaded' en el CSV de control.
 
+import io
 import logging
-import json
 import csv
+from collections import OrderedDict
+from contextlib import nullcontext
 from pathlib import Path
-from bdns_core.db.session import SessionLocal
+import ijson
+import orjson
+from sqlalchemy import text
+from bdns_core.db.session import get_session
 from bdns_core.db.models import (
     Convocatoria, Instrumento, TipoBeneficiario, Finalidad, Objetivo, Organo,
     Reglamento, Fondo, Region, SectorActividad, SectorProducto
@@ -20,24 +25,193 @@ if not logger.hasHandlers():
         format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s"
     )
 
-def registrar_pendiente(nombre_catalogo, descripcion):
-    """Registra un valor pendiente (sin duplicados) en data/convocatorias/pending/<catalogo>_pending.csv."""
-    pending_dir = _BASE_DATA_DIR / "convocatorias" / "pending"
-    pending_dir.mkdir(parents=True, exist_ok=True)
-    pending_file = pending_dir / f"{nombre_catalogo}_pending.csv"
-    if not hasattr(registrar_pendiente, "vistos"):
-        registrar_pendiente.vistos = set()
-    clave = (nombre_catalogo, str(descripcion))
-    if clave in registrar_pendiente.vistos:
-        return
-    registrar_pendiente.vistos.add(clave)
-    with open(pending_file, "a", encoding="utf-8", newline="") as f:
-        f.write(f"{descripcion}\n")
-
-def load_convocatorias_from_json(json_path, csv_path):
+ETL_USER = "etl_system"
+
+# (atributo, modelo, clave en el JSON) de las relaciones N:M
+_RELACIONES_N_M = (
+    ("instrumentos", Instrumento, "instrumentos"),
+    ("tipos_beneficiarios", TipoBeneficiario, "tiposBeneficiarios"),
+    ("finalidades", Finalidad, "finalidades"),
+    ("objetivos", Objetivo, "objetivos"),
+    ("reglamentos", Reglamento, "reglamentos"),
+    ("fondos", Fondo, "fondos"),
+    ("regiones", Region, "regiones"),
+    ("sectores_actividad", SectorActividad, "sectoresActividad"),
+    ("sectores_producto", SectorProducto, "sectoresProducto"),
+)
+
+# (columna, modelo, clave en el JSON) de las FKs simples
+_FKS = (
+    ("organo_id", Organo, "organo"),
+    ("reglamento_id", Reglamento, "reglamento"),
+    ("finalidad_id", Finalidad, "finalidad"),
+    ("objetivo_id", Objetivo, "objetivo"),
+    ("instrumento_id", Instrumento, "instrumento"),
+    ("tipo_beneficiario_id", TipoBeneficiario, "tipoBeneficiario"),
+    ("sector_actividad_id", SectorActividad, "sectorActividad"),
+    ("sector_producto_id", SectorProducto, "sectorProducto"),
+    ("region_id", Region, "region"),
+    ("fondo_id", Fondo, "fondo"),
+)
+
+# Columnas de bdns.convocatoria que se cargan desde el JSON, en el orden del COPY
+_COLUMNAS = (
+    "codigo_bdns", "descripcion", "descripcion_leng", "fecha_recepcion", "mrr",
+    *(columna for columna, _, _ in _FKS),
+)
+
+
+def ids_necesarios(data) -> dict:
+    """
+    Recorre las entradas y reúne, por modelo, los ids referenciados
+    (por FK simple o por relación N:M).
+    """
+    ids = {}
+    for entrada in data:
+        for _, modelo, clave in _FKS:
+            valor = entrada.get(clave)
+            if valor:
+                ids.setdefault(modelo, set()).add(valor.get("id") if isinstance(valor, dict) else valor)
+        for _, modelo, clave in _RELACIONES_N_M:
+            for item in entrada.get(clave) or []:
+                if item.get("id"):
+                    ids.setdefault(modelo, set()).add(item["id"])
+    return ids
+
+def _tabla_enlace(attr):
+    """
+    Tabla N:M de una relación de Convocatoria, tomada del mapeo ORM.
+    Devuelve (tabla, columna hacia convocatoria, columna hacia el catálogo).
+    """
+    rel = getattr(Convocatoria, attr).property
+    return (
+        rel.secondary.fullname,
+        rel.synchronize_pairs[0][1].name,
+        rel.secondary_synchronize_pairs[0][1].name,
+    )
+
+def _copy(cursor, tabla, columnas, buf):
+    """COPY de un buffer CSV pipe-separated a una tabla temporal; devuelve las filas copiadas."""
+    buf.seek(0)
+    cursor.copy_expert(
+        f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT CSV, DELIMITER '|')",
+        buf,
+    )
+    return cursor.rowcount
+
+def iter_entradas(json_path):
+    """
+    Recorre las convocatorias en streaming, sin cargar la lista entera.
+    Acepta el JSONL de extract_convocatorias (una convocatoria por línea)
+    o un JSON con una lista (ijson).
+    """
+    with open(json_path, "rb") as f:
+        if Path(json_path).suffix == ".jsonl":
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+        else:
+            yield from ijson.items(f, "item", use_float=True)
+
+class PendingWriter:
+    """
+    Registra valores pendientes (sin duplicados) en
+    data/convocatorias/pending/<catalogo>_pending.csv.
+
+    Las líneas se acumulan en un buffer por catálogo y se escriben al salir del
+    bloque with, abriendo cada fichero una sola vez. Los valores ya vistos se
+    recuerdan entre cargas del mismo proceso, con un máximo de MAX_VISTOS (LRU).
+    """
+
+    MAX_VISTOS = 100_000
+    _vistos: "OrderedDict[tuple, None]" = OrderedDict()
+
+    def __init__(self, pending_dir=None):
+        self.pending_dir = Path(pending_dir or _BASE_DATA_DIR / "convocatorias" / "pending")
+        self._buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def write(self, nombre_catalogo, descripcion):
+        clave = (nombre_catalogo, str(descripcion))
+        vistos = PendingWriter._vistos
+        if clave in vistos:
+            vistos.move_to_end(clave)
+            return
+        vistos[clave] = None
+        if len(vistos) > self.MAX_VISTOS:
+            vistos.popitem(last=False)
+        buf = self._buffers.get(nombre_catalogo)
+        if buf is None:
+            buf = self._buffers[nombre_catalogo] = io.StringIO()
+        buf.write(f"{descripcion}\n")
+
+    def flush(self):
+        if not self._buffers:
+            return
+        self.pending_dir.mkdir(parents=True, exist_ok=True)
+        for nombre_catalogo, buf in self._buffers.items():
+            with open(self.pending_dir / f"{nombre_catalogo}_pending.csv", "a", encoding="utf-8", newline="") as f:
+                f.write(buf.getvalue())
+        self._buffers.clear()
+
+def loaded_log_path(csv_path):
+    """Log de deltas (codigos cargados pendientes de aplicar) asociado al CSV de control."""
+    csv_path = Path(csv_path)
+    return csv_path.with_suffix(".loaded.log")
+
+def merge_loaded_log(csv_path):
+    """
+    Aplica al CSV de control todos los codigos anotados en su log de deltas
+    (status = 'loaded') con una única reescritura, y borra el log.
+    Devuelve el número de filas marcadas.
+    """
+    csv_path = Path(csv_path)
+    log_path = loaded_log_path(csv_path)
+    if not log_path.exists() or not csv_path.exists():
+        return 0
+
+    with open(log_path, encoding="utf-8") as lf:
+        cargados = {line.strip() for line in lf if line.strip()}
+
+    with open(csv_path, encoding="utf-8", newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    COD = header.index("codigo_bdns")
+    STATUS = header.index("status")
+
+    marcadas = 0
+    for row in rows:
+        if len(row) > COD and row[COD] in cargados:
+            if len(row) <= STATUS:
+                row.extend([""] * (STATUS + 1 - len(row)))
+            row[STATUS] = "loaded"
+            marcadas += 1
+
+    with open(csv_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    log_path.unlink()
+    logger.info(f"CSV de control {csv_path.name}: {marcadas} convocatorias marcadas como 'loaded'.")
+    return marcadas
+
+def load_convocatorias_from_json(json_path, csv_path, *, session=None, existentes=None):
     """
-    Carga todas las convocatorias de un JSON mensual.
-    Marca como 'loaded' en el CSV las que se cargan.
+    Carga todas las convocatorias de un JSON (o JSONL) mensual: COPY a tablas
+    temporales e INSERT ... ON CONFLICT DO NOTHING, en una sola transacción.
+    Anota las que se cargan en el log de deltas del CSV de control
+    (ver merge_loaded_log).
+
+    Para cargar varios ficheros seguidos (ver load_convocatorias.load_many) se
+    pueden pasar una sesión abierta y el dict `existentes` (modelo -> ids de
+    catálogo ya comprobados), que se reutiliza y amplía entre llamadas.
     Devuelve completadas, pendientes.
     """
     (_BASE_DATA_DIR / "convocatorias" / "pending").mkdir(parents=True, exist_ok=True)
@@ -48,115 +222,149 @@ def load_convocatorias_from_json(json_path, csv_path):
         logger.error(f"No existe el JSON: {json_path}")
         return 0, 0
 
-    with open(json_path, encoding="utf-8") as f:
-        data = json.load(f)
-
     # Cargar CSV de control
     csv_path = Path(csv_path)
     if not csv_path.exists():
         logger.error(f"No existe el CSV de control: {csv_path}")
-        return 0, len(data)
-
-    with open(csv_path, encoding="utf-8", newline='') as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
-        fieldnames = reader.fieldnames
+        return 0, sum(1 for _ in iter_entradas(json_path))
 
     completadas, pendientes = 0, 0
+    total = 0
     codigos_procesados = set()
 
-    for entrada in data:
-        pendientes_entry = []
-        codigo_bdns = str(entrada.get("codigo_bdns") or entrada.get("numeroConvocatoria") or entrada.get("id"))
-        if not codigo_bdns:
-            logger.warning("Convocatoria sin codigo_bdns, ignorada")
-            continue
-
-        def check_fk(session, modelo, nombre, valor):
-            if not valor:
-                registrar_pendiente(nombre, valor)
-                pendientes_entry.append(nombre)
-                return None
-            id_val = valor.get("id") if isinstance(valor, dict) else valor
-            obj = session.query(modelo).get(id_val)
-            if not obj:
-                registrar_pendiente(nombre, valor)
-                pendientes_entry.append(nombre)
-                return None
-            return obj.id
-
-        with SessionLocal() as session:
-            try:
-                id_organo = check_fk(session, Organo, "organo", entrada.get("organo"))
-                id_reglamento = check_fk(session, Reglamento, "reglamento", entrada.get("reglamento"))
-                id_finalidad = check_fk(session, Finalidad, "finalidad", entrada.get("finalidad"))
-                id_objetivo = check_fk(session, Objetivo, "objetivo", entrada.get("objetivo"))
-                id_instrumento = check_fk(session, Instrumento, "instrumento", entrada.get("instrumento"))
-                id_tipo_beneficiario = check_fk(session, TipoBeneficiario, "tipo_beneficiario", entrada.get("tipoBeneficiario"))
-                id_sector_actividad = check_fk(session, SectorActividad, "sector_actividad", entrada.get("sectorActividad"))
-                id_sector_producto = check_fk(session, SectorProducto, "sector_producto", entrada.get("sectorProducto"))
-                id_region = check_fk(session, Region, "region", entrada.get("region"))
-                id_fondo = check_fk(session, Fondo, "fondo", entrada.get("fondo"))
-
-                if pendientes_entry:
-                    pendientes += 1
-                    continue
+    # Filas válidas en CSV pipe-separated: una para temp_convocatorias y otra
+    # por tabla N:M (codigo_bdns, id del catálogo)
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter="|")
+    enlaces = {attr: io.StringIO() for attr, _, _ in _RELACIONES_N_M}
+    writers_enlace = {attr: csv.writer(b, delimiter="|") for attr, b in enlaces.items()}
+
+    if existentes is None:
+        existentes = {}
 
-                convocatoria = Convocatoria(
-                    codigo_bdns=codigo_bdns,
-                    descripcion=entrada.get("descripcion"),
-                    descripcion_leng=entrada.get("descripcionLeng"),
-                    fecha_recepcion=entrada.get("fechaRecepcion"),
-                    mrr=entrada.get("mrr"),
-                    organo_id=id_organo,
-                    reglamento_id=id_reglamento,
-                    finalidad_id=id_finalidad,
-                    objetivo_id=id_objetivo,
-                    instrumento_id=id_instrumento,
-                    tipo_beneficiario_id=id_tipo_beneficiario,
-                    sector_actividad_id=id_sector_actividad,
-                    sector_producto_id=id_sector_producto,
-                    region_id=id_region,
-                    fondo_id=id_fondo,
+    with PendingWriter() as pw, (nullcontext(session) if session is not None else get_session()) as session:
+        # Solo las filas de catálogo que el fichero referencia y no estén ya
+        # comprobadas, con un SELECT ... IN por modelo; FKs y N:M se comprueban
+        # después en memoria
+        for modelo, ids in ids_necesarios(iter_entradas(json_path)).items():
+            conocidos = existentes.setdefault(modelo, set())
+            por_comprobar = ids - conocidos
+            if por_comprobar:
+                conocidos.update(
+                    row[0] for row in session.query(modelo.id).filter(modelo.id.in_(por_comprobar)).all()
                 )
 
-                # Relaciones N:M
-                def set_n_m(attr, model, key):
-                    items = entrada.get(key) or []
-                    objs = [session.query(model).get(i["id"]) for i in items if i.get("id")]
-                    setattr(convocatoria, attr, objs)
-
-                set_n_m("instrumentos", Instrumento, "instrumentos")
-                set_n_m("tipos_beneficiarios", TipoBeneficiario, "tiposBeneficiarios")
-                set_n_m("finalidades", Finalidad, "finalidades")
-                set_n_m("objetivos", Objetivo, "objetivos")
-                set_n_m("reglamentos", Reglamento, "reglamentos")
-                set_n_m("fondos", Fondo, "fondos")
-                set_n_m("regiones", Region, "regiones")
-                set_n_m("sectores_actividad", SectorActividad, "sectoresActividad")
-                set_n_m("sectores_producto", SectorProducto, "sectoresProducto")
-
-                session.merge(convocatoria)
-                session.commit()
-                completadas += 1
-                codigos_procesados.add(codigo_bdns)
-            except Exception as e:
-                session.rollback()
-                logger.error(f"Error cargando convocatoria {codigo_bdns}: {e}")
+        for entrada in iter_entradas(json_path):
+            total += 1
+            pendientes_entry = []
+            codigo_bdns = str(entrada.get("codigo_bdns") or entrada.get("numeroConvocatoria") or entrada.get("id"))
+            if not codigo_bdns:
+                logger.warning("Convocatoria sin codigo_bdns, ignorada")
+                continue
+
+            def check_fk(modelo, nombre, valor):
+                if not valor:
+                    pw.write(nombre, valor)
+                    pendientes_entry.append(nombre)
+                    return None
+                id_val = valor.get("id") if isinstance(valor, dict) else valor
+                if id_val not in existentes.get(modelo, ()):
+                    pw.write(nombre, valor)
+                    pendientes_entry.append(nombre)
+                    return None
+                return id_val
+
+            fila = [
+                codigo_bdns,
+                entrada.get("descripcion"),
+                entrada.get("descripcionLeng"),
+                entrada.get("fechaRecepcion"),
+                entrada.get("mrr"),
+            ]
+            fila.extend(
+                check_fk(modelo, columna.removesuffix("_id"), entrada.get(clave))
+                for columna, modelo, clave in _FKS
+            )
+
+            # Relaciones N:M: todos los ids deben existir en su catálogo
+            enlaces_entry = []
+            for attr, model, key in _RELACIONES_N_M:
+                for item in entrada.get(key) or []:
+                    if not item.get("id"):
+                        continue
+                    if item["id"] not in existentes.get(model, ()):
+                        pw.write(attr, item)
+                        pendientes_entry.append(attr)
+                    enlaces_entry.append((attr, item["id"]))
+
+            if pendientes_entry:
                 pendientes += 1
+                continue
 
-    # Actualizar CSV: marcar como 'loaded' las completadas
-    for row in rows:
-        if row.get("codigo_bdns") in codigos_procesados:
-            row["status"] = "loaded"
+            writer.writerow(fila)
+            for attr, id_val in enlaces_entry:
+                writers_enlace[attr].writerow((codigo_bdns, id_val))
+            codigos_procesados.add(codigo_bdns)
 
-    with open(csv_path, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+        # Una sola transacción: COPY a temporales e INSERT ... SELECT a las tablas
+        # finales. Las temporales copian los tipos de las tablas reales (CREATE
+        # TABLE AS ... WITH NO DATA), sin depender de cómo estén definidos los ids
+        try:
+            session.execute(text(f"""
+                CREATE TEMP TABLE temp_convocatorias ON COMMIT DROP AS
+                SELECT {", ".join(_COLUMNAS)} FROM bdns.convocatoria WITH NO DATA
+            """))
+            cursor = session.connection().connection.cursor()
+            copiadas = _copy(cursor, "temp_convocatorias", _COLUMNAS, buf)
+
+            # codigo_bdns es el identificador natural único; el id se genera aquí
+            insertadas = session.execute(text(f"""
+                INSERT INTO bdns.convocatoria (id, {", ".join(_COLUMNAS)}, created_by, created_at)
+                SELECT DISTINCT ON (t.codigo_bdns)
+                    uuid_generate_v7(), {", ".join("t." + c for c in _COLUMNAS)}, :created_by, NOW()
+                FROM temp_convocatorias t
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM bdns.convocatoria c WHERE c.codigo_bdns = t.codigo_bdns
+                )
+                ON CONFLICT (codigo_bdns) DO NOTHING
+            """), {"created_by": ETL_USER}).rowcount
+
+            for attr, _, _ in _RELACIONES_N_M:
+                if not enlaces[attr].tell():
+                    continue
+                tabla, col_conv, col_ref = _tabla_enlace(attr)
+                temp = f"temp_{attr}"
+                session.execute(text(f"""
+                    CREATE TEMP TABLE {temp} ON COMMIT DROP AS
+                    SELECT NULL::varchar AS codigo_bdns, {col_ref} FROM {tabla} WITH NO DATA
+                """))
+                _copy(cursor, temp, ("codigo_bdns", col_ref), enlaces[attr])
+                session.execute(text(f"""
+                    INSERT INTO {tabla} ({col_conv}, {col_ref})
+                    SELECT DISTINCT c.id, t.{col_ref}
+                    FROM {temp} t
+                    JOIN bdns.convocatoria c ON c.codigo_bdns = t.codigo_bdns
+                    ON CONFLICT DO NOTHING
+                """))
+
+            session.commit()
+            completadas = len(codigos_procesados)
+            logger.info(f"COPY: {copiadas} convocatorias, {insertadas} insertadas, "
+                        f"{copiadas - insertadas} ya existentes")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error cargando {json_path.name}: {e}")
+            pendientes += len(codigos_procesados)
+            codigos_procesados.clear()
+
+    # Marcar como 'loaded' las completadas: se anotan en el log de deltas del
+    # CSV de control (append); merge_loaded_log las aplica en una sola pasada
+    if codigos_procesados:
+        with open(loaded_log_path(csv_path), "a", encoding="utf-8") as lf:
+            lf.writelines(c + "\n" for c in codigos_procesados)
 
     # Si todas las convocatorias se cargaron, elimina el JSON mensual
-    if completadas and completadas + pendientes == len(data):
+    if completadas and completadas + pendientes == total:
         try:
             json_path.unlink()
             logger.info(f"Eliminado JSON mensual {json_path} tras cargar todas las convocatorias.")
@@ -171,10 +379,17 @@ def load_convocatorias_from_json(json_path, csv_path):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Carga convocatorias de un JSON mensual en la BD y marca el CSV de control.")
-    parser.add_argument("--json", "-j", type=str, required=True, help="Ruta al JSON mensual")
+    parser.add_argument("--json", "-j", type=str, help="Ruta al JSON/JSONL mensual")
     parser.add_argument("--csv", "-c", type=str, required=True, help="Ruta al CSV de control")
+    parser.add_argument("--merge-loaded", action="store_true",
+                        help="Aplica al CSV de control el log de convocatorias cargadas")
     args = parser.parse_args()
-    load_convocatorias_from_json(args.json, args.csv)
+    if args.json:
+        load_convocatorias_from_json(args.json, args.csv)
+    if args.merge_loaded:
+        merge_loaded_log(args.csv)
+    elif not args.json:
+        parser.error("indica --json y/o --merge-loaded")
 
 
 
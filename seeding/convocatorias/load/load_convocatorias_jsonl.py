@@ -1,7 +1,5 @@
 # seeding/convocatorias/load/load_convocatorias_jsonl.py
 
-import subprocess
-import re
 import sys
 import time
 import json
@@ -12,7 +10,10 @@ from typing import Tuple
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from bdns_core.db.session import get_database_url
+from sqlalchemy import text
+from bdns_core.db.session import get_session
+
+COPY_BUFFER_SIZE = 1 << 20
 
 
 # Configuración de logging
@@ -27,72 +28,64 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def generate_load_sql(jsonl_path: Path) -> str:
+CREATE_TEMP_JSON_SQL = """
+    CREATE TEMP TABLE temp_convocatorias_json (data JSONB) ON COMMIT DROP
+"""
+
+# Una línea del JSONL por fila: CSV con comilla y delimitador que no aparecen
+# en JSON, para que COPY no interprete los escapes \ del propio JSON
+COPY_JSON_SQL = r"""
+    COPY temp_convocatorias_json (data)
+    FROM STDIN WITH (FORMAT csv, QUOTE E'\x01', DELIMITER E'\x02')
+"""
+
+
+def generate_load_sql() -> dict:
     """
-    Genera script SQL completo para cargar JSONL.
+    Genera los INSERT desde temp_convocatorias_json, por tabla destino.
     """
     # ... (igual que antes, omitido por brevedad)
-    return f"""..."""
+    return {
+        "convocatorias": "...",
+        "documentos": "...",
+        "anuncios": "...",
+    }
 
 
 def copy_convocatorias_jsonl(jsonl_path: Path) -> Tuple[int, int, int, int]:
     """
-    Ejecuta carga completa via psql.
+    Carga completa en una transacción: COPY del JSONL a una tabla temporal
+    e INSERT por tabla destino. Los recuentos salen de cursor.rowcount.
     Retorna: (total_jsonl, convocatorias, documentos, anuncios)
     """
     if not jsonl_path.exists():
         logger.error(f"JSONL no encontrado: {jsonl_path}")
         raise FileNotFoundError(f"JSONL no encontrado: {jsonl_path}")
 
-    db_url = get_database_url()
-    
     logger.info(f"Iniciando carga desde {jsonl_path.name}")
-    
-    sql_script = generate_load_sql(jsonl_path)
-    
-    logger.debug(f"Ejecutando psql con script de {len(sql_script)} caracteres")
-    
-    result = subprocess.run(
-        ["psql", db_url, "-v", "ON_ERROR_STOP=1", "-c", sql_script],
-        capture_output=True,
-        text=True
-    )
-    
-    if result.returncode != 0:
-        logger.error(f"psql falló: {result.stderr}")
-        raise RuntimeError(f"psql falló: {result.stderr}")
-    
-    logger.debug("psql ejecutado correctamente")
-    
-    # Parsear estadísticas
-    output = result.stdout + result.stderr
-    
-    stats = {
-        "total_jsonl": 0,
-        "convocatorias": 0,
-        "documentos": 0,
-        "anuncios": 0
-    }
-    
-    patterns = {
-        "total_jsonl": r'total_jsonl\s*\n\s*(\d+)',
-        "convocatorias": r'convocatorias_insertadas\s*\n\s*(\d+)',
-        "documentos": r'documentos_insertados\s*\n\s*(\d+)',
-        "anuncios": r'anuncios_insertados\s*\n\s*(\d+)'
-    }
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, output)
-        if match:
-            stats[key] = int(match.group(1))
-    
+
+    stats = {}
+    with get_session() as session:
+        session.execute(text(CREATE_TEMP_JSON_SQL))
+
+        cursor = session.connection().connection.cursor()
+        with open(jsonl_path, "rb", buffering=COPY_BUFFER_SIZE) as f:
+            cursor.copy_expert(COPY_JSON_SQL, f, size=COPY_BUFFER_SIZE)
+        stats["total_jsonl"] = cursor.rowcount
+        logger.debug(f"COPY: {stats['total_jsonl']} filas copiadas a temporal")
+
+        for tabla, sql in generate_load_sql().items():
+            stats[tabla] = session.execute(text(sql)).rowcount
+
+        session.commit()
+
     logger.info(f"Carga completada: {stats['convocatorias']} convocatorias, "
                 f"{stats['documentos']} documentos, {stats['anuncios']} anuncios "
                 f"(de {stats['total_jsonl']} en JSONL)")
-    
+
     if stats['convocatorias'] == 0 and stats['total_jsonl'] > 0:
         logger.warning("No se insertaron convocatorias aunque el JSONL tenía registros")
-    
+
     return (
         stats["total_jsonl"],
         stats["convocatorias"],
@@ -104,7 +97,7 @@ def copy_convocatorias_jsonl(jsonl_path: Path) -> Tuple[int, int, int, int]:
 if __name__ == "__main__":
     import argparse
 
-    parser = argparse.ArgumentParser(description="Carga JSONL de convocatorias via psql COPY")
+    parser = argparse.ArgumentParser(description="Carga JSONL de convocatorias via COPY")
     parser.add_argument("--jsonl", required=True, help="Archivo JSONL de entrada")
     parser.add_argument("--verbose", "-v", action="store_true", help="Nivel DEBUG")
     args = parser.parse_args()
@@ -1,6 +1,7 @@
 """
 Transform: convierte JSON raw de convocatorias de la API BDNS a CSV
-listo para carga masiva con COPY.
+listo para carga masiva con COPY, o lo carga directamente con COPY sin
+escribir el CSV intermedio (transform_and_copy_convocatorias).
 
 Resuelve FK IDs (organo_id, reglamento_id) contra tablas de catálogos.
 Requiere que los catálogos estén poblados al 100%.
@@ -11,19 +12,25 @@ La API de detalle (/api/convocatorias?numConv=X) devuelve:
 - codigoBDNS como string (no codigo_bdns)
 """
 
-import json
-import re
+import os
 import sys
+import ijson
 import unicodedata
-from datetime import datetime
+import ahocorasick
+from contextlib import nullcontext
+from datetime import date, datetime
+from multiprocessing import Pool
+from functools import lru_cache
 from pathlib import Path
-from uuid import uuid4
+from typing import Iterator
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 
 from sqlalchemy import text
 from bdns_core.db.session import get_session
+from seeding.common.copy_stream import CopyStream
+from seeding.convocatorias.load.load_convocatorias_copy import copy_convocatorias_from
 
 # Columnas del CSV de salida (deben coincidir con bdns.convocatoria)
 CSV_COLUMNS = [
@@ -32,15 +39,25 @@ CSV_COLUMNS = [
     "presupuesto_total", "reglamento_id", "created_by", "created_at"
 ]
 
+# Las filas se acumulan en un bytearray y se escriben en bloques de este tamaño
+WRITE_BUFFER_SIZE = 1 << 16
 
+# Registros por tarea enviada a cada worker del pool
+POOL_CHUNKSIZE = 2000
+
+
+@lru_cache(maxsize=65536)
 def _normalizar(texto):
-    """Normaliza texto para búsqueda: quita tildes, uppercase, colapsa espacios."""
+    """
+    Normaliza texto para búsqueda: quita tildes, uppercase, colapsa espacios.
+    Memoizada: los niveles de órgano y los reglamentos se repiten mucho.
+    """
     if not texto:
         return None
-    texto = unicodedata.normalize("NFKD", texto).encode("ASCII", "ignore").decode("ASCII")
-    texto = texto.upper().strip()
-    texto = re.sub(r"\s+", " ", texto)
-    return texto
+    # Camino rápido: los textos ya ASCII no necesitan descomposición NFKD
+    if not texto.isascii():
+        texto = unicodedata.normalize("NFKD", texto).encode("ASCII", "ignore").decode("ASCII")
+    return " ".join(texto.upper().split())
 
 
 def _build_organo_lookup(session) -> dict:
@@ -70,6 +87,23 @@ def _build_reglamento_lookup(session) -> dict:
     return lookup
 
 
+def _build_reglamento_automaton(lookup: dict):
+    """
+    Autómata Aho-Corasick sobre las claves del mapa de reglamentos, para el
+    fallback de _resolve_reglamento: una sola pasada por la descripción
+    encuentra todas las claves contenidas. Cada clave guarda su posición en
+    el mapa, para quedarse con la primera como hacía la búsqueda lineal.
+    """
+    automaton = ahocorasick.Automaton()
+    for orden, (key, uuid) in enumerate(lookup.items()):
+        if key:
+            automaton.add_word(key, (orden, uuid))
+    if len(automaton) == 0:
+        return None
+    automaton.make_automaton()
+    return automaton
+
+
 def _resolve_organo(organo_dict, lookup):
     """Resuelve organo_id desde el dict {nivel1, nivel2, nivel3} de la API."""
     if not organo_dict or not isinstance(organo_dict, dict):
@@ -88,7 +122,7 @@ def _resolve_organo(organo_dict, lookup):
     return result
 
 
-def _resolve_reglamento(reglamento_dict, lookup):
+def _resolve_reglamento(reglamento_dict, lookup, automaton=None):
     """Resuelve reglamento_id desde el dict {descripcion, orden} de la API."""
     if not reglamento_dict or not isinstance(reglamento_dict, dict):
         return None
@@ -101,10 +135,10 @@ def _resolve_reglamento(reglamento_dict, lookup):
     if result:
         return result
     # Fallback: buscar si alguna clave del lookup está contenida en la descripción
-    for key, uuid in lookup.items():
-        if key and key in desc_norm:
-            return uuid
-    return None
+    if automaton is None:
+        return None
+    matches = [value for _, value in automaton.iter(desc_norm)]
+    return min(matches)[1] if matches else None
 
 
 def _parse_date(date_str):
@@ -113,8 +147,11 @@ def _parse_date(date_str):
         return ""
     date_str = str(date_str).strip()[:10]
     if "/" in date_str:
+        # Formato fijo: partir e int() es mucho más barato que strptime;
+        # date() sigue rechazando fechas imposibles
         try:
-            return datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
+            dia, mes, anio = date_str.split("/")
+            return date(int(anio), int(mes), int(dia)).isoformat()
         except ValueError:
             return ""
     return date_str
@@ -130,22 +167,77 @@ def _safe_str(value, max_len=None):
     return s if s else "\\N"
 
 
-def transform_convocatorias_to_csv(json_path: Path, csv_path: Path) -> dict:
-    """
-    Transforma JSON raw de convocatorias a CSV para COPY.
+# Estado de solo lectura instalado en cada proceso worker (ver _init_worker)
+_organo_map = None
+_reglamento_map = None
+_reglamento_automaton = None
+_now = None
 
-    Args:
-        json_path: Ruta al JSON con datos crudos de la API
-        csv_path: Ruta de salida para el CSV
 
-    Returns:
-        Dict con estadísticas: total, transformados, errores, sin_organo, sin_reglamento
+def _init_worker(organo_map: dict, reglamento_map: dict, now: str):
+    """Inicializador del pool: recibe los lookups una vez por proceso."""
+    global _organo_map, _reglamento_map, _reglamento_automaton, _now
+    _organo_map = organo_map
+    _reglamento_map = reglamento_map
+    _reglamento_automaton = _build_reglamento_automaton(reglamento_map)
+    _now = now
+
+
+def _format_row(rec) -> tuple:
     """
-    with open(json_path, encoding="utf-8") as f:
-        records = json.load(f)
+    Convierte un registro de la API en una línea del CSV.
 
-    stats = {
-        "total": len(records),
+    Returns:
+        (línea en bytes o None si se descarta, claves de stats a incrementar)
+    """
+    try:
+        # ID BDNS: la API de detalle usa "codigoBDNS" (camelCase)
+        raw_id = (rec.get("codigoBDNS")
+                  or rec.get("codigo_bdns")
+                  or rec.get("numeroConvocatoria")
+                  or rec.get("id"))
+        if not raw_id:
+            return None, ("sin_id_bdns", "errores")
+        id_bdns = str(raw_id).strip()
+        incidencias = []
+
+        # Resolver FKs usando formato real de la API
+        organo_id = _resolve_organo(rec.get("organo"), _organo_map)
+        if not organo_id:
+            incidencias.append("sin_organo")
+
+        reglamento_id = _resolve_reglamento(rec.get("reglamento"), _reglamento_map, _reglamento_automaton)
+        if not rec.get("reglamento"):
+            pass  # No contar como error si la API no incluye reglamento
+        elif not reglamento_id:
+            incidencias.append("sin_reglamento")
+
+        row = "|".join([
+            "\\N",                                               # id (lo genera la BD)
+            id_bdns,                                             # id_bdns
+            _safe_str(id_bdns),                                  # codigo_bdns
+            _safe_str(rec.get("descripcion"), 500),              # titulo
+            _safe_str(rec.get("descripcionLeng")
+                      or rec.get("descripcion")),                # descripcion
+            _parse_date(rec.get("fechaRecepcion")) or "\\N",     # fecha_recepcion
+            _parse_date(rec.get("fechaPublicacion")) or "\\N",   # fecha_publicacion
+            organo_id or "\\N",                                  # organo_id
+            str(rec.get("presupuestoTotal") or "\\N"),           # presupuesto_total
+            reglamento_id or "\\N",                              # reglamento_id
+            "etl_system",                                        # created_by
+            _now,                                                # created_at
+        ])
+        incidencias.append("transformados")
+        return (row + "\n").encode("utf-8"), incidencias
+
+    except Exception as e:
+        print(f"[Transform] Error en registro: {e}")
+        return None, ("errores",)
+
+
+def _nuevas_stats() -> dict:
+    return {
+        "total": 0,
         "transformados": 0,
         "errores": 0,
         "sin_organo": 0,
@@ -153,78 +245,111 @@ def transform_convocatorias_to_csv(json_path: Path, csv_path: Path) -> dict:
         "sin_id_bdns": 0,
     }
 
+
+def _iter_filas(json_path: Path, stats: dict, workers: int = None) -> Iterator[bytes]:
+    """
+    Genera las líneas del CSV (sin cabecera) y actualiza stats sobre la marcha.
+
+    Los registros se formatean en un pool de procesos (imap_unordered: el
+    orden de las filas no importa para COPY); con workers=1, en este proceso.
+    """
     # Cargar lookups de catálogos
     with get_session() as session:
         organo_map = _build_organo_lookup(session)
         reglamento_map = _build_reglamento_lookup(session)
 
     print(f"[Transform] Catálogos cargados: {len(organo_map)} órganos, {len(reglamento_map)} reglamentos")
-    print(f"[Transform] Procesando {len(records)} convocatorias...")
+    print(f"[Transform] Procesando convocatorias de {json_path.name}...")
 
     now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    workers = workers or os.cpu_count() or 1
+    initargs = (organo_map, reglamento_map, now)
+
+    # Entrada en streaming (ijson): no se carga la lista entera
+    with open(json_path, "rb") as fin, \
+            (Pool(workers, initializer=_init_worker, initargs=initargs) if workers > 1 else nullcontext()) as pool:
+        if pool is None:
+            _init_worker(*initargs)
+            filas = map(_format_row, ijson.items(fin, "item", use_float=True))
+        else:
+            filas = pool.imap_unordered(_format_row, ijson.items(fin, "item", use_float=True), chunksize=POOL_CHUNKSIZE)
+
+        for line, incidencias in filas:
+            stats["total"] += 1
+            for clave in incidencias:
+                stats[clave] += 1
+            if line is not None:
+                yield line
+
+
+def _iter_bloques(lines: Iterator[bytes]) -> Iterator[bytes]:
+    """Agrupa líneas en bloques de al menos WRITE_BUFFER_SIZE bytes."""
+    buf = bytearray()
+    for line in lines:
+        buf += line
+        if len(buf) >= WRITE_BUFFER_SIZE:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+
+def _print_resumen(stats: dict):
+    print(f"[Transform] Completado: {stats['transformados']}/{stats['total']} "
+          f"({stats['errores']} errores, {stats['sin_organo']} sin órgano, "
+          f"{stats['sin_reglamento']} sin reglamento)")
+
+
+def transform_convocatorias_to_csv(json_path: Path, csv_path: Path, workers: int = None) -> dict:
+    """
+    Transforma JSON raw de convocatorias a CSV para COPY.
+
+    Args:
+        json_path: Ruta al JSON con datos crudos de la API
+        csv_path: Ruta de salida para el CSV
+        workers: Procesos del pool (por defecto, os.cpu_count())
+
+    Returns:
+        Dict con estadísticas: total, transformados, errores, sin_organo, sin_reglamento
+    """
+    stats = _nuevas_stats()
     csv_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(csv_path, "w", encoding="utf-8") as f:
+    with open(csv_path, "wb") as f:
         # Header
-        f.write("|".join(CSV_COLUMNS) + "\n")
-
-        for rec in records:
-            try:
-                # ID BDNS: la API de detalle usa "codigoBDNS" (camelCase)
-                raw_id = (rec.get("codigoBDNS")
-                          or rec.get("codigo_bdns")
-                          or rec.get("numeroConvocatoria")
-                          or rec.get("id"))
-                if not raw_id:
-                    stats["sin_id_bdns"] += 1
-                    stats["errores"] += 1
-                    continue
-                id_bdns = str(raw_id).strip()
-
-                # Resolver FKs usando formato real de la API
-                organo_id = _resolve_organo(rec.get("organo"), organo_map)
-                if not organo_id:
-                    stats["sin_organo"] += 1
-
-                reglamento_id = _resolve_reglamento(rec.get("reglamento"), reglamento_map)
-                if not rec.get("reglamento"):
-                    pass  # No contar como error si la API no incluye reglamento
-                elif not reglamento_id:
-                    stats["sin_reglamento"] += 1
-
-                row = "|".join([
-                    str(uuid4()),                                        # id
-                    id_bdns,                                             # id_bdns
-                    _safe_str(id_bdns),                                  # codigo_bdns
-                    _safe_str(rec.get("descripcion"), 500),              # titulo
-                    _safe_str(rec.get("descripcionLeng")
-                              or rec.get("descripcion")),                # descripcion
-                    _parse_date(rec.get("fechaRecepcion")) or "\\N",     # fecha_recepcion
-                    _parse_date(rec.get("fechaPublicacion")) or "\\N",   # fecha_publicacion
-                    organo_id or "\\N",                                  # organo_id
-                    str(rec.get("presupuestoTotal") or "\\N"),           # presupuesto_total
-                    reglamento_id or "\\N",                              # reglamento_id
-                    "etl_system",                                        # created_by
-                    now,                                                 # created_at
-                ])
-                f.write(row + "\n")
-                stats["transformados"] += 1
-
-            except Exception as e:
-                stats["errores"] += 1
-                print(f"[Transform] Error en registro: {e}")
+        f.write(("|".join(CSV_COLUMNS) + "\n").encode("utf-8"))
+        for bloque in _iter_bloques(_iter_filas(json_path, stats, workers)):
+            f.write(bloque)
 
-    print(f"[Transform] Completado: {stats['transformados']}/{stats['total']} "
-          f"({stats['errores']} errores, {stats['sin_organo']} sin órgano, "
-          f"{stats['sin_reglamento']} sin reglamento)")
+    _print_resumen(stats)
+    return stats
+
+
+def transform_and_copy_convocatorias(json_path: Path, workers: int = None) -> dict:
+    """
+    Transforma JSON raw de convocatorias y carga las filas directamente con
+    COPY (load_convocatorias_copy), sin escribir el CSV intermedio.
+
+    Returns:
+        Dict con las estadísticas de transform_convocatorias_to_csv más
+        insertados y duplicados
+    """
+    stats = _nuevas_stats()
+    stream = CopyStream(_iter_bloques(_iter_filas(json_path, stats, workers)))
+    stats["insertados"], stats["duplicados"] = copy_convocatorias_from(stream)
 
+    _print_resumen(stats)
     return stats
 
 
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description="Transforma JSON de convocatorias a CSV")
+    parser = argparse.ArgumentParser(description="Transforma JSON de convocatorias y lo carga con COPY (o a CSV con --csv)")
     parser.add_argument("--json", required=True, help="JSON de entrada")
-    parser.add_argument("--csv", required=True, help="CSV de salida")
+    parser.add_argument("--csv", help="CSV de salida; sin él, las filas van directas a la BD")
+    parser.add_argument("--workers", type=int, help="Procesos para formatear registros (por defecto, todos los núcleos)")
     args = parser.parse_args()
-    transform_convocatorias_to_csv(Path(args.json), Path(args.csv))
+    if args.csv:
+        transform_convocatorias_to_csv(Path(args.json), Path(args.csv), args.workers)
+    else:
+        transform_and_copy_convocatorias(Path(args.json), args.workers)
@@ -1,12 +1,19 @@
 # seeding/convocatorias/transform/transform_convocatorias_to_jsonl.py
 
 import json
+import os
 import sys
+import ijson
 import time
 import logging
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, Iterator, List, Optional, Any
 from datetime import datetime
+from collections import defaultdict
+from contextlib import nullcontext
+from multiprocessing import Pool
+from functools import lru_cache
+from unicodedata import combining, normalize
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
@@ -44,6 +51,25 @@ CAMPO_MAP = {
 }
 
 
+# Convocatorias por tarea enviada a cada worker del pool
+POOL_CHUNKSIZE = 2000
+
+# (tabla, clave en la API) de los arrays N:M que se resuelven por descripción
+_ARRAYS_POR_DESCRIPCION = (
+    ("instrumento", "instrumentos"),
+    ("region", "regiones"),
+    ("fondo", "fondos"),
+    ("objetivo", "objetivos"),
+    ("sector_producto", "sectoresProductos"),
+)
+
+# Arrays con código (se prueba antes que la descripción)
+_ARRAYS_POR_CODIGO = (
+    ("tipo_beneficiario", "tiposBeneficiarios"),
+    ("sector_actividad", "sectores"),
+)
+
+
 def parse_fecha(fecha_str: Optional[str]) -> Optional[str]:
     """Normaliza fechas a formato ISO."""
     if not fecha_str:
@@ -55,129 +81,150 @@ def parse_fecha(fecha_str: Optional[str]) -> Optional[str]:
         return None
 
 
-def resolver_fk_por_descripcion(session, tabla: str, descripcion: Optional[str]) -> Optional[str]:
-    """Resuelve UUID de catálogo buscando por descripcion_norm."""
+@lru_cache(maxsize=65536)
+def normalizar_descripcion(descripcion: str) -> str:
+    """Forma de descripcion_norm: minúsculas y sin marcas diacríticas."""
+    descripcion_norm = normalize('NFKD', descripcion.lower())
+    return ''.join(c for c in descripcion_norm if not combining(c))
+
+
+def _descripcion_arrays(raw: Dict):
+    """(tabla, descripcion) de las FKs y arrays N:M que se resuelven por descripción."""
+    reglamento = raw.get("reglamento")
+    if reglamento:
+        yield "reglamento", reglamento.get("descripcion")
+    yield "finalidad", raw.get("descripcionFinalidad")
+    for tabla, clave in _ARRAYS_POR_DESCRIPCION + _ARRAYS_POR_CODIGO:
+        for item in raw.get(clave) or []:
+            yield tabla, item.get("descripcion")
+
+
+def cargar_lookups(session, raw_data: Iterable[Dict]) -> Dict[str, Any]:
+    """
+    Resuelve de una vez todos los catálogos que referencian las convocatorias:
+    recoge en una primera pasada las descripciones y códigos usados y lanza una
+    consulta por tabla (= ANY(:xs)). Los órganos se cargan enteros.
+
+    Returns:
+        {"descripcion": {tabla: {descripcion_norm: uuid}},
+         "codigo": {tabla: {codigo: uuid}},
+         "organo": {(n1, n2, n3 | None): uuid}}
+    """
+    descripciones = defaultdict(set)
+    codigos = defaultdict(set)
+    for raw in raw_data:
+        for tabla, descripcion in _descripcion_arrays(raw):
+            if descripcion:
+                descripciones[tabla].add(normalizar_descripcion(descripcion))
+        for tabla, clave in _ARRAYS_POR_CODIGO:
+            for item in raw.get(clave) or []:
+                if item.get("codigo"):
+                    codigos[tabla].add(item["codigo"])
+
+    lookups = {"descripcion": {}, "codigo": {}, "organo": {}}
+    for tabla, xs in descripciones.items():
+        rows = session.execute(
+            text(f"SELECT descripcion_norm, id FROM bdns.{tabla} WHERE descripcion_norm = ANY(:xs)"),
+            {"xs": list(xs)}
+        ).all()
+        por_desc = lookups["descripcion"][tabla] = {}
+        for desc_norm, id_ in rows:
+            por_desc.setdefault(desc_norm, str(id_))
+    for tabla, xs in codigos.items():
+        rows = session.execute(
+            text(f"SELECT codigo, id FROM bdns.{tabla} WHERE codigo = ANY(:xs)"),
+            {"xs": list(xs)}
+        ).all()
+        por_codigo = lookups["codigo"][tabla] = {}
+        for codigo, id_ in rows:
+            por_codigo.setdefault(str(codigo), str(id_))
+    rows = session.execute(text(
+        "SELECT nivel1_norm, nivel2_norm, nivel3_norm, id FROM bdns.organo"
+    )).all()
+    for n1, n2, n3, id_ in rows:
+        lookups["organo"].setdefault((n1, n2, n3), str(id_))
+
+    logger.info(f"Catálogos resueltos: {sum(len(d) for d in lookups['descripcion'].values())} "
+                f"por descripción, {sum(len(d) for d in lookups['codigo'].values())} por código, "
+                f"{len(lookups['organo'])} órganos")
+    return lookups
+
+
+def resolver_fk_por_descripcion(lookups: Dict, tabla: str, descripcion: Optional[str]) -> Optional[str]:
+    """Resuelve UUID de catálogo por descripcion_norm."""
     if not descripcion:
         return None
-    
-    from unicodedata import normalize
-    descripcion_norm = normalize('NFKD', descripcion.lower())
-    descripcion_norm = ''.join(c for c in descripcion_norm if not c.iscombining())
-    
-    result = session.execute(
-        text(f"SELECT id FROM bdns.{tabla} WHERE descripcion_norm = :desc"),
-        {"desc": descripcion_norm}
-    ).scalar()
-    
+
+    result = lookups["descripcion"].get(tabla, {}).get(normalizar_descripcion(descripcion))
+
     if result:
         logger.debug(f"Resuelto {tabla}: '{descripcion[:30]}...' -> {result}")
     else:
         logger.warning(f"No se encontró {tabla} para: '{descripcion[:50]}...'")
-    
-    return str(result) if result else None
+
+    return result
 
 
-def resolver_organo_id(session, organo_data: Optional[Dict]) -> Optional[str]:
+def resolver_organo_id(lookups: Dict, organo_data: Optional[Dict]) -> Optional[str]:
     """Resuelve UUID de órgano por niveles jerárquicos."""
     if not organo_data:
         return None
-    
+
     nivel1 = organo_data.get("nivel1", "")
     nivel2 = organo_data.get("nivel2", "")
     nivel3 = organo_data.get("nivel3")
-    
-    query = """
-        SELECT id FROM bdns.organo 
-        WHERE nivel1_norm = :n1 AND nivel2_norm = :n2
-    """
-    params = {
-        "n1": nivel1.lower() if nivel1 else "",
-        "n2": nivel2.lower() if nivel2 else ""
-    }
-    
-    if nivel3:
-        query += " AND nivel3_norm = :n3"
-        params["n3"] = nivel3.lower()
-    else:
-        query += " AND nivel3_norm IS NULL"
-    
-    result = session.execute(text(query), params).scalar()
-    
+
+    key = (
+        nivel1.lower() if nivel1 else "",
+        nivel2.lower() if nivel2 else "",
+        nivel3.lower() if nivel3 else None,
+    )
+    result = lookups["organo"].get(key)
+
     if not result:
         logger.warning(f"Órgano no encontrado: {nivel1}/{nivel2}/{nivel3}")
-    
-    return str(result) if result else None
+
+    return result
 
 
-def extraer_ids_array(session, tabla: str, items: Optional[List[Dict]], campo_descripcion: str = "descripcion") -> List[str]:
+def extraer_ids_array(lookups: Dict, tabla: str, items: Optional[List[Dict]], campo_descripcion: str = "descripcion") -> List[str]:
     """Resuelve UUIDs para array de objetos."""
     if not items:
         return []
-    
+
     ids = []
     for item in items:
         desc = item.get(campo_descripcion)
-        fk_id = resolver_fk_por_descripcion(session, tabla, desc)
+        fk_id = resolver_fk_por_descripcion(lookups, tabla, desc)
         if fk_id:
             ids.append(fk_id)
-    
+
     logger.debug(f"Resueltos {len(ids)}/{len(items)} {tabla}")
     return ids
 
 
-def extraer_sector_actividad_ids(session, sectores: Optional[List[Dict]]) -> List[str]:
-    """Sectores tienen código y descripción."""
-    if not sectores:
+def extraer_ids_por_codigo(lookups: Dict, tabla: str, items: Optional[List[Dict]]) -> List[str]:
+    """Arrays con código y descripción (sectores, tipos de beneficiario): primero por código."""
+    if not items:
         return []
-    
-    ids = []
-    for sector in sectores:
-        codigo = sector.get("codigo")
-        descripcion = sector.get("descripcion")
-        
-        if codigo:
-            result = session.execute(
-                text("SELECT id FROM bdns.sector_actividad WHERE codigo = :cod"),
-                {"cod": codigo}
-            ).scalar()
-            if result:
-                ids.append(str(result))
-                continue
-        
-        fk_id = resolver_fk_por_descripcion(session, "sector_actividad", descripcion)
-        if fk_id:
-            ids.append(fk_id)
-    
-    return ids
-
 
-def extraer_tipo_beneficiario_ids(session, tipos: Optional[List[Dict]]) -> List[str]:
-    """Tipos de beneficiario con código o descripción."""
-    if not tipos:
-        return []
-    
     ids = []
-    for tipo in tipos:
-        codigo = tipo.get("codigo")
-        descripcion = tipo.get("descripcion")
-        
+    for item in items:
+        codigo = item.get("codigo")
         if codigo:
-            result = session.execute(
-                text("SELECT id FROM bdns.tipo_beneficiario WHERE codigo = :cod"),
-                {"cod": codigo}
-            ).scalar()
+            result = lookups["codigo"].get(tabla, {}).get(str(codigo))
             if result:
-                ids.append(str(result))
+                ids.append(result)
                 continue
-        
-        fk_id = resolver_fk_por_descripcion(session, "tipo_beneficiario", descripcion)
+
+        fk_id = resolver_fk_por_descripcion(lookups, tabla, item.get("descripcion"))
         if fk_id:
             ids.append(fk_id)
-    
+
     return ids
 
 
-def transformar_convocatoria(session, raw: Dict) -> Optional[Dict]:
+def transformar_convocatoria(lookups: Dict, raw: Dict) -> Optional[Dict]:
     """Transforma un objeto convocatoria de la API a nuestro esquema."""
     codigo_bdns = raw.get("codigoBDNS")
     if not codigo_bdns:
@@ -199,19 +246,19 @@ def transformar_convocatoria(session, raw: Dict) -> Optional[Dict]:
     # Resolver FKs
     logger.debug(f"Resolviendo FKs para convocatoria {codigo_bdns}")
     
-    result["organo_id"] = resolver_organo_id(session, raw.get("organo"))
-    result["reglamento_id"] = resolver_fk_por_descripcion(session, "reglamento", 
+    result["organo_id"] = resolver_organo_id(lookups, raw.get("organo"))
+    result["reglamento_id"] = resolver_fk_por_descripcion(lookups, "reglamento", 
                                                           raw.get("reglamento", {}).get("descripcion") if raw.get("reglamento") else None)
-    result["finalidad_id"] = resolver_fk_por_descripcion(session, "finalidad", raw.get("descripcionFinalidad"))
+    result["finalidad_id"] = resolver_fk_por_descripcion(lookups, "finalidad", raw.get("descripcionFinalidad"))
     
     # Arrays N:M
-    result["instrumento_ids"] = extraer_ids_array(session, "instrumento", raw.get("instrumentos"))
-    result["tipo_beneficiario_ids"] = extraer_tipo_beneficiario_ids(session, raw.get("tiposBeneficiarios"))
-    result["sector_actividad_ids"] = extraer_sector_actividad_ids(session, raw.get("sectores"))
-    result["region_ids"] = extraer_ids_array(session, "region", raw.get("regiones"))
-    result["fondo_ids"] = extraer_ids_array(session, "fondo", raw.get("fondos"))
-    result["objetivo_ids"] = extraer_ids_array(session, "objetivo", raw.get("objetivos"))
-    result["sector_producto_ids"] = extraer_ids_array(session, "sector_producto", raw.get("sectoresProductos"))
+    result["instrumento_ids"] = extraer_ids_array(lookups, "instrumento", raw.get("instrumentos"))
+    result["tipo_beneficiario_ids"] = extraer_ids_por_codigo(lookups, "tipo_beneficiario", raw.get("tiposBeneficiarios"))
+    result["sector_actividad_ids"] = extraer_ids_por_codigo(lookups, "sector_actividad", raw.get("sectores"))
+    result["region_ids"] = extraer_ids_array(lookups, "region", raw.get("regiones"))
+    result["fondo_ids"] = extraer_ids_array(lookups, "fondo", raw.get("fondos"))
+    result["objetivo_ids"] = extraer_ids_array(lookups, "objetivo", raw.get("objetivos"))
+    result["sector_producto_ids"] = extraer_ids_array(lookups, "sector_producto", raw.get("sectoresProductos"))
     
     # Entidades anidadas (para carga posterior)
     result["documentos"] = raw.get("documentos", [])
@@ -220,36 +267,74 @@ def transformar_convocatoria(session, raw: Dict) -> Optional[Dict]:
     return result
 
 
-def transform_convocatorias_jsonl(input_json: Path, output_jsonl: Path) -> int:
-    """Lee JSON crudo de la API, transforma y escribe JSONL normalizado."""
+def iter_convocatorias(input_json: Path) -> Iterator[Dict]:
+    """
+    Recorre las convocatorias del JSON crudo en streaming (ijson), sin cargar
+    la lista entera. Un JSON con un único objeto se devuelve tal cual.
+    """
+    with open(input_json, "rb") as f:
+        if f.read(64).lstrip().startswith(b"{"):
+            f.seek(0)
+            yield json.load(f)
+            return
+        f.seek(0)
+        yield from ijson.items(f, "item", use_float=True)
+
+
+# Lookups de solo lectura instalados en cada proceso worker (ver _init_worker)
+_lookups = None
+
+
+def _init_worker(lookups: Dict):
+    """Inicializador del pool: recibe los lookups una vez por proceso."""
+    global _lookups
+    _lookups = lookups
+
+
+def _transformar_linea(raw_conv: Dict) -> Optional[str]:
+    """Transforma una convocatoria en su línea JSONL; None si se omite."""
+    try:
+        transformed = transformar_convocatoria(_lookups, raw_conv)
+    except Exception as e:
+        logger.error(f"Error transformando convocatoria {raw_conv.get('codigoBDNS')}: {e}", exc_info=True)
+        return None
+    if not transformed:
+        return None
+    return json.dumps(transformed, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def transform_convocatorias_jsonl(input_json: Path, output_jsonl: Path, workers: Optional[int] = None) -> int:
+    """
+    Lee JSON crudo de la API, transforma y escribe JSONL normalizado.
+    Las convocatorias se transforman en un pool de procesos (imap_unordered);
+    con workers=1, en este proceso.
+    """
     logger.info(f"Iniciando transformación: {input_json.name} -> {output_jsonl.name}")
-    
-    with open(input_json, "r", encoding="utf-8") as f:
-        raw_data = json.load(f)
-    
-    if isinstance(raw_data, dict):
-        raw_data = [raw_data]
-    
-    logger.info(f"Leídas {len(raw_data)} convocatorias del JSON de entrada")
-    
+
+    # Dos pasadas en streaming: la primera reúne los catálogos a resolver,
+    # la segunda transforma y escribe
     with get_session() as session:
-        count = 0
-        skipped = 0
-        with open(output_jsonl, "w", encoding="utf-8") as fout:
-            for i, raw_conv in enumerate(raw_data, 1):
-                try:
-                    transformed = transformar_convocatoria(session, raw_conv)
-                    if transformed:
-                        fout.write(json.dumps(transformed, ensure_ascii=False, separators=(",", ":")))
-                        fout.write("\n")
-                        count += 1
-                    else:
-                        skipped += 1
-                except Exception as e:
-                    logger.error(f"Error transformando convocatoria {i}: {e}", exc_info=True)
-                    skipped += 1
-        
-        logger.info(f"Transformación completada: {count} convocatorias escritas, {skipped} omitidas")
+        lookups = cargar_lookups(session, iter_convocatorias(input_json))
+
+    workers = workers or os.cpu_count() or 1
+    count = 0
+    skipped = 0
+    with open(output_jsonl, "w", encoding="utf-8") as fout, \
+            (Pool(workers, initializer=_init_worker, initargs=(lookups,)) if workers > 1 else nullcontext()) as pool:
+        if pool is None:
+            _init_worker(lookups)
+            lineas = map(_transformar_linea, iter_convocatorias(input_json))
+        else:
+            lineas = pool.imap_unordered(_transformar_linea, iter_convocatorias(input_json), chunksize=POOL_CHUNKSIZE)
+        for linea in lineas:
+            if linea is None:
+                skipped += 1
+            else:
+                fout.write(linea)
+                count += 1
+
+    logger.info(f"Transformación completada: {count} convocatorias escritas, {skipped} omitidas "
+                f"(de {count + skipped} en el JSON de entrada)")
     
     return count
 
@@ -260,6 +345,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Transforma JSON crudo de API a JSONL normalizado")
     parser.add_argument("--input", required=True, help="JSON de entrada (crudo de API)")
     parser.add_argument("--output", required=True, help="JSONL de salida (normalizado)")
+    parser.add_argument("--workers", type=int, help="Procesos para transformar (por defecto, todos los núcleos)")
     parser.add_argument("--verbose", "-v", action="store_true", help="Nivel DEBUG")
     args = parser.parse_args()
     
@@ -268,7 +354,7 @@ if __name__ == "__main__":
         logger.debug("Modo verbose activado")
     
     try:
-        total = transform_convocatorias_jsonl(Path(args.input), Path(args.output))
+        total = transform_convocatorias_jsonl(Path(args.input), Path(args.output), args.workers)
         logger.info(f"ETL completado exitosamente")
         print(f"{total}", file=sys.stderr)  # Para scripting
     except Exception as e:
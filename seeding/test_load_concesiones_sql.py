@@ -0,0 +1,83 @@
+"""
+Script de prueba para las conversiones SQL de load_concesiones.
+
+Ejecuta _sql_date y _sql_float contra la base de datos con valores límite:
+fechas imposibles y números fuera de rango deben dar NULL, nunca un error
+que aborte la carga (que va en una sola transacción).
+"""
+
+import sys
+from datetime import date
+from pathlib import Path
+
+# Añadir paths
+sys.path.insert(0, str(Path(__file__).parent / "concesiones" / "load"))
+
+from sqlalchemy import text
+from load_concesiones import _sql_date, _sql_float, get_session
+
+
+FECHAS = [
+    ("2024-02-29", date(2024, 2, 29)),
+    ("2023-02-29", None),
+    ("31/04/2024", None),
+    ("30/04/2024", date(2024, 4, 30)),
+    ("29/02/2000", date(2000, 2, 29)),
+    ("29/02/1900", None),
+    ("2024-13-01", None),
+    ("0000-01-01", None),
+    ("2024/01/01", None),
+    ("", None),
+]
+
+IMPORTES = [
+    ("1e999", None),
+    (".5", 0.5),
+    ("5.", 5.0),
+    ("-1,25", -1.25),
+    ("1.5e3", 1500.0),
+    ("0", 0.0),
+    ("1.234,56", None),
+    ("abc", None),
+    ("", None),
+]
+
+
+def _evaluar(session, expr_sql: str, valor: str):
+    return session.execute(
+        text(f"SELECT {expr_sql} FROM (VALUES (CAST(:v AS text))) t(x)"),
+        {"v": valor},
+    ).scalar()
+
+
+def test_sql_date():
+    """Fechas válidas se convierten; las imposibles dan NULL sin error."""
+    with get_session() as session:
+        for valor, esperado in FECHAS:
+            obtenido = _evaluar(session, _sql_date("t.x"), valor)
+            assert obtenido == esperado, f"_sql_date({valor!r}) = {obtenido!r}, esperado {esperado!r}"
+
+
+def test_sql_float():
+    """Importes con punto o coma decimal; los no convertibles dan NULL sin error."""
+    with get_session() as session:
+        for valor, esperado in IMPORTES:
+            obtenido = _evaluar(session, _sql_float("t.x"), valor)
+            assert obtenido == esperado, f"_sql_float({valor!r}) = {obtenido!r}, esperado {esperado!r}"
+
+
+def main():
+    """Ejecuta todas las pruebas."""
+    print("\n" + "=" * 60)
+    print("VERIFICACIÓN DE CONVERSIONES SQL DE load_concesiones")
+    print("=" * 60)
+
+    test_sql_date()
+    print(f"✅ _sql_date: {len(FECHAS)} casos")
+
+    test_sql_float()
+    print(f"✅ _sql_float: {len(IMPORTES)} casos")
+
+
+if __name__ == "__main__":
+    main()